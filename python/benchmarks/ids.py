@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Compares the uuid4 and compact pipeline ID allocations.
+
+Times the generation of IDs one at a time and in fan-out sized batches, then
+runs a fan-out pipeline against the local service stubs with each allocation
+and reports the bytes of the entities put and of the tasks enqueued.
+
+Usage:
+  python benchmarks/ids.py [children]
+"""
+
+import logging
+import os
+import sys
+import timeit
+import unittest
+
+# Fix up paths for running benchmarks.
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../test'))
+
+import testutil
+
+from google.appengine.api import apiproxy_stub_map
+
+from pipeline import pipeline, testing as test_shared
+
+
+class Echo(pipeline.Pipeline):
+  """A synchronous pipeline that outputs its argument."""
+
+  def run(self, value):
+    return value
+
+
+class FanOut(pipeline.Pipeline):
+  """Yields a chain of Echo children, each depending on the last one."""
+
+  def run(self, children):
+    result = None
+    for index in range(children):
+      result = yield Echo(index if result is None else result)
+
+
+class _Harness(test_shared.TaskRunningMixin, testutil.TestSetupMixin,
+               unittest.TestCase):
+  """Provides the service stubs and task runner of the tests."""
+
+  def runTest(self):
+    pass
+
+
+class _ByteCounter(object):
+  """Counts the bytes of the entities put and the tasks added."""
+
+  def __init__(self):
+    self.entity_bytes = 0
+    self.key_bytes = 0
+    self.task_bytes = 0
+
+  def install(self):
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('id_bytes_datastore', self._datastore_hook, 'datastore_v3')
+    hooks.Append('id_bytes_taskqueue', self._taskqueue_hook, 'taskqueue')
+
+  def _datastore_hook(self, service, call, request, response):
+    if call == 'Put':
+      for entity in request.entity:
+        self.entity_bytes += entity.ByteSize()
+        self.key_bytes += entity.key.ByteSize()
+
+  def _taskqueue_hook(self, service, call, request, response):
+    if call == 'BulkAdd':
+      for add_request in request.add_request:
+        self.task_bytes += add_request.ByteSize()
+
+
+def measure(children, id_allocation):
+  """Runs a FanOut pipeline and returns its _ByteCounter."""
+  harness = _Harness()
+  harness.setUp()
+  try:
+    counter = _ByteCounter()
+    counter.install()
+    stage = FanOut(children)
+    stage.id_allocation = id_allocation
+    harness.run_pipeline(stage)
+  finally:
+    harness.tearDown()
+  return counter
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.ERROR)
+  children = int(argv[1]) if len(argv) > 1 else 20
+  allocations = (pipeline.UUID_IDS, pipeline.COMPACT_IDS)
+
+  print('%-10s %14s %14s' % ('ids', 'one by one us', 'batch us/id'))
+  number = 20000
+  for id_allocation in allocations:
+    single = min(timeit.repeat(
+        lambda: pipeline._allocate_ids(id_allocation, 1),
+        number=number, repeat=3)) / number
+    batches = max(1, number // children)
+    batch = min(timeit.repeat(
+        lambda: pipeline._allocate_ids(id_allocation, children * 2),
+        number=batches, repeat=3)) / batches / (children * 2)
+    print('%-10s %14.2f %14.2f' % (id_allocation, single * 1e6, batch * 1e6))
+
+  print()
+  print('%-10s %12s %12s %12s' % (
+      'ids', 'entity bytes', 'key bytes', 'task bytes'))
+  for id_allocation in allocations:
+    counter = measure(children, id_allocation)
+    print('%-10s %12d %12d %12d' % (
+        id_allocation, counter.entity_bytes, counter.key_bytes,
+        counter.task_bytes))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
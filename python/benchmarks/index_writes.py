@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Reports the Datastore index writes per pipeline node.
+
+Runs a fan-out pipeline against the local service stubs, once with the
+default indexes and once in low-index mode, and counts the index rows
+written by every put along the way.
+
+Usage:
+  python benchmarks/index_writes.py [children]
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+# Fix up paths for running benchmarks.
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../test'))
+
+import testutil
+
+from pipeline import models, pipeline, testing as test_shared
+
+
+class Echo(pipeline.Pipeline):
+  """A synchronous pipeline that outputs its argument."""
+
+  def run(self, value):
+    return value
+
+
+class FanOut(pipeline.Pipeline):
+  """Yields a chain of Echo children, each depending on the last one."""
+
+  def run(self, children):
+    result = None
+    for index in range(children):
+      result = yield Echo(index if result is None else result)
+
+
+class _Harness(test_shared.TaskRunningMixin, testutil.TestSetupMixin,
+               unittest.TestCase):
+  """Provides the service stubs and task runner of the tests."""
+
+  def runTest(self):
+    pass
+
+
+def measure(children, low_index_mode):
+  """Runs a FanOut pipeline and returns its IndexWriteCounter."""
+  models._LOW_INDEX_MODE = low_index_mode
+  harness = _Harness()
+  harness.setUp()
+  try:
+    counter = testutil.IndexWriteCounter()
+    counter.install()
+    harness.run_pipeline(FanOut(children))
+  finally:
+    harness.tearDown()
+  return counter
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.ERROR)
+  children = int(argv[1]) if len(argv) > 1 else 20
+  # The generator and its children.
+  nodes = children + 1
+  print('%-10s %8s %14s %13s %15s' % (
+      'mode', 'puts', 'indexed values', 'index writes', 'writes per node'))
+  for low_index_mode in (False, True):
+    counter = measure(children, low_index_mode)
+    print('%-10s %8d %14d %13d %15.1f' % (
+        'low-index' if low_index_mode else 'default', counter.entities,
+        counter.indexed_values, counter.index_writes,
+        counter.index_writes / nodes))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Micro-benchmarks of the JSON codec on params and slot payloads.
+
+Times encoding and decoding of representative payloads with the current
+codec, next to the plain object-hook decoding it replaced, with and without
+flat keys, and with and without orjson.
+
+Usage:
+  python benchmarks/json_codec.py [repeat]
+"""
+
+import datetime
+import json
+import os
+import sys
+import timeit
+
+# Fix up paths for running benchmarks.
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from google.appengine.api import full_app_id
+from google.appengine.ext import ndb
+
+from pipeline import util
+
+
+def _slot_key(index):
+  return ndb.Key('_AE_Pipeline_Slot', '%032x' % index)
+
+
+def payloads():
+  """Returns (name, value) pairs of representative payloads."""
+  now = datetime.datetime(2024, 5, 17, 12, 30, 45, 123456)
+  params = {
+      'args': [{'type': 'value', 'value': index} for index in range(5)] + [
+          {'type': 'slot', 'slot_key': _slot_key(9).urlsafe().decode()}],
+      'kwargs': {'name': {'type': 'value', 'value': 'a name'}},
+      'after_all': [],
+      'output_slots': dict(
+          (name, _slot_key(index).urlsafe().decode())
+          for index, name in enumerate(('default', 'one', 'two'))),
+      'class_path': 'my.module.MyPipeline',
+      'queue_name': 'default',
+      'base_path': '/_ah/pipeline',
+      'backoff_seconds': 15,
+      'backoff_factor': 2,
+      'max_attempts': 3,
+      'task_retry': False,
+      'target': None,
+  }
+  return [
+      ('params', params),
+      ('rows', [{'id': index, 'name': 'row %d' % index, 'score': index / 3.0,
+                 'tags': ['a', 'b']} for index in range(1000)]),
+      ('keys', [_slot_key(index) for index in range(200)]),
+      ('datetimes', [now + datetime.timedelta(seconds=index)
+                     for index in range(200)]),
+      ('text', 'x' * 100000),
+  ]
+
+
+def _legacy_encode_key(o):
+  return {'key_string': o.urlsafe().decode('utf-8')}
+
+
+def _legacy_encode_datetime(o):
+  return {'isostr': o.strftime(util._DATETIME_FORMAT)}
+
+
+def _legacy_decode_datetime(d):
+  return datetime.datetime.strptime(d['isostr'], util._DATETIME_FORMAT)
+
+
+def _legacy_encode(value):
+  """Encodes like the codec did before, with urlsafe keys and strftime."""
+  encoders = util._TYPE_TO_ENCODER
+  encoders[ndb.Key] = _legacy_encode_key
+  encoders[datetime.datetime] = _legacy_encode_datetime
+  try:
+    return json.dumps(value, sort_keys=True, cls=util.JsonEncoder)
+  finally:
+    encoders[ndb.Key] = util._JsonEncodeKey
+    encoders[datetime.datetime] = util._json_encode_datetime
+
+
+def _legacy_decode(encoded):
+  """Decodes like the codec did before, with the hook on every object."""
+  decoders = util._TYPE_NAME_TO_DECODER
+  decoders['datetime'] = _legacy_decode_datetime
+  try:
+    return json.loads(encoded, cls=util.JsonDecoder)
+  finally:
+    decoders['datetime'] = util._json_decode_datetime
+
+
+def _time(function, repeat):
+  number = max(1, repeat)
+  return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main(argv):
+  repeat = int(argv[1]) if len(argv) > 1 else 200
+  full_app_id.put('benchmark-app')
+  print('orjson %s' % ('available' if util.orjson else 'not installed'))
+  print('%-10s %9s %9s %11s %11s %11s %11s' % (
+      'payload', 'old size', 'new size', 'old enc us', 'new enc us',
+      'old dec us', 'new dec us'))
+  for name, value in payloads():
+    legacy = _legacy_encode(value)
+    current = util._json_encode_value(value)
+    assert util._json_decode_value(current) == _legacy_decode(legacy)
+    print('%-10s %9d %9d %11.1f %11.1f %11.1f %11.1f' % (
+        name, len(legacy), len(current),
+        _time(lambda: _legacy_encode(value), repeat),
+        _time(lambda: util._json_encode_value(value), repeat),
+        _time(lambda: _legacy_decode(legacy), repeat),
+        _time(lambda: util._json_decode_value(current), repeat)))
+
+  print()
+  print('%-10s %9s %9s %11s %11s %11s %11s' % (
+      'keys', 'url size', 'flat size', 'url enc us', 'flat enc us',
+      'url dec us', 'flat dec us'))
+  keys = dict(payloads())['keys']
+  results = []
+  for flat_keys in (False, True):
+    util._FLAT_KEYS = flat_keys
+    encoded = util._json_encode_value(keys)
+    assert util._json_decode_value(encoded) == keys
+    results.append((
+        len(encoded),
+        _time(lambda: util._json_encode_value(keys), repeat),
+        _time(lambda: util._json_decode_value(encoded), repeat)))
+  util._FLAT_KEYS = False
+  print('%-10s %9d %9d %11.1f %11.1f %11.1f %11.1f' % (
+      'keys', results[0][0], results[1][0], results[0][1], results[1][1],
+      results[0][2], results[1][2]))
+
+  if util.orjson:
+    print()
+    print('%-10s %14s %14s' % ('payload', 'json dec us', 'orjson dec us'))
+    for name, value in payloads():
+      current = util._json_encode_value(value)
+      timings = []
+      for use_orjson in (False, True):
+        util._USE_ORJSON = use_orjson
+        timings.append(
+            _time(lambda: util._json_decode_value(current), repeat))
+      print('%-10s %14.1f %14.1f' % (name, timings[0], timings[1]))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -16,15 +16,323 @@
 
 """Datastore models used by the Google App Engine Pipeline API."""
 
-import json
-
+import collections
+import contextlib
+import hashlib
+import logging
+import pickle
+import threading
+
+from google.appengine.api import full_app_id
 from google.appengine.ext import ndb
 
 # Relative imports
 from . import util
 
+# When True, entities are written without the indexes that only the
+# root_pipeline queries and other unused queries need; the entities of a root
+# pipeline are found through its _ManifestRecord instead. Root _PipelineRecords
+# keep the indexes of the root list. Manifests are only written and relied on
+# when this is True. Only enable this once every instance runs code that writes
+# manifests; root pipelines started before it was enabled have no root manifest
+# page and fall back to the root_pipeline queries.
+_LOW_INDEX_MODE = False
+
+# Decoded _PipelineRecord params are kept in a process-wide cache of at most
+# this many bytes, so the records fetched by later requests are not decoded,
+# or downloaded from Cloud Storage, again. None disables the cache.
+_PARAMS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Maps (pipeline key, codec, digest) tuples to pickled params, least
+# recently used first.
+_params_cache = collections.OrderedDict()
+_params_cache_bytes = 0
+_params_cache_lock = threading.Lock()
+
+# When True, pipeline and slot keys are written to params and task payloads in
+# the compact form of _encode_key. Only enable it once every instance serving
+# tasks can read compact keys.
+_COMPACT_KEYS = False
+
+# At most this many keys parsed by _decode_key are memoized. None disables the
+# memo.
+_KEY_CACHE_SIZE = 10000
+
+# Maps (model class, encoded key) pairs to the keys parsed from them, least
+# recently used first.
+_key_cache = collections.OrderedDict()
+_key_cache_lock = threading.Lock()
+
+
+def _decode_payload(text, blob, gcs, codec):
+  """Decodes a params or slot value stored in one of several properties.
+
+  Args:
+    text: The inline text encoding, if any.
+    blob: The inline binary encoding, if any; may be compressed.
+    gcs: The name of the Cloud Storage blob holding the encoding, if any; its
+      contents may be compressed.
+    codec: The ID of the codec used to encode the value; None for JSON.
+
+  Returns:
+    The decoded value.
+  """
+  from .storage import read_blob_gcs, read_stream_gcs
+
+  if gcs is not None and codec == util.JSON_STREAM_CODEC:
+    # Streamed values are decoded as they are downloaded.
+    return util.decode_json_stream(
+        util.decompress_chunks(read_stream_gcs(gcs)))
+  if gcs is not None:
+    encoded = read_blob_gcs(gcs)
+  elif blob is not None:
+    encoded = blob
+  else:
+    encoded = text
+  return util.decode_value(util.decompress_encoded(encoded), codec)
+
+
+def _get_cached_params(cache_key):
+  """Returns a private copy of cached params, or None if not cached."""
+  with _params_cache_lock:
+    pickled = _params_cache.get(cache_key)
+    if pickled is None:
+      return None
+    _params_cache.move_to_end(cache_key)
+  return pickle.loads(pickled)
+
+
+def _cache_params(cache_key, params):
+  """Adds decoded params to the cache, evicting the least recently used."""
+  global _params_cache_bytes
+  try:
+    pickled = pickle.dumps(params, pickle.HIGHEST_PROTOCOL)
+  except Exception as e:
+    logging.debug('Not caching params of %r: %s', cache_key[0], e)
+    return
+  if len(pickled) > _PARAMS_CACHE_MAX_BYTES:
+    return
+  with _params_cache_lock:
+    previous = _params_cache.pop(cache_key, None)
+    if previous is not None:
+      _params_cache_bytes -= len(previous)
+    _params_cache[cache_key] = pickled
+    _params_cache_bytes += len(pickled)
+    while _params_cache_bytes > _PARAMS_CACHE_MAX_BYTES:
+      _, evicted = _params_cache.popitem(last=False)
+      _params_cache_bytes -= len(evicted)
+
+
+def _clear_params_cache():
+  """Empties the params cache."""
+  global _params_cache_bytes
+  with _params_cache_lock:
+    _params_cache.clear()
+    _params_cache_bytes = 0
+
+
+def _encode_key(key):
+  """Encodes a pipeline or slot key for params and task payloads.
+
+  Keys of this app whose path has string IDs and only _PipelineRecord
+  ancestors are encoded as '<namespace>:<ancestor IDs>:<ID>', which is much
+  shorter than the urlsafe form and cannot be mistaken for it since ':' is not
+  a urlsafe character. Other keys are encoded in the urlsafe form.
+
+  Args:
+    key: The ndb.Key to encode.
+
+  Returns:
+    The encoded key, readable by _decode_key.
+  """
+  if _COMPACT_KEYS and key.app() == full_app_id.get():
+    pairs = key.pairs()
+    parent_kind = _PipelineRecord._get_kind()
+    if (all(kind == parent_kind for kind, _ in pairs[:-1]) and
+        all(isinstance(key_id, str) and ':' not in key_id
+            for _, key_id in pairs)):
+      return ':'.join([key.namespace()] + [key_id for _, key_id in pairs])
+  return key.urlsafe().decode()
+
+
+def _decode_key(model_class, value):
+  """Parses a key encoded by _encode_key or in the urlsafe form.
+
+  Args:
+    model_class: The model class of the key, which compact encodings omit.
+    value: The encoded key.
+
+  Returns:
+    The ndb.Key.
+  """
+  cache_key = (model_class, value)
+  with _key_cache_lock:
+    key = _key_cache.get(cache_key)
+    if key is not None:
+      _key_cache.move_to_end(cache_key)
+      return key
+  if ':' in value:
+    parts = value.split(':')
+    pairs = [(_PipelineRecord, key_id) for key_id in parts[1:-1]]
+    pairs.append((model_class, parts[-1]))
+    key = ndb.Key(pairs=pairs, namespace=parts[0])
+  else:
+    key = ndb.Key(urlsafe=value)
+  if _KEY_CACHE_SIZE is not None:
+    with _key_cache_lock:
+      _key_cache[cache_key] = key
+      while len(_key_cache) > _KEY_CACHE_SIZE:
+        _key_cache.popitem(last=False)
+  return key
+
+
+def _unindex_properties(pb, names):
+  """Moves properties of an EntityProto to its unindexed properties.
+
+  Args:
+    pb: The EntityProto to modify.
+    names: The names of the properties to stop indexing.
+  """
+  moved = [prop for prop in pb.property if prop.name in names]
+  if moved:
+    kept = [prop for prop in pb.property if prop.name not in names]
+    del pb.property[:]
+    pb.property.extend(kept)
+    pb.raw_property.extend(moved)
+
+
+class _RequestCache(object):
+  """Entities read outside of transactions while handling one request.
+
+  Entities that never change once read, like filled slots and barrier
+  indexes, stay cached for the whole request. Any other entity is only reused
+  until the request writes or deletes an entity, since the write may be a
+  state transition that the cached copy does not reflect.
+  """
+
+  _local = threading.local()
+
+  def __init__(self):
+    # Entities reused for the whole request, and those dropped on any write;
+    # kept apart so that a write never has to go through the former.
+    self._entities = {}
+    self._mutable_entities = {}
+
+  @classmethod
+  def current(cls):
+    """Returns the cache of the current request, or None."""
+    return getattr(cls._local, 'cache', None)
+
+  def _get(self, key):
+    entity = self._entities.get(key)
+    if entity is None:
+      entity = self._mutable_entities.get(key)
+    return entity
+
+  def _add(self, entity):
+    if entity._immutable_in_request():
+      self._entities[entity.key] = entity
+    else:
+      self._mutable_entities[entity.key] = entity
+
+  def get_multi(self, keys):
+    """Returns the entities for the given keys, reading the missing ones."""
+    missing = [key for key in dict.fromkeys(keys) if self._get(key) is None]
+    if missing:
+      for entity in ndb.get_multi(missing):
+        if entity is not None:
+          self._add(entity)
+    return [self._get(key) for key in keys]
+
+  def prime(self, entities):
+    """Adds entities known without reading them, unless already cached."""
+    for entity in entities:
+      if self._get(entity.key) is None:
+        self._add(entity)
+
+  def invalidate(self, key):
+    """Drops the entities that a write of the given key may have changed."""
+    self._entities.pop(key, None)
+    self._mutable_entities.clear()
+
+
+@contextlib.contextmanager
+def _request_cache():
+  """Serves the reads made with _cached_get_multi() in the block from a cache."""
+  previous_cache = _RequestCache.current()
+  _RequestCache._local.cache = _RequestCache()
+  try:
+    yield
+  finally:
+    _RequestCache._local.cache = previous_cache
+
+
+def _cached_get_multi(keys):
+  """Reads entities through the request cache, when outside a transaction.
+
+  Args:
+    keys: The db.Keys of the entities to read.
+
+  Returns:
+    List of entities, with None for the keys that do not exist.
+  """
+  cache = _RequestCache.current()
+  if cache is None or ndb.in_transaction():
+    return ndb.get_multi(keys)
+  return cache.get_multi(keys)
+
+
+def _prime_request_cache(entities):
+  """Serves later reads of the given entities from the request cache."""
+  cache = _RequestCache.current()
+  if cache is not None:
+    cache.prime(entities)
+
+
+def _cached_get(key):
+  """Reads an entity through the request cache; see _cached_get_multi()."""
+  return _cached_get_multi([key])[0]
+
+
+class _RequestCachedModel(ndb.Model):
+  """Base class for models whose writes invalidate the request cache."""
+
+  def _immutable_in_request(self):
+    """Returns True if this entity may still be reused after writes."""
+    return False
+
+  def _pre_put_hook(self):
+    cache = _RequestCache.current()
+    if cache is not None:
+      cache.invalidate(self.key)
+
+  @classmethod
+  def _pre_delete_hook(cls, key):
+    cache = _RequestCache.current()
+    if cache is not None:
+      cache.invalidate(key)
+
+
+class _LowIndexModel(_RequestCachedModel):
+  """Base class for models that skip some index writes in low-index mode.
+
+  Subclasses list the properties that need no index in LOW_INDEX_PROPERTIES.
+  """
+
+  LOW_INDEX_PROPERTIES = ('root_pipeline',)
+
+  def _low_index_properties(self):
+    """Returns the names of the properties that need no index on this entity."""
+    return self.LOW_INDEX_PROPERTIES
+
+  def _to_pb(self, *args, **kwargs):
+    pb = super()._to_pb(*args, **kwargs)
+    if _LOW_INDEX_MODE:
+      _unindex_properties(pb, self._low_index_properties())
+    return pb
 
-class _PipelineRecord(ndb.Model):
+
+class _PipelineRecord(_LowIndexModel):
   """Represents a Pipeline.
 
   Key name is a randomly assigned UUID. No parent entity.
@@ -39,6 +347,7 @@ class _PipelineRecord(ndb.Model):
       was enqueued to run immediately.
     finalized_time: When this pipeline moved from WAITING or RUN to DONE.
     params: Serialized parameter dictionary.
+    params_codec: ID of the codec used to serialize params; None for JSON.
     status: The current status of the pipeline.
     current_attempt: The current attempt (starting at 0) to run.
     max_attempts: Maximum number of attempts (starting at 0) to run.
@@ -66,9 +375,11 @@ class _PipelineRecord(ndb.Model):
   start_time = ndb.DateTimeProperty(indexed=True)
   finalized_time = ndb.DateTimeProperty(indexed=False)
 
-  # One of these two will be set, depending on the size of the params.
+  # One of these will be set, depending on the size and codec of the params.
   params_text = ndb.TextProperty(name='params')
+  params_blob = ndb.BlobProperty(name='params_blob')
   params_gcs = ndb.StringProperty(name='params_gcs', indexed=False)
+  params_codec = ndb.StringProperty(name='params_codec', indexed=False)
 
   status = ndb.StringProperty(choices=(WAITING, RUN, DONE, ABORTED),
                              default=WAITING)
@@ -84,24 +395,62 @@ class _PipelineRecord(ndb.Model):
   abort_message = ndb.TextProperty()
   abort_requested = ndb.BooleanProperty(indexed=False)
 
+  LOW_INDEX_PROPERTIES = (
+      'class_path', 'root_pipeline', 'start_time', 'status',
+      'is_root_pipeline')
+
+  # The root list queries these on root pipelines.
+  ROOT_INDEX_PROPERTIES = ('class_path', 'start_time', 'is_root_pipeline')
+
   @classmethod
   def _get_kind(cls):
     return '_AE_Pipeline_Record'
 
+  def _low_index_properties(self):
+    if self.is_root_pipeline:
+      return tuple(name for name in self.LOW_INDEX_PROPERTIES
+                   if name not in self.ROOT_INDEX_PROPERTIES)
+    return self.LOW_INDEX_PROPERTIES
+
+  def _params_cache_key(self):
+    """Returns the key of this record's params in the params cache, or None.
+
+    Params never change once written, but the SHA-256 digest of their
+    encoding is part of the key in case a pipeline ID is reused after
+    cleanup. Blob names are derived from the content of the blob.
+    """
+    if _PARAMS_CACHE_MAX_BYTES is None or self.key is None:
+      return None
+    if self.params_gcs is not None:
+      digest = self.params_gcs
+    elif self.params_blob is not None:
+      digest = hashlib.sha256(self.params_blob).digest()
+    elif self.params_text is not None:
+      digest = hashlib.sha256(self.params_text.encode('utf-8')).digest()
+    else:
+      return None
+    return (self.key, self.params_codec, digest)
+
   @property
   def params(self):
-    """Returns the dictionary of parameters for this Pipeline."""
-    from .storage import read_blob_gcs
+    """Returns the dictionary of parameters for this Pipeline.
 
+    The params are decoded once per entity and shared through the params
+    cache with other fetches of the same record; each entity still gets its
+    own copy, so callers may modify it.
+    """
     if hasattr(self, '_params_decoded'):
       return self._params_decoded
 
-    if self.params_gcs is not None:
-      value_encoded = read_blob_gcs(self.params_gcs)
-    else:
-      value_encoded = self.params_text
+    cache_key = self._params_cache_key()
+    if cache_key is not None:
+      value = _get_cached_params(cache_key)
+      if value is not None:
+        self._params_decoded = value
+        return value
 
-    value = json.loads(value_encoded, cls=util.JsonDecoder)
+    value = _decode_payload(self.params_text, self.params_blob,
+                            self.params_gcs, self.params_codec)
     if isinstance(value, dict):
       kwargs = value.get('kwargs')
       if kwargs:
@@ -111,11 +460,13 @@ class _PipelineRecord(ndb.Model):
           adjusted_kwargs[str(arg_key)] = arg_value
         value['kwargs'] = adjusted_kwargs
 
+    if cache_key is not None:
+      _cache_params(cache_key, value)
     self._params_decoded = value
     return self._params_decoded
 
 
-class _SlotRecord(ndb.Model):
+class _SlotRecord(_LowIndexModel):
   """Represents an output slot.
 
   Key name is a randomly assigned UUID. No parent for slots of child pipelines.
@@ -126,6 +477,7 @@ class _SlotRecord(ndb.Model):
     root_pipeline: The root of the workflow.
     filler: The pipeline that filled this slot.
     value: Serialized value for this slot.
+    value_codec: ID of the codec used to serialize value; None for JSON.
     status: The current status of the slot.
     fill_time: When the slot was filled by the filler.
   """
@@ -138,48 +490,56 @@ class _SlotRecord(ndb.Model):
   root_pipeline = ndb.KeyProperty(kind=_PipelineRecord)
   filler = ndb.KeyProperty(_PipelineRecord)
 
-  # One of these two will be set, depending on the size of the value.
+  # One of these will be set, depending on the size and codec of the value.
   value_text = ndb.TextProperty(name='value')
+  value_blob = ndb.BlobProperty(name='value_blob')
   value_gcs = ndb.StringProperty(name='value_gcs', indexed=False)
+  value_codec = ndb.StringProperty(name='value_codec', indexed=False)
 
   status = ndb.StringProperty(choices=(FILLED, WAITING), default=WAITING,
                              indexed=False)
   fill_time = ndb.DateTimeProperty(indexed=False)
 
+  LOW_INDEX_PROPERTIES = ('root_pipeline', 'filler')
+
   @classmethod
   def _get_kind(cls):
     return '_AE_Pipeline_Slot'
 
+  def _immutable_in_request(self):
+    # Filled slots are only written again by retries of their filler.
+    return self.status == self.FILLED
+
   @property
   def value(self):
     """Returns the value of this Slot."""
-    from .storage import read_blob_gcs
-
     if hasattr(self, '_value_decoded'):
       return self._value_decoded
 
-    if self.value_gcs is not None:
-      encoded_value = read_blob_gcs(self.value_gcs)
-    else:
-      encoded_value = self.value_text
-
-    self._value_decoded = json.loads(encoded_value, cls=util.JsonDecoder)
+    self._value_decoded = _decode_payload(self.value_text, self.value_blob,
+                                          self.value_gcs, self.value_codec)
     return self._value_decoded
 
 
-class _BarrierRecord(ndb.Model):
+class _BarrierRecord(_LowIndexModel):
   """Represents a barrier.
 
   Key name is the purpose of the barrier (START or FINALIZE). Parent entity
   is the _PipelineRecord the barrier should trigger when all of its
   blocking_slots are filled.
 
+  After() gates are barriers whose key name is 'gate-<gate slot id>' and whose
+  parent is the generator pipeline that yielded the gated children. Instead of
+  running a pipeline they fill their gate_slot when they fire, which in turn
+  releases every child blocked on that slot.
+
   Properties:
     root_pipeline: The root of the workflow.
     target: The pipeline to run when the barrier fires.
     blocking_slots: The slots that must be filled before this barrier fires.
     trigger_time: When this barrier fired.
     status: The current status of the barrier.
+    gate_slot: For After() gates, the slot to fill when the barrier fires.
   """
 
   # Barrier statuses
@@ -190,6 +550,7 @@ class _BarrierRecord(ndb.Model):
   START = 'start'
   FINALIZE = 'finalize'
   ABORT = 'abort'
+  GATE = 'gate'
 
   root_pipeline = ndb.KeyProperty(kind=_PipelineRecord)
   target = ndb.KeyProperty(kind=_PipelineRecord)
@@ -197,13 +558,17 @@ class _BarrierRecord(ndb.Model):
   trigger_time = ndb.DateTimeProperty(indexed=False)
   status = ndb.StringProperty(choices=(FIRED, WAITING), default=WAITING,
                              indexed=False)
+  gate_slot = ndb.KeyProperty(kind=_SlotRecord, indexed=False)
+
+  # blocking_slots stays indexed for notifications without _BarrierIndexes.
+  LOW_INDEX_PROPERTIES = ('root_pipeline', 'target')
 
   @classmethod
   def _get_kind(cls):
     return '_AE_Pipeline_Barrier'
 
 
-class _BarrierIndex(ndb.Model):
+class _BarrierIndex(_LowIndexModel):
   """Indicates a _BarrierRecord that is dependent on a slot.
 
   Previously, when a _SlotRecord was filled, notify_barriers() would query for
@@ -270,7 +635,7 @@ class _BarrierIndex(ndb.Model):
     return ndb.Key(*barrier_record_path)
 
 
-class _StatusRecord(ndb.Model):
+class _StatusRecord(_LowIndexModel):
   """Represents the current status of a pipeline.
 
   Properties:
@@ -291,3 +656,38 @@ class _StatusRecord(ndb.Model):
   @classmethod
   def _get_kind(cls):
     return '_AE_Pipeline_Status'
+
+
+class _ManifestRecord(ndb.Model):
+  """Lists the keys of entities created for a root pipeline.
+
+  A manifest page is written in the same batch as the entities it lists, so
+  all the entities of a root pipeline can be found with a fully consistent
+  ancestor query for its pages, instead of eventually consistent queries on
+  the root_pipeline property of each kind. _StatusRecords are not listed;
+  their keys follow from the keys of the _PipelineRecords.
+
+  The key path for _ManifestRecords is:
+
+    _PipelineRecord<root_pipeline_id>/_ManifestRecord<page_id>
+
+  The page written along with the root pipeline has the key name ROOT_PAGE;
+  other pages have randomly assigned UUIDs. Root pipelines started before
+  manifests were written have no ROOT_PAGE.
+
+  Properties:
+    entity_keys: The keys of the entities written along with this page.
+  """
+
+  ROOT_PAGE = 'root'
+
+  entity_keys = ndb.KeyProperty(repeated=True, indexed=False)
+
+  @classmethod
+  def _get_kind(cls):
+    return '_AE_Pipeline_Manifest'
+
+  @classmethod
+  def root_page_key(cls, root_pipeline_key):
+    """Returns the db.Key of the ROOT_PAGE of a root pipeline's manifest."""
+    return ndb.Key(cls, cls.ROOT_PAGE, parent=root_pipeline_key)
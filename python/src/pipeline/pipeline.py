@@ -23,10 +23,13 @@ __all__ = [
     'UnexpectedPipelineError', 'PipelineStatusError', 'Slot', 'Pipeline',
     'PipelineFuture', 'After', 'InOrder', 'Retry', 'Abort', 'get_status_tree',
     'get_pipeline_names', 'get_root_list', 'create_handlers_map',
-    'set_enforce_auth',
+    'set_enforce_auth', 'set_default_codec', 'BlobRef', 'get_datastore_stats',
+    'reset_datastore_stats', 'UUID_IDS', 'COMPACT_IDS',
 ]
 
+import base64
 import calendar
+import contextlib
 import datetime
 import hashlib
 import itertools
@@ -37,6 +40,7 @@ import pprint
 import re
 import sys
 import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
@@ -44,7 +48,7 @@ import uuid
 
 from flask import abort, make_response, request
 from flask.views import MethodView
-from google.appengine.api import taskqueue, users
+from google.appengine.api import memcache, taskqueue, users
 from google.appengine.ext import ndb
 from google.appengine.datastore.datastore_rpc import TransactionOptions
 
@@ -52,7 +56,9 @@ from google.appengine.datastore.datastore_rpc import TransactionOptions
 # Relative imports
 from . import models, status_ui
 from . import util as mr_util
-from .storage import write_json_gcs
+from .storage import (delete_blobs_gcs, read_blob_gcs, read_blobs_gcs,
+                      wait_for_writes, write_json_gcs, write_json_gcs_async,
+                      write_stream_gcs)
 
 # pylint: disable=g-bad-name
 # pylint: disable=protected-access
@@ -60,9 +66,12 @@ from .storage import write_json_gcs
 # For convenience
 _BarrierIndex = models._BarrierIndex
 _BarrierRecord = models._BarrierRecord
+_ManifestRecord = models._ManifestRecord
 _PipelineRecord = models._PipelineRecord
 _SlotRecord = models._SlotRecord
 _StatusRecord = models._StatusRecord
+_decode_key = models._decode_key
+_encode_key = models._encode_key
 
 
 # Overall TODOs:
@@ -142,19 +151,432 @@ _DEFAULT_BACKOFF_FACTOR = 2
 
 _DEFAULT_MAX_ATTEMPTS = 3
 
+# Values of Pipeline.id_allocation. UUID_IDS gives every new pipeline and slot
+# a 32-character uuid4 hex ID. COMPACT_IDS gives them 20-character random
+# URL-safe IDs with as many random bits, allocated in one batch per fan-out.
+UUID_IDS = 'uuid'
+COMPACT_IDS = 'compact'
+
+# The id_allocation of new root pipelines; children use their root's.
+_DEFAULT_ID_ALLOCATION = UUID_IDS
+
 _RETRY_WIGGLE_TIMEDELTA = datetime.timedelta(seconds=20)
 
 _DEBUG = False
 
 _MAX_JSON_SIZE = 900000
 
+# Encoded params and slot values bigger than this are compressed before
+# deciding whether they fit in the entity. None disables compression. Older
+# instances cannot read compressed records, so only set it (e.g. to 16384) once
+# every instance serving tasks can.
+_COMPRESS_MIN_SIZE = None
+
+# When params do not fit in their entity, the argument values whose encoding is
+# still bigger than this after compression are written to Cloud Storage on
+# their own and referenced from the params, instead of writing all of the
+# params there. None keeps every argument inline. Older instances reject these
+# arguments, so only set it (e.g. to 65536) once every instance serving tasks
+# can read them.
+_MAX_INLINE_ARG_SIZE = None
+
+# Slot values that are lists or dictionaries with a JSON encoding bigger than
+# this are encoded and uploaded to Cloud Storage item by item, instead of
+# being encoded in memory as a whole. None disables streaming.
+_STREAM_MIN_SIZE = 16 * 1024 * 1024
+
+# Filled input values are sent along with the task that starts a pipeline, so
+# that it does not read them again, as long as the form-encoded inputs task
+# parameter stays within this many bytes. It is capped at half of the task size
+# limit, leaving room for the other parameters and headers. None disables
+# inline inputs.
+_MAX_INLINE_INPUTS_SIZE = 16 * 1024
+
+_DEFAULT_CODEC = mr_util.JSON_CODEC
+
 _ENFORCE_AUTH = True
 
 _MAX_CALLBACK_TASK_RETRIES = 5
 
+# A _ManifestRecord page lists at most this many entity keys; bigger batches of
+# entities are listed in several pages.
+_MAX_MANIFEST_KEYS = 500
+
+# The status tree of a root pipeline shows at most this many entities of each
+# kind.
+_MAX_STATUS_TREE_ENTITIES = 1000
+
+# Manifest pages are read this many at a time when building a status tree.
+_STATUS_TREE_MANIFEST_PAGES = 10
+
+# Cleanup deletes at most this many Cloud Storage blobs at a time. None deletes
+# them all at once.
+_MAX_CLEANUP_BLOBS = 1000
+
+# Cleanup fetches and deletes the keys of this many entities at a time, with
+# up to _CLEANUP_PARALLEL_BATCHES of these deletes in flight.
+_CLEANUP_BATCH_SIZE = 500
+
+_CLEANUP_PARALLEL_BATCHES = 4
+
+# A cleanup task stops starting new batches after this many seconds, and
+# continues in a new task.
+_CLEANUP_TIME_BUDGET_SECONDS = 300
+
+# When True, cleanup runs a separate chain of tasks for each entity kind and
+# for the Cloud Storage blobs, instead of a single one.
+_CLEANUP_SHARD_BY_KIND = False
+
+# The steps of cleanup in order: deleting the entities of each kind, then the
+# entities listed in the manifest along with the manifest itself, then the
+# blobs. Root pipelines with a complete manifest (see _has_complete_manifest)
+# skip the kind steps.
+_CLEANUP_KINDS = dict(
+    (model_class._get_kind(), model_class)
+    for model_class in (_PipelineRecord, _SlotRecord, _BarrierRecord,
+                        _StatusRecord, _BarrierIndex))
+
+_CLEANUP_MANIFEST_STEP = 'manifest'
+
+_CLEANUP_BLOBS_STEP = 'blobs'
+
+_CLEANUP_STEPS = list(_CLEANUP_KINDS) + [
+    _CLEANUP_MANIFEST_STEP, _CLEANUP_BLOBS_STEP]
+
+# evaluate reuses the abort_requested flag read from a root pipeline for this
+# many seconds, instead of reading the root for every child. Aborts still
+# reach every child through the abort fan-out, but until the flag expires
+# other instances keep running children of a root that was aborted or
+# deleted. None, the default, always reads the root; set it (e.g. 5) to
+# trade that delay for fewer reads of the root.
+_ABORT_SIGNAL_TTL_SECONDS = None
+
+# When True, the abort_requested flags are also shared between instances
+# through memcache.
+_ABORT_SIGNAL_MEMCACHE = False
+
+# Expired abort_requested flags are dropped once more than this many root
+# pipelines are cached.
+_MAX_ABORT_SIGNALS = 10000
+
+# When True, the Datastore transactions, gets, puts and queries made while
+# starting a pipeline or handling its tasks are counted for that pipeline.
+# See get_datastore_stats().
+_RECORD_DATASTORE_OPS = False
+
+# Most entity groups a cross-group transaction may touch. A pipeline is only
+# completed in the transaction filling its last output when its record and all
+# of its output slots fit in one.
+_MAX_XG_ENTITY_GROUPS = 25
+
+################################################################################
+
+# Maps root pipeline IDs to (expiry time, abort_requested) tuples.
+_abort_signals = {}
+_abort_signals_lock = threading.Lock()
+
+
+def _abort_signal_memcache_key(root_pipeline_id):
+  return 'pipeline-abort-signal:%s' % root_pipeline_id
+
+
+def _get_abort_signal(root_pipeline_key):
+  """Returns the cached abort_requested flag of a root pipeline.
+
+  Args:
+    root_pipeline_key: db.Key of the root pipeline.
+
+  Returns:
+    The flag, or None if it is not cached or has expired.
+  """
+  if _ABORT_SIGNAL_TTL_SECONDS is None:
+    return None
+  root_pipeline_id = root_pipeline_key.string_id()
+  with _abort_signals_lock:
+    entry = _abort_signals.get(root_pipeline_id)
+  if entry is not None and entry[0] > time.time():
+    return entry[1]
+  if _ABORT_SIGNAL_MEMCACHE:
+    abort_requested = memcache.get(
+        _abort_signal_memcache_key(root_pipeline_id))
+    if abort_requested is not None:
+      _set_abort_signal(root_pipeline_key, abort_requested, shared=False)
+      return abort_requested
+  return None
+
+
+def _set_abort_signal(root_pipeline_key, abort_requested, shared=True):
+  """Caches the abort_requested flag of a root pipeline.
+
+  The flag only ever goes from False to True, so a cached True is never
+  replaced by a False read earlier.
+
+  Args:
+    root_pipeline_key: db.Key of the root pipeline.
+    abort_requested: The flag as read from or written to the root pipeline.
+    shared: When True, the flag is also written to memcache if enabled.
+  """
+  if _ABORT_SIGNAL_TTL_SECONDS is None:
+    return
+  root_pipeline_id = root_pipeline_key.string_id()
+  now = time.time()
+  with _abort_signals_lock:
+    entry = _abort_signals.get(root_pipeline_id)
+    if abort_requested or entry is None or not entry[1]:
+      _abort_signals[root_pipeline_id] = (
+          now + _ABORT_SIGNAL_TTL_SECONDS, abort_requested)
+    if len(_abort_signals) > _MAX_ABORT_SIGNALS:
+      for expired_id in [root_id for root_id, (expiry, _) in
+                         _abort_signals.items() if expiry <= now]:
+        del _abort_signals[expired_id]
+  if shared and _ABORT_SIGNAL_MEMCACHE:
+    memcache_key = _abort_signal_memcache_key(root_pipeline_id)
+    if abort_requested:
+      memcache.set(memcache_key, True, time=_ABORT_SIGNAL_TTL_SECONDS)
+    else:
+      memcache.add(memcache_key, False, time=_ABORT_SIGNAL_TTL_SECONDS)
+
+
+def _forget_abort_signal(root_pipeline_key):
+  """Drops the cached abort_requested flag of a root pipeline.
+
+  Called when the root is about to be deleted, so evaluate reads the root
+  again and gives up once it is missing. Other instances may still use
+  their own copy of the flag for up to _ABORT_SIGNAL_TTL_SECONDS.
+
+  Args:
+    root_pipeline_key: db.Key of the root pipeline.
+  """
+  root_pipeline_id = root_pipeline_key.string_id()
+  with _abort_signals_lock:
+    _abort_signals.pop(root_pipeline_id, None)
+  if _ABORT_SIGNAL_MEMCACHE:
+    memcache.delete(_abort_signal_memcache_key(root_pipeline_id))
+
+
+_DATASTORE_OP_NAMES = ('transactions', 'gets', 'puts', 'queries')
+
+_datastore_ops = {}
+_datastore_ops_lock = threading.Lock()
+_datastore_ops_local = threading.local()
+# The API proxy _count_datastore_op was registered with. Testbeds replace the
+# proxy, so the hook is registered again for each new one.
+_datastore_ops_proxy = None
+
+
+def _count_datastore_op(service, call, request, response):
+  """API proxy hook counting Datastore calls for the current pipeline."""
+  pipeline_id = getattr(_datastore_ops_local, 'pipeline_id', None)
+  if pipeline_id is None:
+    return
+  if call == 'BeginTransaction':
+    name, count = 'transactions', 1
+  elif call == 'Get':
+    name, count = 'gets', len(request.key)
+  elif call == 'Put':
+    name, count = 'puts', len(request.entity)
+  elif call == 'RunQuery':
+    name, count = 'queries', 1
+  else:
+    return
+  with _datastore_ops_lock:
+    counters = _datastore_ops.setdefault(
+        pipeline_id, dict.fromkeys(_DATASTORE_OP_NAMES, 0))
+    counters[name] += count
+
+
+def _install_datastore_ops_hook():
+  """Registers _count_datastore_op once with the current API proxy."""
+  global _datastore_ops_proxy
+  from google.appengine.api import apiproxy_stub_map
+  with _datastore_ops_lock:
+    proxy = apiproxy_stub_map.apiproxy
+    if proxy is not _datastore_ops_proxy:
+      proxy.GetPreCallHooks().Append(
+          'pipeline_datastore_ops', _count_datastore_op, 'datastore_v3')
+      _datastore_ops_proxy = proxy
+
+
+@contextlib.contextmanager
+def _recording_datastore_ops(pipeline_id):
+  """Counts the Datastore calls made in the block for the given pipeline.
+
+  Does nothing unless _RECORD_DATASTORE_OPS is True.
+
+  Args:
+    pipeline_id: ID of the pipeline to count the calls for, or None.
+  """
+  if not _RECORD_DATASTORE_OPS or pipeline_id is None:
+    yield
+    return
+  _install_datastore_ops_hook()
+  previous_id = getattr(_datastore_ops_local, 'pipeline_id', None)
+  _datastore_ops_local.pipeline_id = pipeline_id
+  try:
+    yield
+  finally:
+    _datastore_ops_local.pipeline_id = previous_id
+
+
+def _recording_task_datastore_ops():
+  """Counts the Datastore calls of the current task request.
+
+  The calls are counted for the pipeline named by the task's headers or
+  parameters: the pipeline being run or finalized, the one that filled the
+  slot being notified, or the parent being fanned out.
+  """
+  pipeline_id = None
+  if _RECORD_DATASTORE_OPS:
+    pipeline_id = request.values.get('pipeline_id')
+    for value in (request.headers.get('X-Ae-Pipeline-Key'),
+                  request.headers.get('X-Ae-Filler-Pipeline-Key'),
+                  request.values.get('parent_key')):
+      if value:
+        pipeline_id = _decode_key(_PipelineRecord, value).string_id()
+        break
+  return _recording_datastore_ops(pipeline_id)
+
+
+def get_datastore_stats(pipeline_id=None):
+  """Returns the Datastore operation counters recorded in this process.
+
+  Counters are only recorded while _RECORD_DATASTORE_OPS is True.
+
+  Args:
+    pipeline_id: ID of a pipeline to return the counters of. When None, the
+      counters of all pipelines are returned.
+
+  Returns:
+    Dictionary with the number of transactions, gets, puts and queries made
+    for the pipeline, counting each key read and entity written. When
+    pipeline_id is None, a dictionary mapping pipeline IDs to these.
+  """
+  with _datastore_ops_lock:
+    if pipeline_id is not None:
+      return dict(_datastore_ops.get(
+          pipeline_id, dict.fromkeys(_DATASTORE_OP_NAMES, 0)))
+    return dict((pipeline_id, dict(counters))
+                for pipeline_id, counters in _datastore_ops.items())
+
+
+def reset_datastore_stats():
+  """Discards the Datastore operation counters recorded in this process."""
+  with _datastore_ops_lock:
+    _datastore_ops.clear()
+
+# The key of the root of the pipeline being evaluated by this thread; see
+# _running_under_root().
+_current_root_local = threading.local()
+
+
+@contextlib.contextmanager
+def _running_under_root(root_pipeline_key):
+  """Makes the given root pipeline the current one within the block.
+
+  Args:
+    root_pipeline_key: db.Key of the root pipeline, or None.
+  """
+  previous_key = getattr(_current_root_local, 'key', None)
+  _current_root_local.key = root_pipeline_key
+  try:
+    yield
+  finally:
+    _current_root_local.key = previous_key
+
 ################################################################################
 
 
+class BlobRef(object):
+  """A reference to a value stored in its own Cloud Storage blob.
+
+  BlobRefs may be passed as pipeline arguments and outputs like any other
+  value. Only the reference is serialized, so passing one along costs the
+  same however big the value is; the value is only downloaded when open() is
+  called.
+
+  The blob belongs to a root pipeline and is deleted when that root pipeline
+  is cleaned up, after which the reference dangles. References must not be
+  kept beyond the lifetime of their root pipeline.
+  """
+
+  def __init__(self, blob_name, codec=None, size=None):
+    """Initializer.
+
+    Args:
+      blob_name: The name of the blob in the default bucket.
+      codec: The ID of the codec the value was encoded with; None for JSON.
+      size: The size of the blob in bytes, if known.
+    """
+    self.blob_name = blob_name
+    self.codec = codec
+    self.size = size
+
+  @classmethod
+  def create(cls, value, pipeline_id=None):
+    """Writes a value to a blob and returns a reference to it.
+
+    Args:
+      value: The serializable value to store.
+      pipeline_id: The root pipeline ID the blob belongs to; it is deleted
+        when that root pipeline is cleaned up. Defaults to the root of the
+        pipeline being run, finalized or called back.
+
+    Returns:
+      A new BlobRef.
+
+    Raises:
+      PipelineSetupError if no pipeline_id is passed outside of a pipeline.
+    """
+    if pipeline_id is None:
+      root_pipeline_key = getattr(_current_root_local, 'key', None)
+      if _TEST_MODE:
+        root_pipeline_key = _TEST_ROOT_PIPELINE_KEY
+      if root_pipeline_key is None:
+        raise PipelineSetupError(
+            'BlobRef.create() needs a pipeline_id outside of a pipeline.')
+      pipeline_id = root_pipeline_key.string_id()
+    encoded = mr_util.encode_value(value, _DEFAULT_CODEC)
+    if _COMPRESS_MIN_SIZE is not None and len(encoded) > _COMPRESS_MIN_SIZE:
+      encoded = mr_util.compress_encoded(encoded)
+    codec = None
+    if _DEFAULT_CODEC != mr_util.JSON_CODEC:
+      codec = _DEFAULT_CODEC
+    return cls(write_json_gcs(encoded, pipeline_id), codec, len(encoded))
+
+  def open(self):
+    """Downloads and decodes the referenced value.
+
+    Returns:
+      The value that was stored in the blob.
+    """
+    return models._decode_payload(None, None, self.blob_name, self.codec)
+
+  def _to_json(self):
+    return {'blob_name': self.blob_name, 'codec': self.codec,
+            'size': self.size}
+
+  @classmethod
+  def _from_json(cls, d):
+    return cls(d['blob_name'], d.get('codec'), d.get('size'))
+
+  def __eq__(self, other):
+    return (isinstance(other, BlobRef) and
+            (self.blob_name, self.codec) == (other.blob_name, other.codec))
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.blob_name)
+
+  def __repr__(self):
+    return 'BlobRef(%r, size=%r)' % (self.blob_name, self.size)
+
+
+mr_util._register_json_primitive(
+    BlobRef, BlobRef._to_json, BlobRef._from_json)
+
+
 class Slot(object):
   """An output that is filled by a Pipeline as it executes."""
 
@@ -184,6 +606,10 @@ class Slot(object):
     self._filler_pipeline_key = None
     self._fill_datetime = None
     self._value = None
+    # The _SlotRecord whose value is decoded when first read, and the slots
+    # resolved along with this one.
+    self._slot_record = None
+    self._lazy_slots = None
 
   @property
   def value(self):
@@ -198,6 +624,8 @@ class Slot(object):
     if not self.filled:
       raise SlotNotFilledError('Slot with name "%s", key "%s" not yet filled.'
                                % (self.name, self.key))
+    if self._slot_record is not None:
+      self._decode_value()
     return self._value
 
   @property
@@ -230,19 +658,33 @@ class Slot(object):
                                % (self.name, self.key))
     return self._fill_datetime
 
-  def _set_value(self, slot_record):
+  def _set_value(self, slot_record, lazy_slots=None):
     """Sets the value of this slot based on its corresponding _SlotRecord.
 
-    Does nothing if the slot has not yet been filled.
+    Does nothing if the slot has not yet been filled. The value is only
+    decoded, and downloaded if it is in Cloud Storage, when first read.
 
     Args:
       slot_record: The _SlotRecord containing this Slot's value.
+      lazy_slots: The slots set along with this one. The values of those that
+        were touched are downloaded in the same batch as this one's.
     """
     if slot_record.status == _SlotRecord.FILLED:
       self.filled = True
       self._filler_pipeline_key = slot_record.filler
       self._fill_datetime = slot_record.fill_time
-      self._value = slot_record.value
+      self._slot_record = slot_record
+      self._lazy_slots = lazy_slots
+
+  def _decode_value(self):
+    """Decodes the value of this slot and prefetches touched lazy slots."""
+    _prefetch_slot_values([self._slot_record] + [
+        slot._slot_record for slot in self._lazy_slots or ()
+        if slot is not self and slot._touched and
+        slot._slot_record is not None])
+    self._value = self._slot_record.value
+    self._slot_record = None
+    self._lazy_slots = None
 
   def _set_value_test(self, filler_pipeline_key, value):
     """Sets the value of this slot for use in testing.
@@ -255,14 +697,14 @@ class Slot(object):
     self.filled = True
     self._filler_pipeline_key = filler_pipeline_key
     self._fill_datetime = datetime.datetime.utcnow()
-    # Convert to JSON and back again, to simulate the behavior of production.
-    self._value = json.loads(json.dumps(
-        value, cls=mr_util.JsonEncoder), cls=mr_util.JsonDecoder)
+    # Encode and decode again, to simulate the behavior of production.
+    self._value = mr_util.decode_value(
+        mr_util.encode_value(value, _DEFAULT_CODEC), _DEFAULT_CODEC)
 
   def __repr__(self):
     """Returns a string representation of this slot."""
     if self.filled:
-      return repr(self._value)
+      return repr(self.value)
     else:
       return 'Slot(name="%s", slot_key="%s")' % (self.name, self.key)
 
@@ -308,7 +750,7 @@ class PipelineFuture(object):
         of any exiting output slots to be inherited by this future.
       resolve_outputs: When True, this method will dereference all output slots
         before returning back to the caller, making those output slots' values
-        available.
+        available. The values are decoded when first read.
 
     Raises:
       UnexpectedPipelineError when resolve_outputs is True and any of the output
@@ -316,7 +758,7 @@ class PipelineFuture(object):
     """
     for name, slot_key in list(already_defined.items()):
       if not isinstance(slot_key, ndb.Key):
-        slot_key = ndb.Key(urlsafe=slot_key)
+        slot_key = _decode_key(_SlotRecord, slot_key)
 
       slot = self._output_dict.get(name)
       if slot is None:
@@ -332,7 +774,8 @@ class PipelineFuture(object):
 
     if resolve_outputs:
       slot_key_dict = {s.key: s for s in self._output_dict.values()}
-      all_slots = ndb.get_multi(slot_key_dict.keys())
+      all_slots = models._cached_get_multi(list(slot_key_dict.keys()))
+      lazy_slots = list(slot_key_dict.values())
       for slot, slot_record in zip(iter(list(slot_key_dict.values())), all_slots):
         if slot_record is None:
           raise UnexpectedPipelineError(
@@ -340,7 +783,7 @@ class PipelineFuture(object):
               'missing its Slot in the datastore: "%s"' %
               (slot.name, pipeline_name, slot.key))
         slot = slot_key_dict[slot_record.key]
-        slot._set_value(slot_record)
+        slot._set_value(slot_record, lazy_slots)
 
   def __getattr__(self, name):
     """Provides an output Slot instance with the given name if allowed."""
@@ -349,6 +792,7 @@ class PipelineFuture(object):
         raise SlotNotDeclaredError('Undeclared output with name "%s"' % name)
       self._output_dict[name] = Slot(name=name)
     slot = self._output_dict[name]
+    slot._touched = True
     return slot
 
 
@@ -399,6 +843,9 @@ class Pipeline(object, metaclass=_PipelineMeta):
       completely and aborting the entire pipeline up to the root.
     target: The application version to use for processing this Pipeline. This
       can be set to the name of a backend to direct Pipelines to run there.
+    id_allocation: How the IDs of this pipeline, its descendants and their
+      slots are generated, UUID_IDS or COMPACT_IDS. Only the value of the root
+      pipeline matters; children inherit it.
 
   Instance properties:
     pipeline_id: The ID of this pipeline.
@@ -415,6 +862,7 @@ class Pipeline(object, metaclass=_PipelineMeta):
 
   # Internal only.
   _class_path = None  # Set for each class
+  _spilled_args = False  # Whether args hold _SpilledArgs; see from_id
 
   # callback_xg_transaction: Determines whether callbacks are processed within
   # a single entity-group transaction (False), a cross-entity-group
@@ -442,6 +890,7 @@ class Pipeline(object, metaclass=_PipelineMeta):
     self.max_attempts = _DEFAULT_MAX_ATTEMPTS
     self.target = None
     self.task_retry = False
+    self.id_allocation = _DEFAULT_ID_ALLOCATION
     self._current_attempt = 0
     self._root_pipeline_key = None
     self._pipeline_key = None
@@ -459,6 +908,44 @@ class Pipeline(object, metaclass=_PipelineMeta):
       self.outputs = PipelineFuture(self.output_names)
       self._context.evaluate_test(self)
 
+  @property
+  def args(self):
+    """Returns the positional arguments of this Pipeline."""
+    if self._spilled_args:
+      self._load_spilled_args()
+    return self._args
+
+  @args.setter
+  def args(self, value):
+    self._args = value
+
+  @property
+  def kwargs(self):
+    """Returns the keyword arguments of this Pipeline."""
+    if self._spilled_args:
+      self._load_spilled_args()
+    return self._kwargs
+
+  @kwargs.setter
+  def kwargs(self, value):
+    self._kwargs = value
+
+  def _load_spilled_args(self):
+    """Downloads the arguments left in Cloud Storage by from_id at once."""
+    spilled = [
+        value.arg
+        for value in itertools.chain(self._args, list(self._kwargs.values()))
+        if isinstance(value, _SpilledArg)]
+    blob_dict = read_blobs_gcs([arg['blob_name'] for arg in spilled])
+    def _load(value):
+      if isinstance(value, _SpilledArg):
+        return _read_spilled_arg(value.arg, blob_dict)
+      return value
+    self._args = tuple(_load(value) for value in self._args)
+    self._kwargs = dict(
+        (name, _load(value)) for name, value in self._kwargs.items())
+    self._spilled_args = False
+
   @property
   def pipeline_id(self):
     """Returns the ID of this Pipeline as a string or None if unknown."""
@@ -553,7 +1040,7 @@ class Pipeline(object, metaclass=_PipelineMeta):
     pipeline_key = ndb.Key(_PipelineRecord, pipeline_id)
 
     if pipeline_record is None:
-      pipeline_record = pipeline_key.get()
+      pipeline_record = models._cached_get(pipeline_key)
     if pipeline_record is None:
       return None
 
@@ -566,8 +1053,12 @@ class Pipeline(object, metaclass=_PipelineMeta):
       pipeline_func_class = cls
 
     params = pipeline_record.params
+    # Spilled arguments are only downloaded on first access when the class
+    # does not look at them in its own __init__.
+    defer_spilled = pipeline_func_class.__init__ is Pipeline.__init__
     arg_list, kwarg_dict = _dereference_args(
-        pipeline_record.class_path, params['args'], params['kwargs'])
+        pipeline_record.class_path, params['args'], params['kwargs'],
+        defer_spilled=defer_spilled)
     outputs = PipelineFuture(pipeline_func_class.output_names)
     outputs._inherit_outputs(
         pipeline_record.class_path,
@@ -575,11 +1066,15 @@ class Pipeline(object, metaclass=_PipelineMeta):
         resolve_outputs=resolve_outputs)
 
     stage = pipeline_func_class(*arg_list, **kwarg_dict)
+    stage._spilled_args = any(
+        isinstance(value, _SpilledArg)
+        for value in itertools.chain(arg_list, list(kwarg_dict.values())))
     stage.backoff_seconds = params['backoff_seconds']
     stage.backoff_factor = params['backoff_factor']
     stage.max_attempts = params['max_attempts']
     stage.task_retry = params['task_retry']
     stage.target = params.get('target')  # May not be defined for old Pipelines
+    stage.id_allocation = params.get('id_allocation', _DEFAULT_ID_ALLOCATION)
     stage._current_attempt = pipeline_record.current_attempt
     stage._set_values_internal(
         _PipelineContext('', params['queue_name'], params['base_path']),
@@ -630,7 +1125,7 @@ class Pipeline(object, metaclass=_PipelineMeta):
       PipelineSetupError if the pipeline could not start for any other reason.
     """
     if not idempotence_key:
-      idempotence_key = uuid.uuid4().hex
+      idempotence_key = _allocate_ids(self.id_allocation, 1)[0]
     elif not isinstance(idempotence_key, str):
       try:
         idempotence_key.decode('utf-8')
@@ -643,8 +1138,9 @@ class Pipeline(object, metaclass=_PipelineMeta):
     try:
       self._set_values_internal(
           context, pipeline_key, pipeline_key, future, _PipelineRecord.WAITING)
-      return context.start(
-          self, return_task=return_task, countdown=countdown, eta=eta)
+      with _recording_datastore_ops(idempotence_key):
+        return context.start(
+            self, return_task=return_task, countdown=countdown, eta=eta)
     except Error:
       # Pass through exceptions that originate in this module.
       raise
@@ -743,7 +1239,8 @@ class Pipeline(object, metaclass=_PipelineMeta):
           'Cannot fill output with name "%s" that was just '
           'declared within the Pipeline context.' % slot.name)
 
-    self._context.fill_slot(self._pipeline_key, slot, value)
+    self._context.fill_slot(self._pipeline_key, slot, value,
+                            root_pipeline_key=self._root_pipeline_key)
 
   def set_status(self, message=None, console_url=None, status_links=None):
     """Sets the current status of this pipeline.
@@ -811,7 +1308,9 @@ class Pipeline(object, metaclass=_PipelineMeta):
       raise UnexpectedPipelineError(
           'May only call complete() method for asynchronous pipelines.')
     self._context.fill_slot(
-        self._pipeline_key, self.outputs.default, default_output)
+        self._pipeline_key, self.outputs.default, default_output,
+        root_pipeline_key=self._root_pipeline_key,
+        complete=self._completes_on_fill())
 
   def get_callback_url(self, **kwargs):
     """Returns a relative URL for invoking this Pipeline's callback method.
@@ -870,9 +1369,9 @@ class Pipeline(object, metaclass=_PipelineMeta):
     if not self.is_root:
       return
     task = taskqueue.Task(
-        params=dict(root_pipeline_key=self._root_pipeline_key.urlsafe().decode()),
+        params=dict(root_pipeline_key=_encode_key(self._root_pipeline_key)),
         url=self.base_path + '/cleanup',
-        headers={'X-Ae-Pipeline-Key': self._root_pipeline_key.urlsafe().decode()})
+        headers={'X-Ae-Pipeline-Key': _encode_key(self._root_pipeline_key)})
     taskqueue.Queue(self.queue_name).add(task)
 
   def with_params(self, **kwargs):
@@ -1009,9 +1508,11 @@ class Pipeline(object, metaclass=_PipelineMeta):
   def _callback_internal(self, kwargs):
     """Used to execute callbacks on asynchronous pipelines."""
     logging.debug('Callback %s(*%s, **%s)#%s with params: %r',
-                  self._class_path, _short_repr(self.args),
-                  _short_repr(self.kwargs), self._pipeline_key.string_id(), kwargs)
-    return self.callback(**kwargs)
+                  self._class_path, _short_repr(self._args),
+                  _short_repr(self._kwargs), self._pipeline_key.string_id(),
+                  kwargs)
+    with _running_under_root(self._root_pipeline_key):
+      return self.callback(**kwargs)
 
   def _run_internal(self,
                     context,
@@ -1027,6 +1528,17 @@ class Pipeline(object, metaclass=_PipelineMeta):
                   _short_repr(self.kwargs), self._pipeline_key.string_id())
     return self.run(*self.args, **self.kwargs)
 
+  def _completes_on_fill(self):
+    """Returns True if filling the outputs can also complete this Pipeline.
+
+    This is the case when finalization does nothing, so the Pipeline may be
+    marked as done in the transaction that fills its last output instead of
+    in a separate finalization task.
+    """
+    pipeline_class = type(self)
+    return (pipeline_class.finalized is Pipeline.finalized and
+            pipeline_class._finalized_internal is Pipeline._finalized_internal)
+
   def _finalized_internal(self,
                           context,
                           pipeline_key,
@@ -1041,8 +1553,8 @@ class Pipeline(object, metaclass=_PipelineMeta):
     self._set_values_internal(
         context, pipeline_key, root_pipeline_key, caller_output, result_status)
     logging.debug('Finalizing %s(*%r, **%r)#%s',
-                  self._class_path, _short_repr(self.args),
-                  _short_repr(self.kwargs), self._pipeline_key.string_id())
+                  self._class_path, _short_repr(self._args),
+                  _short_repr(self._kwargs), self._pipeline_key.string_id())
     try:
       self.finalized()
     except NotImplementedError:
@@ -1051,7 +1563,7 @@ class Pipeline(object, metaclass=_PipelineMeta):
   def __repr__(self):
     """Returns a string representation of this Pipeline."""
     return '%s(*%s, **%s)' % (
-        self._class_path, _short_repr(self.args), _short_repr(self.kwargs))
+        self._class_path, _short_repr(self._args), _short_repr(self._kwargs))
 
 
 # TODO: Change InOrder and After to use a common thread-local list of
@@ -1155,17 +1667,67 @@ def _short_repr(obj):
     return '%s... (%d bytes)' % (stringified[:200], len(stringified))
   return stringified
 
-def _dereference_args(pipeline_name, args, kwargs):
+def _allocate_ids(id_allocation, count):
+  """Generates the IDs of new pipelines or slots.
+
+  Args:
+    id_allocation: UUID_IDS or COMPACT_IDS.
+    count: How many IDs to generate.
+
+  Returns:
+    List of count new string IDs.
+
+  Raises:
+    PipelineSetupError if id_allocation is not known.
+  """
+  if id_allocation == COMPACT_IDS:
+    # 15 random bytes encode to exactly 20 characters, so the whole batch is
+    # drawn and encoded at once and then split.
+    encoded = base64.urlsafe_b64encode(os.urandom(15 * count)).decode()
+    ids = [encoded[index:index + 20] for index in range(0, len(encoded), 20)]
+    for index, new_id in enumerate(ids):
+      # Names matching __*__ are reserved by the Datastore.
+      while new_id.startswith('__') and new_id.endswith('__'):
+        new_id = base64.urlsafe_b64encode(os.urandom(15)).decode()
+      ids[index] = new_id
+    return ids
+  if id_allocation == UUID_IDS:
+    return [uuid.uuid4().hex for _ in range(count)]
+  raise PipelineSetupError('Unknown id_allocation %r' % (id_allocation,))
+
+
+class _SpilledArg(object):
+  """Stands for an argument value that is still in Cloud Storage.
+
+  Pipeline.from_id() leaves these in the arguments of the Pipeline it
+  returns, unless its class overrides __init__; they are all downloaded
+  together the first time the arguments are accessed. See
+  Pipeline._load_spilled_args.
+  """
+
+  __slots__ = ('arg',)
+
+  def __init__(self, arg):
+    self.arg = arg
+
+  def __repr__(self):
+    return '<spilled %s>' % self.arg['blob_name']
+
+
+def _dereference_args(pipeline_name, args, kwargs, defer_spilled=False):
   """Dereference a Pipeline's arguments that are slots, validating them.
 
   Each argument value passed in is assumed to be a dictionary with the format:
     {'type': 'value', 'value': 'serializable'}  # A resolved value.
     {'type': 'slot', 'slot_key': 'str() on a db.Key'}  # A pending Slot.
+    {'type': 'gcs', 'blob_name': 'name', 'codec': 'id'}  # A spilled value.
 
   Args:
     pipeline_name: The name of the pipeline class; used for debugging.
     args: Iterable of positional arguments.
     kwargs: Dictionary of keyword arguments.
+    defer_spilled: When True, values spilled to Cloud Storage are not
+      downloaded but returned as _SpilledArg instances instead.
 
   Returns:
     Tuple (args, kwargs) where:
@@ -1178,40 +1740,329 @@ def _dereference_args(pipeline_name, args, kwargs):
     UnexpectedPipelineError if an unknown parameter type was passed.
   """
   lookup_slots = set()
+  spilled_args = []
   for arg in itertools.chain(args, iter(list(kwargs.values()))):
     if arg['type'] == 'slot':
-      lookup_slots.add(ndb.Key(urlsafe=arg['slot_key']))
+      lookup_slots.add(_decode_key(_SlotRecord, arg['slot_key']))
+    elif arg['type'] == 'gcs' and not defer_spilled:
+      spilled_args.append(arg)
 
-  slot_dict = {}
-  for key, slot_record in zip(lookup_slots, ndb.get_multi(lookup_slots)):
+  lookup_slots = list(lookup_slots)
+  slot_records = models._cached_get_multi(lookup_slots)
+  for key, slot_record in zip(lookup_slots, slot_records):
     if slot_record is None or slot_record.status != _SlotRecord.FILLED:
       raise SlotNotFilledError(
           'Slot "%s" missing its value. From %s(*args=%s, **kwargs=%s)' %
           (key, pipeline_name, _short_repr(args), _short_repr(kwargs)))
+
+  # Download all the values spilled to Cloud Storage at once.
+  blob_dict = _prefetch_slot_values(
+      slot_records, [arg['blob_name'] for arg in spilled_args])
+
+  slot_dict = {}
+  for key, slot_record in zip(lookup_slots, slot_records):
     slot_dict[key] = slot_record.value
 
   arg_list = []
   for current_arg in args:
     if current_arg['type'] == 'slot':
-      arg_list.append(slot_dict[ndb.Key(urlsafe=current_arg['slot_key'])])
+      arg_list.append(slot_dict[_decode_key(_SlotRecord, current_arg['slot_key'])])
     elif current_arg['type'] == 'value':
       arg_list.append(current_arg['value'])
+    elif current_arg['type'] == 'gcs':
+      if defer_spilled:
+        arg_list.append(_SpilledArg(current_arg))
+      else:
+        arg_list.append(_read_spilled_arg(current_arg, blob_dict))
     else:
       raise UnexpectedPipelineError('Unknown parameter type: %r' % current_arg)
 
   kwarg_dict = {}
   for key, current_arg in list(kwargs.items()):
     if current_arg['type'] == 'slot':
-      kwarg_dict[key] = slot_dict[ndb.Key(urlsafe=current_arg['slot_key'])]
+      kwarg_dict[key] = slot_dict[_decode_key(_SlotRecord, current_arg['slot_key'])]
     elif current_arg['type'] == 'value':
       kwarg_dict[key] = current_arg['value']
+    elif current_arg['type'] == 'gcs':
+      if defer_spilled:
+        kwarg_dict[key] = _SpilledArg(current_arg)
+      else:
+        kwarg_dict[key] = _read_spilled_arg(current_arg, blob_dict)
     else:
       raise UnexpectedPipelineError('Unknown parameter type: %r' % current_arg)
 
   return (arg_list, kwarg_dict)
 
 
-def _generate_args(pipeline, future, queue_name, base_path):
+def _write_blob(encoded, pipeline_id, pending_writes=None):
+  """Writes an encoded value to Cloud Storage.
+
+  Args:
+    encoded: The encoded value.
+    pipeline_id: The root pipeline ID used to segment blobs in Cloud Storage.
+    pending_writes: Optional list. When present the write is only started and
+      its future appended to the list; the caller must wait for it with
+      wait_for_writes() before storing any entity referencing the blob.
+
+  Returns:
+    The name of the blob.
+  """
+  if pending_writes is None:
+    return write_json_gcs(encoded, pipeline_id)
+  blob_name, future = write_json_gcs_async(encoded, pipeline_id)
+  pending_writes.append(future)
+  return blob_name
+
+
+def _compress_encoding(encoded):
+  """Compresses an encoding bigger than _COMPRESS_MIN_SIZE, if enabled."""
+  if _COMPRESS_MIN_SIZE is not None and len(encoded) > _COMPRESS_MIN_SIZE:
+    return mr_util.compress_encoded(encoded)
+  return encoded
+
+
+def _encode_record_value(value, property_prefix, pipeline_id,
+                         pending_writes=None, stream=False, encoded=None):
+  """Encodes a params or slot value for storage on its entity.
+
+  The value is encoded with the default codec and compressed when it is
+  bigger than _COMPRESS_MIN_SIZE. Encodings that are still too big to fit in
+  the entity are written to Cloud Storage instead.
+
+  When stream is True and the default codec is JSON, lists and dictionaries
+  whose encoding is bigger than _STREAM_MIN_SIZE are encoded again item by
+  item and streamed to Cloud Storage with the JSON stream codec instead, so
+  that neither the uploaded data nor its compressed form is held in memory
+  as a whole. Smaller values keep the plain JSON encoding.
+
+  Args:
+    value: The serializable value to encode.
+    property_prefix: The prefix of the entity properties that hold the value,
+      'params' for _PipelineRecords or 'value' for _SlotRecords.
+    pipeline_id: The root pipeline ID used to segment blobs in Cloud Storage.
+    pending_writes: Optional list of pending blob writes; see _write_blob.
+    stream: Whether big values may be streamed to Cloud Storage.
+    encoded: Optional encoding of the value with the default codec, already
+      passed through _compress_encoding, when the caller has it.
+
+  Returns:
+    Dictionary mapping each of the <prefix>_text, <prefix>_blob, <prefix>_gcs
+    and <prefix>_codec property names to its new value, suitable for passing
+    to the entity's constructor or populate().
+  """
+  if (encoded is None and stream and _STREAM_MIN_SIZE is not None and
+      _DEFAULT_CODEC == mr_util.JSON_CODEC and
+      type(value) in (list, tuple, dict)):
+    encoded = mr_util.encode_value(value, _DEFAULT_CODEC)
+    if len(encoded) > _STREAM_MIN_SIZE:
+      del encoded
+      chunks = mr_util.iter_encode_json_stream(value)
+      if _COMPRESS_MIN_SIZE is not None:
+        chunks = mr_util.compress_chunks(chunks)
+      else:
+        chunks = (chunk.encode('utf-8') for chunk in chunks)
+      return {
+          property_prefix + '_text': None,
+          property_prefix + '_blob': None,
+          property_prefix + '_gcs': write_stream_gcs(chunks, pipeline_id),
+          property_prefix + '_codec': mr_util.JSON_STREAM_CODEC,
+      }
+    encoded = _compress_encoding(encoded)
+
+  if encoded is None:
+    encoded = _compress_encoding(
+        mr_util.encode_value(value, _DEFAULT_CODEC))
+  text = None
+  blob = None
+  gcs = None
+  if len(encoded) > _MAX_JSON_SIZE:
+    gcs = _write_blob(encoded, pipeline_id, pending_writes)
+  elif isinstance(encoded, bytes):
+    blob = encoded
+  else:
+    text = encoded
+
+  codec = None
+  if _DEFAULT_CODEC != mr_util.JSON_CODEC:
+    codec = _DEFAULT_CODEC
+
+  return {
+      property_prefix + '_text': text,
+      property_prefix + '_blob': blob,
+      property_prefix + '_gcs': gcs,
+      property_prefix + '_codec': codec,
+  }
+
+
+def _encode_arg_value(value, pipeline_id, pending_writes=None):
+  """Encodes a resolved argument value for a pipeline's params.
+
+  Values are kept inline in the params unless their encoding is bigger than
+  _MAX_INLINE_ARG_SIZE, even after compression. Those are written to their
+  own blob in Cloud Storage so that reading the params (for routing, status
+  or barrier notification) does not require downloading them. Since this
+  encodes the value, _generate_args only calls it for the arguments of params
+  that do not fit in their entity.
+
+  Args:
+    value: The serializable argument value.
+    pipeline_id: The root pipeline ID used to segment blobs in Cloud Storage.
+    pending_writes: Optional list of pending blob writes; see _write_blob.
+
+  Returns:
+    The argument dictionary to store in the params; see _dereference_args.
+  """
+  if _MAX_INLINE_ARG_SIZE is None:
+    return {'type': 'value', 'value': value}
+  encoded = mr_util.encode_value(value, _DEFAULT_CODEC)
+  if len(encoded) <= _MAX_INLINE_ARG_SIZE:
+    return {'type': 'value', 'value': value}
+  encoded = _compress_encoding(encoded)
+  if len(encoded) <= _MAX_INLINE_ARG_SIZE:
+    return {'type': 'value', 'value': value}
+
+  codec = None
+  if _DEFAULT_CODEC != mr_util.JSON_CODEC:
+    codec = _DEFAULT_CODEC
+  return {
+      'type': 'gcs',
+      'blob_name': _write_blob(encoded, pipeline_id, pending_writes),
+      'codec': codec,
+      'size': len(encoded),
+  }
+
+
+def _read_spilled_arg(arg, blob_dict=None):
+  """Reads back an argument value written by _encode_arg_value.
+
+  Args:
+    arg: The {'type': 'gcs'} argument dictionary.
+    blob_dict: Optional dictionary of already downloaded blob contents, keyed
+      by blob name.
+
+  Returns:
+    The decoded argument value.
+  """
+  encoded = (blob_dict or {}).get(arg['blob_name'])
+  if encoded is None:
+    encoded = read_blob_gcs(arg['blob_name'])
+  return mr_util.decode_value(
+      mr_util.decompress_encoded(encoded), arg.get('codec'))
+
+
+def _prefetch_slot_values(slot_records, blob_names=()):
+  """Downloads the spilled values of many slots concurrently.
+
+  Decoding a _SlotRecord value stored in Cloud Storage downloads it. This
+  downloads all of those values in parallel first and decodes them, so that
+  reading each slot_record.value afterwards does not block on a download.
+
+  Args:
+    slot_records: Iterable of _SlotRecords, some of which may be None.
+    blob_names: Names of other blobs to download along with the slot values.
+
+  Returns:
+    Dictionary mapping each downloaded blob name to its contents.
+  """
+  pending = [
+      slot_record for slot_record in slot_records
+      if slot_record is not None and slot_record.value_gcs is not None and
+      slot_record.value_codec != mr_util.JSON_STREAM_CODEC and
+      not hasattr(slot_record, '_value_decoded')]
+  all_names = [slot_record.value_gcs for slot_record in pending]
+  all_names.extend(blob_names)
+  if not all_names:
+    return {}
+
+  blob_dict = read_blobs_gcs(all_names)
+  for slot_record in pending:
+    slot_record._value_decoded = models._decode_payload(
+        None, blob_dict[slot_record.value_gcs], None, slot_record.value_codec)
+  return blob_dict
+
+
+def _encode_inline_inputs(pipeline_record, slot_records):
+  """Encodes small filled input slots for the task that starts a pipeline.
+
+  Only values stored inline on their _SlotRecord are sent, while the inputs
+  task parameter, form-encoded with the slot keys, fillers and fill times,
+  stays within _MAX_INLINE_INPUTS_SIZE bytes. The current attempt of the
+  pipeline is sent with them, so that a task that runs after the pipeline has
+  moved on reads its inputs again instead.
+
+  Args:
+    pipeline_record: The _PipelineRecord to start, or None when missing.
+    slot_records: The filled _SlotRecords the pipeline was blocked on.
+
+  Returns:
+    The encoded inputs, or None when there are none to send.
+  """
+  if _MAX_INLINE_INPUTS_SIZE is None or pipeline_record is None:
+    return None
+  budget = min(_MAX_INLINE_INPUTS_SIZE,
+               taskqueue.MAX_PUSH_TASK_SIZE_BYTES // 2)
+  # Form encoding works character by character, so the encoded size of the
+  # JSON document is the sum of the encoded sizes of its pieces.
+  size = len(urllib.parse.urlencode({'inputs': json.dumps(
+      {'attempt': pipeline_record.current_attempt, 'slots': []})}))
+  separator_size = len(urllib.parse.quote_plus(', '))
+  slots = []
+  for slot_record in slot_records:
+    if slot_record.value_text is None:
+      continue
+    slot = [
+        _encode_key(slot_record.key),
+        slot_record.value_codec,
+        slot_record.value_text,
+        slot_record.filler and _encode_key(slot_record.filler),
+        slot_record.fill_time and slot_record.fill_time.isoformat(),
+    ]
+    slot_size = len(urllib.parse.quote_plus(json.dumps(slot)))
+    if slots:
+      slot_size += separator_size
+    if size + slot_size > budget:
+      continue
+    size += slot_size
+    slots.append(slot)
+  if not slots:
+    return None
+  return json.dumps({'attempt': pipeline_record.current_attempt,
+                     'slots': slots})
+
+
+def _prime_inline_inputs(pipeline_record, inputs):
+  """Serves the input slots sent with a start task from the request cache.
+
+  The inputs are ignored unless the pipeline is still waiting to run the
+  attempt they were sent for. They hold the values and fill times the slots
+  had when the barrier fired. A retry of a filler may fill a slot again later;
+  the pipeline then runs with the value it was started for, as it does when
+  its task reads the slot before that retry.
+
+  Args:
+    pipeline_record: The _PipelineRecord about to run.
+    inputs: The inputs encoded by _encode_inline_inputs.
+  """
+  inputs = json.loads(inputs)
+  if (pipeline_record.status != _PipelineRecord.WAITING or
+      pipeline_record.current_attempt != inputs['attempt']):
+    return
+  slot_records = []
+  for slot_key, codec, text, filler, fill_time in inputs['slots']:
+    slot_records.append(_SlotRecord(
+        key=_decode_key(_SlotRecord, slot_key),
+        root_pipeline=pipeline_record.root_pipeline,
+        filler=filler and _decode_key(_PipelineRecord, filler),
+        value_text=text,
+        value_codec=codec,
+        status=_SlotRecord.FILLED,
+        fill_time=fill_time and datetime.datetime.fromisoformat(fill_time)))
+  models._prime_request_cache(slot_records)
+
+
+def _generate_args(pipeline, future, queue_name, base_path,
+                   after_gate_key=None, root_pipeline_key=None,
+                   pending_writes=None):
   """Generate the params used to describe a Pipeline's depedencies.
 
   The arguments passed to this method may be normal values, Slot instances
@@ -1223,21 +2074,30 @@ def _generate_args(pipeline, future, queue_name, base_path):
     future: The PipelineFuture for the Pipeline these arguments correspond to.
     queue_name: The queue to run the pipeline on.
     base_path: Relative URL for pipeline URL handlers.
+    after_gate_key: Optional db.Key of a shared After() gate _SlotRecord. When
+      present the pipeline blocks on this one slot instead of on each of the
+      slots it must run after.
+    root_pipeline_key: Optional db.Key of the root pipeline the Pipeline runs
+      under; big parameters are stored with the root pipeline's blobs. Defaults
+      to the Pipeline itself, for starting root pipelines.
+    pending_writes: Optional list. When present, parameters are uploaded to
+      Cloud Storage in the background and the caller must wait for the
+      uploads appended to it; see _write_blob.
 
   Returns:
-    Tuple (dependent_slots, output_slot_keys, params_text, params_gcs) where:
+    Tuple (dependent_slots, output_slot_keys, params_properties) where:
       dependent_slots: List of db.Key instances of _SlotRecords on which
         this pipeline will need to block before execution (passed to
         create a _BarrierRecord for running the pipeline).
       output_slot_keys: List of db.Key instances of _SlotRecords that will
         be filled by this pipeline during its execution (passed to create
         a _BarrierRecord for finalizing the pipeline).
-      params_text: JSON dictionary of pipeline parameters to be serialized and
-        saved in a corresponding _PipelineRecord. Will be None if the params are
-        too big and must be saved in a blob instead.
-      params_gcs: JSON dictionary of pipeline parameters to be serialized and
-        saved in a cloud storage file, and then attached to a _PipelineRecord. 
-        Will be None if the params data size was small enough to fit in the entity.
+      params_properties: Dictionary of the serialized pipeline parameters,
+        keyed by the _PipelineRecord property names that should hold them
+        (see _encode_record_value). Argument values too big to be kept
+        inline are saved in their own cloud storage file and referenced by
+        name; parameters still too big to fit in the entity are saved in a
+        cloud storage file as a whole.
   """
   params = {
       'args': [],
@@ -1252,15 +2112,20 @@ def _generate_args(pipeline, future, queue_name, base_path):
       'max_attempts': pipeline.max_attempts,
       'task_retry': pipeline.task_retry,
       'target': pipeline.target,
+      'id_allocation': pipeline.id_allocation,
   }
   dependent_slots = set()
+  if root_pipeline_key is not None:
+    blob_pipeline_id = root_pipeline_key.string_id()
+  else:
+    blob_pipeline_id = pipeline.pipeline_id
 
   arg_list = params['args']
   for current_arg in pipeline.args:
     if isinstance(current_arg, PipelineFuture):
       current_arg = current_arg.default
     if isinstance(current_arg, Slot):
-      arg_list.append({'type': 'slot', 'slot_key': current_arg.key.urlsafe().decode()})
+      arg_list.append({'type': 'slot', 'slot_key': _encode_key(current_arg.key)})
       dependent_slots.add(current_arg.key)
     else:
       arg_list.append({'type': 'value', 'value': current_arg})
@@ -1270,7 +2135,7 @@ def _generate_args(pipeline, future, queue_name, base_path):
     if isinstance(current_arg, PipelineFuture):
       current_arg = current_arg.default
     if isinstance(current_arg, Slot):
-      kwarg_dict[name] = {'type': 'slot', 'slot_key': current_arg.key.urlsafe().decode()}
+      kwarg_dict[name] = {'type': 'slot', 'slot_key': _encode_key(current_arg.key)}
       dependent_slots.add(current_arg.key)
     else:
       kwarg_dict[name] = {'type': 'value', 'value': current_arg}
@@ -1278,24 +2143,53 @@ def _generate_args(pipeline, future, queue_name, base_path):
   after_all = params['after_all']
   for other_future in future._after_all_pipelines:
     slot_key = other_future._output_dict['default'].key
-    after_all.append(slot_key.urlsafe().decode())
-    dependent_slots.add(slot_key)
+    after_all.append(_encode_key(slot_key))
+    if after_gate_key is None:
+      dependent_slots.add(slot_key)
+  if after_gate_key is not None:
+    dependent_slots.add(after_gate_key)
 
   output_slots = params['output_slots']
   output_slot_keys = set()
   for name, slot in list(future._output_dict.items()):
     output_slot_keys.add(slot.key)
-    output_slots[name] = slot.key.urlsafe().decode()
+    output_slots[name] = _encode_key(slot.key)
+
+  encoded = _compress_encoding(mr_util.encode_value(params, _DEFAULT_CODEC))
+  if _MAX_INLINE_ARG_SIZE is not None and len(encoded) > _MAX_JSON_SIZE:
+    # The params do not fit in the entity; move the big arguments out.
+    spilled = False
+    for current_arg in itertools.chain(arg_list, list(kwarg_dict.values())):
+      if current_arg['type'] == 'value':
+        encoded_arg = _encode_arg_value(
+            current_arg['value'], blob_pipeline_id, pending_writes)
+        if encoded_arg['type'] == 'gcs':
+          current_arg.clear()
+          current_arg.update(encoded_arg)
+          spilled = True
+    if spilled:
+      encoded = _compress_encoding(
+          mr_util.encode_value(params, _DEFAULT_CODEC))
+
+  params_properties = _encode_record_value(
+      params, 'params', blob_pipeline_id, pending_writes, encoded=encoded)
+
+  return dependent_slots, output_slot_keys, params_properties
+
+
+def _has_complete_manifest(root_pipeline_key):
+  """Returns True if the manifest of a root pipeline lists all its entities.
+
+  Manifests are only written in low index mode, and instances running code
+  from before manifests add entities to any root pipeline without listing
+  them, so manifests are only relied on in low index mode, which may only be
+  enabled once every instance writes them.
 
-  params_encoded = json.dumps(params, cls=mr_util.JsonEncoder)
-  params_text = None
-  params_gcs = None
-  if len(params_encoded) > _MAX_JSON_SIZE:
-    params_gcs = write_json_gcs(params_encoded, pipeline.pipeline_id)
-  else:
-    params_text = params_encoded
-
-  return dependent_slots, output_slot_keys, params_text, params_gcs
+  Args:
+    root_pipeline_key: db.Key of the root pipeline.
+  """
+  return (models._LOW_INDEX_MODE and
+          _ManifestRecord.root_page_key(root_pipeline_key).get() is not None)
 
 
 class _PipelineContext(object):
@@ -1336,7 +2230,8 @@ class _PipelineContext(object):
         environ['HTTP_X_APPENGINE_QUEUENAME'],
         base_path)
 
-  def fill_slot(self, filler_pipeline_key, slot, value):
+  def fill_slot(self, filler_pipeline_key, slot, value,
+                root_pipeline_key=None, complete=False):
     """Fills a slot, enqueueing a task to trigger pending barriers.
 
     Args:
@@ -1344,30 +2239,54 @@ class _PipelineContext(object):
         that filled this slot.
       slot: The Slot instance to fill.
       value: The serializable value to assign.
+      root_pipeline_key: db.Key of the filler's root pipeline, with whose
+        blobs big values are stored. Looked up from the slot when None.
+      complete: When True and this is the last slot the filler's finalize
+        barrier waits on, the filler is marked as done and its barrier as
+        fired in the same transaction, instead of in a separate finalization
+        task. Only for pipelines without a finalized() implementation. The
+        filler is left to its finalization task when its root is known to be
+        aborting before the transaction, so that it is marked as aborted; an
+        abort requested after that is handled by the abort fan-out.
+
+    Returns:
+      True if the filler pipeline was marked as done.
 
     Raises:
       UnexpectedPipelineError if the _SlotRecord for the 'slot' could not
       be found in the Datastore.
     """
     if not isinstance(filler_pipeline_key, ndb.Key):
-      filler_pipeline_key = ndb.Key(urlsafe=filler_pipeline_key)
+      filler_pipeline_key = _decode_key(_PipelineRecord, filler_pipeline_key)
 
+    completed = False
     if _TEST_MODE:
       slot._set_value_test(filler_pipeline_key, value)
     else:
-      encoded_value = json.dumps(value,
-                                       sort_keys=True,
-                                       cls=mr_util.JsonEncoder)
-      value_text = None
-      value_gcs = None
-      if len(encoded_value) <= _MAX_JSON_SIZE:
-        value_text = encoded_value
-      else:
-        # The encoded value is too big. Save it as a blob.
-        value_gcs = write_json_gcs(encoded_value, filler_pipeline_key.string_id())
+      if root_pipeline_key is None:
+        slot_record = models._cached_get(slot.key)
+        if slot_record is None:
+          raise UnexpectedPipelineError(
+              'Tried to fill missing slot "%s" '
+              'by pipeline ID "%s" with value: %r'
+              % (slot.key, filler_pipeline_key.string_id(), value))
+        root_pipeline_key = slot_record.root_pipeline
+      # Blobs are only deleted together with their root pipeline, so they
+      # must never be stored under the ID of the filler itself.
+      value_properties = _encode_record_value(
+          value, 'value', root_pipeline_key.string_id(), stream=True)
+      barrier_key = None
+      if complete:
+        barrier_key = self._last_pending_barrier_key(
+            filler_pipeline_key, slot.key, root_pipeline_key)
 
       def txn():
-        slot_record = slot.key.get()
+        pipeline_record = barrier_record = None
+        if barrier_key is None:
+          slot_record = slot.key.get()
+        else:
+          slot_record, pipeline_record, barrier_record = ndb.get_multi(
+              [slot.key, filler_pipeline_key, barrier_key])
         if slot_record is None:
           raise UnexpectedPipelineError(
               'Tried to fill missing slot "%s" '
@@ -1378,23 +2297,112 @@ class _PipelineContext(object):
         # outputs came from the same retry attempt of the upstream pipeline),
         # the down-stream pipeline must also wait for the 'default' output
         # of these up-stream pipelines.
+        now = self._gettime()
         slot_record.filler = filler_pipeline_key
-        slot_record.value_text = value_text
-        slot_record.value_gcs = value_gcs
+        slot_record.populate(**value_properties)
         slot_record.status = _SlotRecord.FILLED
-        slot_record.fill_time = self._gettime()
-        slot_record.put()
+        slot_record.fill_time = now
+        entities = [slot_record]
+        done = (
+            barrier_key is not None and
+            self._completes_in_txn(slot.key, pipeline_record, barrier_record))
+        if done:
+          pipeline_record.status = _PipelineRecord.DONE
+          pipeline_record.finalized_time = now
+          barrier_record.status = _BarrierRecord.FIRED
+          barrier_record.trigger_time = now
+          entities.extend([pipeline_record, barrier_record])
+        ndb.put_multi(entities)
         task = taskqueue.Task(
             url=self.barrier_handler_path,
             params=dict(
-                slot_key=slot.key.urlsafe().decode(),
+                slot_key=_encode_key(slot.key),
                 use_barrier_indexes=True),
-            headers={'X-Ae-Slot-Key': slot.key.urlsafe().decode(),
-                     'X-Ae-Filler-Pipeline-Key': filler_pipeline_key.urlsafe().decode()})
+            headers={'X-Ae-Slot-Key': _encode_key(slot.key),
+                     'X-Ae-Filler-Pipeline-Key': _encode_key(filler_pipeline_key)})
         task.add(queue_name=self.queue_name, transactional=True)
-      ndb.transaction(txn, propagation=TransactionOptions.ALLOWED)
+        return done
+      completed = ndb.transaction(
+          txn, propagation=TransactionOptions.ALLOWED,
+          xg=barrier_key is not None)
 
     self.session_filled_output_names.add(slot.name)
+    return completed
+
+  def _last_pending_barrier_key(self, pipeline_key, slot_key,
+                                root_pipeline_key):
+    """Returns the key of the finalize barrier that filling a slot may trigger.
+
+    Reads the barrier and the other blocking slots from the request cache,
+    so the transaction only reads them again when they are likely to be
+    ready. _completes_in_txn() checks them again in the transaction.
+
+    The abort_requested flag of the root is only checked here, from the
+    abort signal cache or the request cache, so that the root is not part of
+    every completing transaction. A root aborted after this check aborts the
+    completed pipeline's successors through its abort fan-out instead.
+
+    Args:
+      pipeline_key: db.Key of the _PipelineRecord filling the slot.
+      slot_key: db.Key of the _SlotRecord about to be filled.
+      root_pipeline_key: db.Key of the pipeline's root.
+
+    Returns:
+      The db.Key of the pipeline's finalize _BarrierRecord, or None if it
+      still waits on other slots after this one is filled or its root is
+      missing or being aborted.
+    """
+    barrier = models._cached_get(ndb.Key(
+        _BarrierRecord, _BarrierRecord.FINALIZE, parent=pipeline_key))
+    if barrier is None or slot_key not in barrier.blocking_slots:
+      return None
+    # The slots, and the pipeline with its barrier.
+    if len(barrier.blocking_slots) + 1 > _MAX_XG_ENTITY_GROUPS:
+      return None
+    abort_requested = _get_abort_signal(root_pipeline_key)
+    if abort_requested is None:
+      root_pipeline_record = models._cached_get(root_pipeline_key)
+      if root_pipeline_record is None:
+        return None
+      abort_requested = root_pipeline_record.abort_requested
+    if abort_requested:
+      return None
+    other_slot_keys = [key for key in barrier.blocking_slots if key != slot_key]
+    for slot_record in models._cached_get_multi(other_slot_keys):
+      if slot_record is None or slot_record.status != _SlotRecord.FILLED:
+        return None
+    return barrier.key
+
+  def _completes_in_txn(self, slot_key, pipeline_record, barrier_record):
+    """Returns True if filling a slot completes its filler pipeline.
+
+    Must be called in the transaction filling the slot.
+
+    Args:
+      slot_key: db.Key of the _SlotRecord being filled.
+      pipeline_record: _PipelineRecord of the filler, or None if missing.
+      barrier_record: The filler's finalize _BarrierRecord, or None.
+
+    Returns:
+      True if the filler is running, is not a root being aborted and the slot
+      is the last one its finalize barrier waits on.
+    """
+    if pipeline_record is None or barrier_record is None:
+      return False
+    if pipeline_record.status not in (
+        _PipelineRecord.WAITING, _PipelineRecord.RUN):
+      return False
+    if pipeline_record.abort_requested:
+      return False
+    if (barrier_record.status != _BarrierRecord.WAITING or
+        slot_key not in barrier_record.blocking_slots):
+      return False
+    other_slot_keys = [
+        key for key in barrier_record.blocking_slots if key != slot_key]
+    for slot_record in ndb.get_multi(other_slot_keys):
+      if slot_record is None or slot_record.status != _SlotRecord.FILLED:
+        return False
+    return True
 
   def notify_barriers(self,
                       slot_key,
@@ -1417,7 +2425,7 @@ class _PipelineContext(object):
       PipelineStatusError: If any of the barriers are in a bad state.
     """
     if not isinstance(slot_key, ndb.Key):
-      slot_key = ndb.Key(urlsafe=slot_key)
+      slot_key = _decode_key(_SlotRecord, slot_key)
     logging.debug('Notifying slot %r', slot_key)
 
     if use_barrier_indexes:
@@ -1435,7 +2443,7 @@ class _PipelineContext(object):
       # these dependent entities went through. We assume that the instigator
       # retried from scratch and somehwere there exists a good _BarrierIndex and
       # corresponding _BarrierRecord that tries to accomplish the same thing.
-      barriers = ndb.get_multi(barrier_key_list)
+      barriers = models._cached_get_multi(barrier_key_list)
       results = []
       for barrier_key, barrier in zip(barrier_key_list, barriers):
         if barrier is None:
@@ -1457,7 +2465,7 @@ class _PipelineContext(object):
       blocking_slot_keys.extend(barrier.blocking_slots)
 
     blocking_slot_dict = {}
-    for slot_record in ndb.get_multi(blocking_slot_keys):
+    for slot_record in models._cached_get_multi(blocking_slot_keys):
       if slot_record is None:
         continue
       blocking_slot_dict[slot_record.key] = slot_record
@@ -1482,11 +2490,25 @@ class _PipelineContext(object):
       # the task name tombstones.
       pending_slots = set(barrier.blocking_slots) - set(ready_slots)
       if not pending_slots:
-        if barrier.status != _BarrierRecord.FIRED:
+        already_fired = barrier.status == _BarrierRecord.FIRED
+        if not already_fired:
           barrier.status = _BarrierRecord.FIRED
           barrier.trigger_time = self._gettime()
           updated_barriers.append(barrier)
 
+        if barrier.gate_slot is not None:
+          # After() gates release their children by filling the gate slot.
+          # The fill is transactional with its notification task and happens
+          # before the barrier is marked as fired, so a fired gate has
+          # always been filled.
+          if not already_fired:
+            logging.debug('Opening gate %r', barrier.key)
+            self.fill_slot(
+                barrier.target,
+                Slot(name=barrier.key.string_id(), slot_key=barrier.gate_slot),
+                None, root_pipeline_key=barrier.root_pipeline)
+          continue
+
         purpose = barrier.key.string_id()
         if purpose == _BarrierRecord.START:
           path = self.pipeline_handler_path
@@ -1497,14 +2519,27 @@ class _PipelineContext(object):
           # contention on the _PipelineRecord entity.
           countdown = 1
         pipeline_key = barrier.target
-        pipeline_record = pipeline_key.get()
+        pipeline_record = models._cached_get(pipeline_key)
+        if (already_fired and purpose == _BarrierRecord.FINALIZE and
+            pipeline_record is not None and
+            pipeline_record.status == _PipelineRecord.DONE):
+          # Completed in the same transaction that filled its last output.
+          continue
         logging.debug('Firing barrier %r', barrier.key)
+        task_params = dict(pipeline_key=_encode_key(pipeline_key),
+                           purpose=purpose)
+        if purpose == _BarrierRecord.START:
+          inputs = _encode_inline_inputs(
+              pipeline_record,
+              [blocking_slot_dict[key] for key in barrier.blocking_slots])
+          if inputs is not None:
+            task_params['inputs'] = inputs
         task_list.append(taskqueue.Task(
             url=path,
             countdown=countdown,
             name='ae-barrier-fire-%s-%s' % (pipeline_key.string_id(), purpose),
-            params=dict(pipeline_key=pipeline_key.urlsafe().decode(), purpose=purpose),
-            headers={'X-Ae-Pipeline-Key': pipeline_key.urlsafe().decode()},
+            params=task_params,
+            headers={'X-Ae-Pipeline-Key': _encode_key(pipeline_key)},
             target=pipeline_record.params.get('target', None) if pipeline_record else None))
       else:
         logging.debug('Not firing barrier %r, Waiting for slots: %r',
@@ -1529,7 +2564,7 @@ class _PipelineContext(object):
           name='%s-ae-barrier-notify-%d' % (prefix, end),
           url=self.barrier_handler_path,
           params=dict(
-              slot_key=slot_key.urlsafe().decode(),
+              slot_key=_encode_key(slot_key),
               cursor=cursor.urlsafe().decode() if cursor else '',
               use_barrier_indexes=use_barrier_indexes)))
 
@@ -1574,11 +2609,14 @@ class _PipelineContext(object):
 
       task = taskqueue.Task(
           url=self.fanout_abort_handler_path,
-          params=dict(root_pipeline_key=root_pipeline_key.urlsafe().decode()))
+          params=dict(root_pipeline_key=_encode_key(root_pipeline_key)))
       task.add(queue_name=self.queue_name, transactional=True)
       return True
 
-    return ndb.transaction(txn)
+    if not ndb.transaction(txn):
+      return False
+    _set_abort_signal(root_pipeline_key, True)
+    return True
 
   def continue_abort(self,
                      root_pipeline_key,
@@ -1593,7 +2631,7 @@ class _PipelineContext(object):
       max_to_notify: Used for testing.
     """
     if not isinstance(root_pipeline_key, ndb.Key):
-      root_pipeline_key = ndb.Key(urlsafe=root_pipeline_key)
+      root_pipeline_key = _decode_key(_PipelineRecord, root_pipeline_key)
     # NOTE: The results of this query may include _PipelineRecord instances
     # that are not actually "reachable", meaning you cannot get to them by
     # starting at the root pipeline and following "fanned_out" onward. This
@@ -1606,10 +2644,18 @@ class _PipelineContext(object):
     # unreachable child pipelines, it will appear as if two finalize methods
     # have been called instead of just one. The saving grace here is that
     # finalize must be idempotent, so this *should* be harmless.
-    query = (
-        _PipelineRecord.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key))
-    results, cursor, _ = query.fetch_page(max_to_notify, start_cursor=ndb.Cursor(urlsafe=cursor))
+    if _has_complete_manifest(root_pipeline_key):
+      pipeline_keys, cursor = self._manifest_pipeline_keys(
+          root_pipeline_key, cursor, max_to_notify)
+      results = [record for record in ndb.get_multi(pipeline_keys)
+                 if record is not None]
+    else:
+      query = (
+          _PipelineRecord.query()
+          .filter(_PipelineRecord.root_pipeline == root_pipeline_key))
+      results, cursor, _ = query.fetch_page(max_to_notify, start_cursor=ndb.Cursor(urlsafe=cursor))
+      more = len(results) == max_to_notify
+      cursor = cursor.urlsafe().decode() if more and cursor else None
 
     task_list = []
     for pipeline_record in results:
@@ -1621,11 +2667,11 @@ class _PipelineContext(object):
       task_list.append(taskqueue.Task(
           name='%s-%s-abort' % (self.task_name, pipeline_key.string_id()),
           url=self.abort_handler_path,
-          params=dict(pipeline_key=pipeline_key.urlsafe().decode(), purpose=_BarrierRecord.ABORT),
-          headers={'X-Ae-Pipeline-Key': pipeline_key.urlsafe().decode()}))
+          params=dict(pipeline_key=_encode_key(pipeline_key), purpose=_BarrierRecord.ABORT),
+          headers={'X-Ae-Pipeline-Key': _encode_key(pipeline_key)}))
 
     # Task continuation with sequence number to prevent fork-bombs.
-    if len(results) == max_to_notify:
+    if cursor is not None:
       the_match = re.match('(.*)-([0-9]+)', self.task_name)
       if the_match:
         prefix = the_match.group(1)
@@ -1636,15 +2682,60 @@ class _PipelineContext(object):
       task_list.append(taskqueue.Task(
           name='%s-%d' % (prefix, end),
           url=self.fanout_abort_handler_path,
-          params=dict(root_pipeline_key=root_pipeline_key.urlsafe().decode(),
-                      cursor=cursor.urlsafe().decode() if cursor else '')))
+          params=dict(root_pipeline_key=_encode_key(root_pipeline_key),
+                      cursor=cursor)))
 
-    if task_list:
+    for index in range(0, len(task_list), taskqueue.MAX_TASKS_PER_ADD):
       try:
-        taskqueue.Queue(self.queue_name).add(task_list)
+        taskqueue.Queue(self.queue_name).add(
+            task_list[index:index + taskqueue.MAX_TASKS_PER_ADD])
       except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError):
         pass
 
+  @staticmethod
+  def _manifest_pipeline_keys(root_pipeline_key, cursor, limit):
+    """Lists the _PipelineRecords in a manifest, a limited number at a time.
+
+    Args:
+      root_pipeline_key: db.Key of the root pipeline.
+      cursor: Where a previous call stopped, or None to start from the first
+        page. Made of the number of pipeline keys already listed from a page
+        and the stringified Datastore cursor of that page.
+      limit: The maximum number of keys to return.
+
+    Returns:
+      Tuple (pipeline_keys, cursor) with the cursor to pass to the next call,
+      or None when all the pipelines have been listed.
+    """
+    offset = 0
+    start_cursor = None
+    if cursor:
+      offset, _, page_cursor = cursor.partition(':')
+      offset = int(offset)
+      if page_cursor:
+        start_cursor = ndb.Cursor(urlsafe=page_cursor)
+    query = _ManifestRecord.query(ancestor=root_pipeline_key)
+    pipeline_keys = []
+    while True:
+      pages, end_cursor, more = query.fetch_page(1, start_cursor=start_cursor)
+      if not pages:
+        return pipeline_keys, None
+      page_keys = [key for key in pages[0].entity_keys
+                   if key.kind() == _PipelineRecord._get_kind()]
+      listed = page_keys[offset:offset + limit - len(pipeline_keys)]
+      pipeline_keys.extend(listed)
+      offset += len(listed)
+      if offset < len(page_keys):
+        # Stopped within this page.
+        return pipeline_keys, '%d:%s' % (
+            offset, start_cursor.urlsafe().decode() if start_cursor else '')
+      if not more or end_cursor is None:
+        return pipeline_keys, None
+      if len(pipeline_keys) >= limit:
+        return pipeline_keys, '0:%s' % end_cursor.urlsafe().decode()
+      offset = 0
+      start_cursor = end_cursor
+
   def start(self, pipeline, return_task=True, countdown=None, eta=None):
     """Starts a pipeline.
 
@@ -1669,10 +2760,16 @@ class _PipelineContext(object):
     # Adjust all pipeline output keys for this Pipeline to be children of
     # the _PipelineRecord, that way we can write them all and submit in a
     # single transaction.
-    for name, slot in list(pipeline.outputs._output_dict.items()):
-      slot.key = ndb.Key(flat=slot.key.flat(), **dict(parent=pipeline._pipeline_key))
+    if pipeline.id_allocation == UUID_IDS:
+      for name, slot in list(pipeline.outputs._output_dict.items()):
+        slot.key = ndb.Key(flat=slot.key.flat(), **dict(parent=pipeline._pipeline_key))
+    else:
+      slots = list(pipeline.outputs._output_dict.values())
+      for slot, slot_id in zip(
+          slots, _allocate_ids(pipeline.id_allocation, len(slots))):
+        slot.key = ndb.Key(_SlotRecord, slot_id, parent=pipeline._pipeline_key)
 
-    _, output_slots, params_text, params_gcs = _generate_args(
+    _, output_slots, params_properties = _generate_args(
         pipeline, pipeline.outputs, self.queue_name, self.base_path)
 
     @ndb.transactional(propagation=TransactionOptions.INDEPENDENT)
@@ -1692,10 +2789,9 @@ class _PipelineContext(object):
 
       entities_to_put.append(_PipelineRecord(
           key=pipeline._pipeline_key,
+          **params_properties,
           root_pipeline=pipeline._pipeline_key,
           is_root_pipeline=True,
-          params_text=params_text,
-          params_gcs=params_gcs,
           start_time=self._gettime(),
           class_path=pipeline._class_path,
           max_attempts=pipeline.max_attempts))
@@ -1706,12 +2802,16 @@ class _PipelineContext(object):
           _BarrierRecord.FINALIZE,
           output_slots))
 
+      entities_to_put.extend(_PipelineContext._create_manifest_entities(
+          pipeline._pipeline_key, entities_to_put,
+          first_page_id=_ManifestRecord.ROOT_PAGE))
+
       ndb.put_multi(entities_to_put)
 
       task = taskqueue.Task(
           url=self.pipeline_handler_path,
-          params=dict(pipeline_key=pipeline._pipeline_key.urlsafe().decode()),
-          headers={'X-Ae-Pipeline-Key': pipeline._pipeline_key.urlsafe().decode()},
+          params=dict(pipeline_key=_encode_key(pipeline._pipeline_key)),
+          headers={'X-Ae-Pipeline-Key': _encode_key(pipeline._pipeline_key)},
           target=pipeline.target,
           countdown=countdown,
           eta=eta)
@@ -1858,21 +2958,28 @@ class _PipelineContext(object):
       except NotImplementedError:
         pass
 
-  def evaluate(self, pipeline_key, purpose=None, attempt=0):
+  def evaluate(self, pipeline_key, purpose=None, attempt=0, inputs=None):
     """Evaluates the given Pipeline and enqueues sub-stages for execution.
 
     Args:
       pipeline_key: The db.Key or stringified key of the _PipelineRecord to run.
       purpose: Why evaluate was called ('start', 'finalize', or 'abort').
       attempt: The attempt number that should be tried.
+      inputs: Optional filled input slots sent along with the task; see
+        _encode_inline_inputs.
     """
+    with _running_under_root(None):
+      self._evaluate(pipeline_key, purpose, attempt, inputs)
+
+  def _evaluate(self, pipeline_key, purpose, attempt, inputs):
+    """Implements evaluate(), under the pipeline's root once it is known."""
     After._thread_init()
     InOrder._thread_init()
     InOrder._local._activated = False
 
     if not isinstance(pipeline_key, ndb.Key):
-      pipeline_key = ndb.Key(urlsafe=pipeline_key)
-    pipeline_record = pipeline_key.get()
+      pipeline_key = _decode_key(_PipelineRecord, pipeline_key)
+    pipeline_record = models._cached_get(pipeline_key)
     if pipeline_record is None:
       logging.error('Pipeline ID "%s" does not exist.', pipeline_key.string_id())
       return
@@ -1889,28 +2996,43 @@ class _PipelineContext(object):
                     pipeline_key.string_id(), purpose or _BarrierRecord.START,
                     pipeline_record.status)
       return
+    if inputs:
+      _prime_inline_inputs(pipeline_record, inputs)
 
     params = pipeline_record.params
     root_pipeline_key = pipeline_record.root_pipeline
-    default_slot_key = ndb.Key(urlsafe=params['output_slots']['default'])
-
-    default_slot_record, root_pipeline_record = ndb.get_multi([
-        default_slot_key, root_pipeline_key])
+    _current_root_local.key = root_pipeline_key
+    default_slot_key = _decode_key(_SlotRecord, params['output_slots']['default'])
+
+    # Only read the root when its abort_requested flag is not cached.
+    root_pipeline_record = None
+    if root_pipeline_key == pipeline_key:
+      root_pipeline_record = pipeline_record
+      abort_requested = bool(pipeline_record.abort_requested)
+    else:
+      abort_requested = _get_abort_signal(root_pipeline_key)
+    if abort_requested is None:
+      default_slot_record, root_pipeline_record = models._cached_get_multi([
+          default_slot_key, root_pipeline_key])
+    else:
+      default_slot_record = models._cached_get(default_slot_key)
     if default_slot_record is None:
       logging.error('Pipeline ID "%s" default slot "%s" does not exist.',
                     pipeline_key.string_id(), default_slot_key)
       return
-    if root_pipeline_record is None:
-      logging.error('Pipeline ID "%s" root pipeline ID "%s" is missing.',
-                    pipeline_key.string_id(), root_pipeline_key.string_id())
-      return
+    if abort_requested is None:
+      if root_pipeline_record is None:
+        logging.error('Pipeline ID "%s" root pipeline ID "%s" is missing.',
+                      pipeline_key.string_id(), root_pipeline_key.string_id())
+        return
+      abort_requested = bool(root_pipeline_record.abort_requested)
+      _set_abort_signal(root_pipeline_key, abort_requested)
 
     # Always finalize if we're aborting so pipelines have a chance to cleanup
     # before they terminate. Pipelines must access 'was_aborted' to find
     # out how their finalization should work.
     abort_signal = (
-        purpose == _BarrierRecord.ABORT or
-        root_pipeline_record.abort_requested == True)
+        purpose == _BarrierRecord.ABORT or abort_requested == True)
     finalize_signal = (
         (default_slot_record.status == _SlotRecord.FILLED and
          purpose == _BarrierRecord.FINALIZE) or abort_signal)
@@ -2015,7 +3137,8 @@ class _PipelineContext(object):
         # This properly handles the yield-less generator case when the
         # RUN state transition worked properly but outputting to the default
         # slot failed.
-        self.fill_slot(pipeline_key, caller_output.default, None)
+        self.fill_slot(pipeline_key, caller_output.default, None,
+                       root_pipeline_key=root_pipeline_key)
       return
 
     if (pipeline_record.status == _PipelineRecord.WAITING and
@@ -2039,7 +3162,9 @@ class _PipelineContext(object):
       # value is being serialized. This ensures that serialization errors
       # will cause normal abort/retry behavior.
       try:
-        self.fill_slot(pipeline_key, caller_output.default, result)
+        self.fill_slot(pipeline_key, caller_output.default, result,
+                       root_pipeline_key=root_pipeline_key,
+                       complete=pipeline_func._completes_on_fill())
       except Exception as e:
         retry_message = 'Bad return value. %s: %s' % (
             e.__class__.__name__, str(e))
@@ -2100,6 +3225,7 @@ class _PipelineContext(object):
         # evaluator to raise all exceptions back up to the task queue) is
         # inherited by all children from the root down.
         yielded.task_retry = pipeline_func.task_retry
+        yielded.id_allocation = pipeline_func.id_allocation
       else:
         raise UnexpectedPipelineError(
             'Yielded a disallowed value: %r' % yielded)
@@ -2107,7 +3233,7 @@ class _PipelineContext(object):
     if last_sub_stage:
       # Final yielded stage inherits outputs from calling pipeline that were not
       # already filled during the generator's execution.
-      inherited_outputs = params['output_slots']
+      inherited_outputs = dict(params['output_slots'])
       for slot_name in self.session_filled_output_names:
         del inherited_outputs[slot_name]
       sub_stage_dict[last_sub_stage]._inherit_outputs(
@@ -2126,23 +3252,43 @@ class _PipelineContext(object):
             pipeline_key.string_id(), pipeline_func._class_path))
         if self.handle_run_exception(pipeline_key, pipeline_func, exception):
           raise exception
-      else:
-        self.fill_slot(pipeline_key, caller_output.default, None)
+      elif not self.fill_slot(pipeline_key, caller_output.default, None,
+                              root_pipeline_key=root_pipeline_key,
+                              complete=pipeline_func._completes_on_fill()):
         self.transition_run(pipeline_key)
       return
 
-    # Allocate any SlotRecords that do not yet exist.
-    entities_to_put = []
-    for future in list(sub_stage_dict.values()):
-      for slot in list(future._output_dict.values()):
-        if not slot._exists:
-          entities_to_put.append(_SlotRecord(
-              key=slot.key, root_pipeline=root_pipeline_key))
+    # Allocate any SlotRecords that do not yet exist, along with the IDs of
+    # the children and their new slots.
+    new_slots = [
+        slot for future in sub_stage_dict.values()
+        for slot in future._output_dict.values() if not slot._exists]
+    id_allocation = pipeline_func.id_allocation
+    if id_allocation == UUID_IDS:
+      # The slots already have uuid4 keys.
+      new_ids = _allocate_ids(id_allocation, len(sub_stage_ordering))
+    else:
+      new_ids = _allocate_ids(
+          id_allocation, len(new_slots) + len(sub_stage_ordering))
+      for slot in new_slots:
+        slot.key = ndb.Key(_SlotRecord, new_ids.pop())
+    entities_to_put = [
+        _SlotRecord(key=slot.key, root_pipeline=root_pipeline_key)
+        for slot in new_slots]
+
+    # Children that must run after the same set of futures share a gate.
+    after_gate_dict, gate_entities = _PipelineContext._create_after_gates(
+        root_pipeline_key, pipeline_key, sub_stage_dict.values(),
+        id_allocation)
+    entities_to_put.extend(gate_entities)
 
     # Allocate PipelineRecords and BarrierRecords for generator-run Pipelines.
     pipelines_to_run = set()
     all_children_keys = []
     all_output_slots = set()
+    # Big child parameters are uploaded concurrently while the rest of the
+    # children are serialized; the uploads are joined before the put below.
+    pending_writes = []
     for sub_stage in sub_stage_ordering:
       future = sub_stage_dict[sub_stage]
 
@@ -2150,8 +3296,11 @@ class _PipelineContext(object):
       # are being serialized. This ensures that serialization errors will
       # cause normal retry/abort behavior.
       try:
-        dependent_slots, output_slots, params_text, params_gcs = \
-            _generate_args(sub_stage, future, self.queue_name, self.base_path)
+        dependent_slots, output_slots, params_properties = \
+            _generate_args(sub_stage, future, self.queue_name, self.base_path,
+                           after_gate_key=after_gate_dict.get(future),
+                           root_pipeline_key=root_pipeline_key,
+                           pending_writes=pending_writes)
       except Exception as e:
         retry_message = 'Bad child arguments. %s: %s' % (
             e.__class__.__name__, str(e))
@@ -2165,17 +3314,15 @@ class _PipelineContext(object):
         else:
           return
 
-      child_pipeline_key = ndb.Key(
-          _PipelineRecord, uuid.uuid4().hex)
+      child_pipeline_key = ndb.Key(_PipelineRecord, new_ids.pop())
       all_output_slots.update(output_slots)
       all_children_keys.append(child_pipeline_key)
 
       child_pipeline = _PipelineRecord(
           key=child_pipeline_key,
           root_pipeline=root_pipeline_key,
-          params_text=params_text,
-          params_gcs=params_gcs,
           class_path=sub_stage._class_path,
+          **params_properties,
           max_attempts=sub_stage.max_attempts)
       entities_to_put.append(child_pipeline)
 
@@ -2220,6 +3367,23 @@ class _PipelineContext(object):
     barrier_indexes = barrier_entities[1:]
     entities_to_put.extend(barrier_indexes)
 
+    try:
+      wait_for_writes(pending_writes)
+    except Exception as e:
+      retry_message = 'Could not save child arguments. %s: %s' % (
+          e.__class__.__name__, str(e))
+      logging.exception(
+          'Generator %r#%s caused exception while uploading args for '
+          'child pipelines. %s', pipeline_func, pipeline_key.string_id(),
+          retry_message)
+      self.transition_retry(pipeline_key, retry_message)
+      if pipeline_func.task_retry:
+        raise
+      else:
+        return
+
+    entities_to_put.extend(self._create_manifest_entities(
+        root_pipeline_key, entities_to_put))
     ndb.put_multi(entities_to_put)
 
     self.transition_run(pipeline_key,
@@ -2273,6 +3437,93 @@ class _PipelineContext(object):
 
     return result
 
+  @staticmethod
+  def _create_manifest_entities(root_pipeline_key, entities,
+                                first_page_id=None):
+    """Creates the _ManifestRecord pages listing newly created entities.
+
+    Manifests are only read in low index mode, so none are created otherwise.
+
+    Args:
+      root_pipeline_key: The root pipeline the entities are part of.
+      entities: The entities that will be put along with the pages.
+      first_page_id: Key name of the first page; None for a random UUID.
+
+    Returns:
+      List of _ManifestRecord entities that should be put in the Datastore in
+      the same batch as the listed entities.
+    """
+    if not models._LOW_INDEX_MODE:
+      return []
+    entity_keys = [entity.key for entity in entities]
+    result = []
+    for index in range(0, len(entity_keys), _MAX_MANIFEST_KEYS):
+      page_id = first_page_id if index == 0 else None
+      result.append(_ManifestRecord(
+          parent=root_pipeline_key,
+          id=page_id or uuid.uuid4().hex,
+          entity_keys=entity_keys[index:index + _MAX_MANIFEST_KEYS]))
+    return result
+
+  @staticmethod
+  def _create_after_gates(root_pipeline_key, pipeline_key, futures,
+                          id_allocation=UUID_IDS):
+    """Creates shared After() gates for a generator's child pipelines.
+
+    Without a gate, each of M children that must run after the same K futures
+    blocks on all K slots, costing K*M _BarrierIndexes and M barrier
+    notifications per filled slot. A gate is a _BarrierRecord that blocks on
+    the K slots and fills a single gate _SlotRecord when it fires; the M
+    children block on that slot instead, bringing the cost down to K+M. Gates
+    are only created when that is actually cheaper.
+
+    Args:
+      root_pipeline_key: The root pipeline this is part of.
+      pipeline_key: The generator pipeline that yielded the children.
+      futures: The PipelineFutures of the yielded children.
+      id_allocation: How the IDs of the gate slots are generated.
+
+    Returns:
+      Tuple (after_gate_dict, entities) where:
+        after_gate_dict: Maps each gated PipelineFuture to the db.Key of the
+          gate _SlotRecord it should block on.
+        entities: The gate _SlotRecords, _BarrierRecords and _BarrierIndexes
+          that must be put in the Datastore along with the children.
+    """
+    futures_by_after = {}
+    for future in futures:
+      after_slot_keys = frozenset(
+          other_future._output_dict['default'].key
+          for other_future in future._after_all_pipelines)
+      if after_slot_keys:
+        futures_by_after.setdefault(after_slot_keys, []).append(future)
+
+    gated = [
+        (after_slot_keys, gated_futures)
+        for after_slot_keys, gated_futures in futures_by_after.items()
+        if len(after_slot_keys) * len(gated_futures) >
+            len(after_slot_keys) + len(gated_futures)]
+    gate_ids = _allocate_ids(id_allocation, len(gated))
+
+    after_gate_dict = {}
+    entities = []
+    for (after_slot_keys, gated_futures), gate_id in zip(gated, gate_ids):
+      gate_slot_key = ndb.Key(_SlotRecord, gate_id)
+      entities.append(_SlotRecord(
+          key=gate_slot_key, root_pipeline=root_pipeline_key))
+      barrier_entities = _PipelineContext._create_barrier_entities(
+          root_pipeline_key,
+          pipeline_key,
+          '%s-%s' % (_BarrierRecord.GATE, gate_slot_key.string_id()),
+          after_slot_keys)
+      barrier_entities[0].gate_slot = gate_slot_key
+      entities.extend(barrier_entities)
+
+      for future in gated_futures:
+        after_gate_dict[future] = gate_slot_key
+
+    return after_gate_dict, entities
+
   def handle_run_exception(self, pipeline_key, pipeline_func, e):
     """Handles an exception raised by a Pipeline's user code.
 
@@ -2363,7 +3614,7 @@ class _PipelineContext(object):
           child_indexes.sort()
           task = taskqueue.Task(
               url=self.fanout_handler_path,
-              params=dict(parent_key=pipeline_key.urlsafe().decode(),
+              params=dict(parent_key=_encode_key(pipeline_key),
                           child_indexes=child_indexes))
           task.add(queue_name=self.queue_name, transactional=True)
 
@@ -2464,16 +3715,16 @@ class _PipelineContext(object):
             'Aborting after %d attempts' % pipeline_record.current_attempt)
         task = taskqueue.Task(
             url=self.fanout_abort_handler_path,
-            params=dict(root_pipeline_key=root_pipeline_key.urlsafe().decode()))
+            params=dict(root_pipeline_key=_encode_key(root_pipeline_key)))
         task.add(queue_name=self.queue_name, transactional=True)
       else:
         task = taskqueue.Task(
             url=self.pipeline_handler_path,
             eta=pipeline_record.next_retry_time,
-            params=dict(pipeline_key=pipeline_key.urlsafe().decode(),
+            params=dict(pipeline_key=_encode_key(pipeline_key),
                         purpose=_BarrierRecord.START,
                         attempt=pipeline_record.current_attempt),
-            headers={'X-Ae-Pipeline-Key': pipeline_key.urlsafe().decode()},
+            headers={'X-Ae-Pipeline-Key': _encode_key(pipeline_key)},
             target=pipeline_record.params.get('target', None)
               if pipeline_record else None)
         task.add(queue_name=self.queue_name, transactional=True)
@@ -2521,11 +3772,12 @@ class _BarrierHandler(MethodView):
       return abort(403)
 
     context = _PipelineContext.from_environ(request.environ)
-    context.notify_barriers(
-        request.values.get('slot_key'),
-        request.values.get('cursor'),
-        use_barrier_indexes=request.values.get('use_barrier_indexes') == 'True'
-    )
+    with _recording_task_datastore_ops(), models._request_cache():
+      context.notify_barriers(
+          request.values.get('slot_key'),
+          request.values.get('cursor'),
+          use_barrier_indexes=(
+              request.values.get('use_barrier_indexes') == 'True'))
     return "", 200
 
 class _PipelineHandler(MethodView):
@@ -2536,9 +3788,11 @@ class _PipelineHandler(MethodView):
       return abort(403)
 
     context = _PipelineContext.from_environ(request.environ)
-    context.evaluate(request.values.get('pipeline_key'),
-                     purpose=request.values.get('purpose'),
-                     attempt=int(request.values.get('attempt', '0')))
+    with _recording_task_datastore_ops(), models._request_cache():
+      context.evaluate(request.values.get('pipeline_key'),
+                       purpose=request.values.get('purpose'),
+                       attempt=int(request.values.get('attempt', '0')),
+                       inputs=request.values.get('inputs'))
     return "", 200
 
 
@@ -2565,11 +3819,18 @@ class _FanoutHandler(MethodView):
       return abort(403)
 
     context = _PipelineContext.from_environ(request.environ)
+    with _recording_task_datastore_ops(), models._request_cache():
+      self.fan_out(context)
+    return "", 200
 
-    # Set of stringified db.Keys of children to run.
+  def fan_out(self, context):
+    """Enqueues the run tasks of the children named in the request."""
+    # Set of the keys of children to run.
     all_pipeline_keys = set()
     # For backwards compatibility with the old style of fan-out requests.
-    all_pipeline_keys.update(request.values.getlist('pipeline_key'))
+    all_pipeline_keys.update(
+        _decode_key(_PipelineRecord, pipeline_key)
+        for pipeline_key in request.values.getlist('pipeline_key'))
 
     # Fetch the child pipelines from the parent. This works around the 10KB
     # task payload limit. This get() is consistent-on-read and the fan-out
@@ -2578,22 +3839,22 @@ class _FanoutHandler(MethodView):
     parent_key = request.values.get('parent_key')
     child_indexes = [int(x) for x in request.values.getlist('child_indexes')]
     if parent_key:
-      parent_key = ndb.Key(urlsafe=parent_key)
-      parent = parent_key.get()
+      parent_key = _decode_key(_PipelineRecord, parent_key)
+      parent = models._cached_get(parent_key)
       for index in child_indexes:
-        all_pipeline_keys.add(parent.fanned_out[index].urlsafe().decode())
+        all_pipeline_keys.add(parent.fanned_out[index])
 
     all_tasks = []
-    all_pipelines = ndb.get_multi([ndb.Key(urlsafe=pipeline_key) for pipeline_key in all_pipeline_keys])
+    all_pipelines = models._cached_get_multi(list(all_pipeline_keys))
     for child_pipeline in all_pipelines:
       if child_pipeline is None:
         continue
       pipeline_key = child_pipeline.key
       all_tasks.append(taskqueue.Task(
           url=context.pipeline_handler_path,
-          params=dict(pipeline_key=pipeline_key.urlsafe().decode()),
+          params=dict(pipeline_key=_encode_key(pipeline_key)),
           target=child_pipeline.params.get('target', None) if child_pipeline else None,
-          headers={'X-Ae-Pipeline-Key': pipeline_key.urlsafe().decode()},
+          headers={'X-Ae-Pipeline-Key': _encode_key(pipeline_key)},
           name='ae-pipeline-fan-out-' + child_pipeline.key.string_id()))
 
     batch_size = 100  # Limit of taskqueue API bulk add.
@@ -2603,53 +3864,184 @@ class _FanoutHandler(MethodView):
         taskqueue.Queue(context.queue_name).add(batch)
       except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError):
         pass
-    return "", 200
 
 
 class _CleanupHandler(MethodView):
-  """Request handler for cleaning up a Pipeline."""
+  """Request handler for cleaning up a Pipeline.
+
+  Cleanup deletes the entities of each kind in _CLEANUP_KINDS, then those
+  listed in the manifest, and then the Cloud Storage blobs of the root
+  pipeline, one step after the other. The kind steps are skipped for root
+  pipelines whose manifest lists all of their entities (see
+  _has_complete_manifest). Each
+  task works until its time budget is used up and then continues in a new
+  task from where it stopped. With _CLEANUP_SHARD_BY_KIND, every step runs in
+  its own chain of tasks instead.
+  """
 
   def post(self):
     if 'HTTP_X_APPENGINE_TASKNAME' not in request.environ:
       return abort(403)
 
-    root_pipeline_key = ndb.Key(urlsafe=request.values.get('root_pipeline_key'))
+    root_pipeline_key = _decode_key(
+        _PipelineRecord, request.values.get('root_pipeline_key'))
     logging.debug('Cleaning up root_pipeline_key=%r', root_pipeline_key.urlsafe().decode())
+    queue_name = request.headers.get('X-AppEngine-QueueName', 'default')
+
+    step = request.values.get('step')
+    if step is None:
+      _forget_abort_signal(root_pipeline_key)
+      steps = _CLEANUP_STEPS
+      if _has_complete_manifest(root_pipeline_key):
+        steps = steps[steps.index(_CLEANUP_MANIFEST_STEP):]
+      if _CLEANUP_SHARD_BY_KIND:
+        taskqueue.Queue(queue_name).add([
+            self._make_task(root_pipeline_key, step=step, sharded=1)
+            for step in steps])
+        return "", 200
+      step = steps[0]
+    sharded = bool(int(request.values.get('sharded', 0)))
+    cursor = request.values.get('cursor') or None
+    totals = dict(
+        (name, int(request.values.get(name, 0)))
+        for name in ('deleted_records', 'deleted_blobs', 'deleted_bytes'))
+    deadline = time.time() + _CLEANUP_TIME_BUDGET_SECONDS
 
-    # TODO(user): Accumulate all BlobKeys from _PipelineRecord and
-    # _SlotRecord entities and delete them.
-    pipeline_keys = (
-        _PipelineRecord.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key)
-        .fetch(keys_only=True)
-    )
-    ndb.delete_multi(pipeline_keys)
-    slot_keys = (
-        _SlotRecord.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key)
-        .fetch(keys_only=True)
-      )
-    ndb.delete_multi(slot_keys)
-    barrier_keys = (
-        _BarrierRecord.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key)
-        .fetch(keys_only=True)
-    )
-    ndb.delete_multi(barrier_keys)
-    status_keys = (
-        _StatusRecord.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key)
-        .fetch(keys_only=True)
-    )
-    ndb.delete_multi(status_keys)
-    barrier_index_keys = (
-        _BarrierIndex.query()
-        .filter(_PipelineRecord.root_pipeline == root_pipeline_key)
-        .fetch(keys_only=True)
-    )
-    ndb.delete_multi(barrier_index_keys)
+    while True:
+      if step == _CLEANUP_BLOBS_STEP:
+        done = self._delete_blobs(root_pipeline_key, deadline, totals)
+        cursor = None
+      elif step == _CLEANUP_MANIFEST_STEP:
+        done = self._delete_manifest(root_pipeline_key, deadline, totals)
+        cursor = None
+      else:
+        cursor = self._delete_records(
+            root_pipeline_key, _CLEANUP_KINDS[step], cursor, deadline, totals)
+        done = cursor is None
+      if done:
+        next_index = _CLEANUP_STEPS.index(step) + 1
+        if sharded or next_index == len(_CLEANUP_STEPS):
+          break
+        step = _CLEANUP_STEPS[next_index]
+      if time.time() >= deadline:
+        self._make_task(
+            root_pipeline_key, step=step, sharded=int(sharded),
+            cursor=cursor or '', **totals).add(queue_name=queue_name)
+        return "", 200
+
+    logging.info('Cleaned up root_pipeline_key=%r%s, deleted %d records, %d '
+                 'blobs and reclaimed %d bytes',
+                 root_pipeline_key.urlsafe().decode(),
+                 ' (%s)' % step if sharded else '',
+                 totals['deleted_records'], totals['deleted_blobs'],
+                 totals['deleted_bytes'])
     return "", 200
 
+  def _make_task(self, root_pipeline_key, **params):
+    """Returns a task that continues the cleanup of a root pipeline."""
+    params['root_pipeline_key'] = _encode_key(root_pipeline_key)
+    return taskqueue.Task(
+        url=request.path,
+        params=params,
+        headers={'X-Ae-Pipeline-Key': _encode_key(root_pipeline_key)})
+
+  def _delete_records(self, root_pipeline_key, model_class, cursor, deadline,
+                      totals):
+    """Deletes the entities of one kind page by page until the deadline.
+
+    Deletes of up to _CLEANUP_PARALLEL_BATCHES pages are in flight while the
+    next page is fetched.
+
+    Args:
+      root_pipeline_key: db.Key of the root pipeline being cleaned up.
+      model_class: The model class of the entities to delete.
+      cursor: Stringified Datastore cursor to resume from, or None.
+      deadline: Time after which no more pages should be fetched.
+      totals: Dictionary of counters; deleted_records is incremented.
+
+    Returns:
+      Stringified cursor to resume from in a new task, or None if all entities
+      of the kind have been deleted.
+    """
+    query = model_class.query(model_class.root_pipeline == root_pipeline_key)
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    pending = []
+    while True:
+      keys, start_cursor, more = query.fetch_page(
+          _CLEANUP_BATCH_SIZE, start_cursor=start_cursor, keys_only=True)
+      pending.append(ndb.delete_multi_async(keys))
+      totals['deleted_records'] += len(keys)
+      if len(pending) > _CLEANUP_PARALLEL_BATCHES:
+        for future in pending.pop(0):
+          future.get_result()
+      if not more or start_cursor is None or time.time() >= deadline:
+        break
+    for futures in pending:
+      for future in futures:
+        future.get_result()
+    if more and start_cursor is not None:
+      return start_cursor.urlsafe().decode()
+    return None
+
+  def _delete_manifest(self, root_pipeline_key, deadline, totals):
+    """Deletes the entities listed in a manifest, page by page, until the deadline.
+
+    The entities of up to _CLEANUP_PARALLEL_BATCHES pages are deleted
+    concurrently. Pages are deleted after their entities, so a failed task
+    leaves no entity behind that is not listed anymore.
+
+    Args:
+      root_pipeline_key: db.Key of the root pipeline being cleaned up.
+      deadline: Time after which no more pages should be fetched.
+      totals: Dictionary of counters; deleted_records is incremented.
+
+    Returns:
+      True if all pages of the manifest have been deleted.
+    """
+    query = _ManifestRecord.query(ancestor=root_pipeline_key)
+    while True:
+      pages = query.fetch(_CLEANUP_PARALLEL_BATCHES)
+      if not pages:
+        return True
+      futures = []
+      for page in pages:
+        status_keys = [
+            ndb.Key(_StatusRecord, key.string_id())
+            for key in page.entity_keys
+            if key.kind() == _PipelineRecord._get_kind()]
+        futures.extend(ndb.delete_multi_async(page.entity_keys + status_keys))
+        totals['deleted_records'] += len(page.entity_keys)
+      for future in futures:
+        future.get_result()
+      ndb.delete_multi([page.key for page in pages])
+      if time.time() >= deadline:
+        return False
+
+  def _delete_blobs(self, root_pipeline_key, deadline, totals):
+    """Deletes the blobs of a root pipeline until the deadline.
+
+    Blobs are only shared within the tree of a root pipeline, so none of them
+    are referenced anymore.
+
+    Args:
+      root_pipeline_key: db.Key of the root pipeline being cleaned up.
+      deadline: Time after which no more blobs should be listed.
+      totals: Dictionary of counters; deleted_blobs and deleted_bytes are
+        incremented.
+
+    Returns:
+      True if all blobs have been deleted.
+    """
+    while True:
+      deleted_blobs, deleted_bytes = delete_blobs_gcs(
+          root_pipeline_key.string_id(), max_blobs=_MAX_CLEANUP_BLOBS)
+      totals['deleted_blobs'] += deleted_blobs
+      totals['deleted_bytes'] += deleted_bytes
+      if _MAX_CLEANUP_BLOBS is None or deleted_blobs < _MAX_CLEANUP_BLOBS:
+        return True
+      if time.time() >= deadline:
+        return False
+
 
 class _CallbackHandler(MethodView):
   """Receives asynchronous callback requests from humans or tasks."""
@@ -2659,7 +4051,8 @@ class _CallbackHandler(MethodView):
 
   def get(self):
     try:
-      return self.run_callback()
+      with _recording_task_datastore_ops(), models._request_cache():
+        return self.run_callback()
     except _CallbackTaskError as e:
       logging.error(str(e))
       if 'HTTP_X_APPENGINE_TASKRETRYCOUNT' in request.environ:
@@ -2689,7 +4082,7 @@ class _CallbackHandler(MethodView):
       raise _CallbackTaskError('"pipeline_id" parameter missing.')
 
     pipeline_key = ndb.Key(_PipelineRecord, pipeline_id)
-    pipeline_record = pipeline_key.get()
+    pipeline_record = models._cached_get(pipeline_key)
     if pipeline_record is None:
       raise _CallbackTaskError(
           'Pipeline ID "%s" for callback does not exist.' % pipeline_id)
@@ -2768,6 +4161,17 @@ def _get_timestamp_ms(when):
   return int(ms_since_epoch)
 
 
+def _status_slot_key(slot_key):
+  """Returns the urlsafe form of a slot key encoded in params.
+
+  The status UI refers to slots by their urlsafe keys, whichever form the
+  params store them in.
+  """
+  if ':' not in slot_key:
+    return slot_key
+  return _decode_key(_SlotRecord, slot_key).urlsafe().decode()
+
+
 def _get_internal_status(pipeline_key=None,
                          pipeline_dict=None,
                          slot_dict=None,
@@ -2833,7 +4237,7 @@ def _get_internal_status(pipeline_key=None,
 
   params = pipeline_record.params
   root_pipeline_key = pipeline_record.root_pipeline
-  default_slot_key = ndb.Key(urlsafe=params['output_slots']['default'])
+  default_slot_key = _decode_key(_SlotRecord, params['output_slots']['default'])
   start_barrier_key = ndb.Key(
       _BarrierRecord, _BarrierRecord.START, parent=pipeline_key)
   finalize_barrier_key = ndb.Key(
@@ -2858,10 +4262,11 @@ def _get_internal_status(pipeline_key=None,
     'classPath': pipeline_record.class_path,
     'args': list(params['args']),
     'kwargs': params['kwargs'].copy(),
-    'outputs': params['output_slots'].copy(),
+    'outputs': dict((name, _status_slot_key(slot_key))
+                    for name, slot_key in params['output_slots'].items()),
     'children': [key.string_id() for key in pipeline_record.fanned_out],
     'queueName': params['queue_name'],
-    'afterSlotKeys': [key for key in params['after_all']],
+    'afterSlotKeys': [_status_slot_key(key) for key in params['after_all']],
     'currentAttempt': pipeline_record.current_attempt + 1,
     'maxAttempts': pipeline_record.max_attempts,
     'backoffSeconds': pipeline_record.params['backoff_seconds'],
@@ -2877,7 +4282,11 @@ def _get_internal_status(pipeline_key=None,
   for value_dict in itertools.chain(
       output['args'], iter(list(output['kwargs'].values()))):
     if 'slot_key' in value_dict:
-      value_dict['slotKey'] = value_dict.pop('slot_key')
+      value_dict['slotKey'] = _status_slot_key(value_dict.pop('slot_key'))
+    elif value_dict['type'] == 'gcs':
+      # Spilled values are not downloaded just to render the status page.
+      value_dict['value'] = '<%d bytes in %s>' % (
+          value_dict['size'], value_dict['blob_name'])
 
   # Figure out the pipeline's status.
   if pipeline_record.status in (_PipelineRecord.WAITING, _PipelineRecord.RUN):
@@ -3013,11 +4422,42 @@ def get_status_tree(root_pipeline_id):
       raise PipelineStatusError(
           'Could not find pipeline ID "%s"' % root_pipeline_id)
 
-  # Run all queries asynchronously.
-  queries = {}
-  for model in (_PipelineRecord, _SlotRecord, _BarrierRecord, _StatusRecord):
-    queries[model] = model.query().filter(
-        _PipelineRecord.root_pipeline == root_pipeline_key).fetch(1000)
+  if _has_complete_manifest(root_pipeline_key):
+    # Look up the entities listed in the manifest, up to the limit per kind.
+    keys_by_kind = dict(
+        (model._get_kind(), [])
+        for model in (_PipelineRecord, _SlotRecord, _BarrierRecord))
+    query = _ManifestRecord.query(ancestor=root_pipeline_key)
+    cursor = None
+    more = True
+    while more and any(len(keys) < _MAX_STATUS_TREE_ENTITIES
+                       for keys in keys_by_kind.values()):
+      pages, cursor, more = query.fetch_page(
+          _STATUS_TREE_MANIFEST_PAGES, start_cursor=cursor)
+      more = more and cursor is not None
+      for page in pages:
+        for key in page.entity_keys:
+          keys = keys_by_kind.get(key.kind())
+          if keys is not None and len(keys) < _MAX_STATUS_TREE_ENTITIES:
+            keys.append(key)
+    keys_by_kind[_StatusRecord._get_kind()] = [
+        ndb.Key(_StatusRecord, key.string_id())
+        for key in keys_by_kind.get(_PipelineRecord._get_kind(), [])]
+    futures = {}
+    for model in (_PipelineRecord, _SlotRecord, _BarrierRecord, _StatusRecord):
+      futures[model] = ndb.get_multi_async(
+          keys_by_kind.get(model._get_kind(), []))
+    queries = {}
+    for model, model_futures in futures.items():
+      queries[model] = [future.get_result() for future in model_futures]
+      queries[model] = [entity for entity in queries[model] if entity]
+  else:
+    # Run all queries asynchronously.
+    queries = {}
+    for model in (_PipelineRecord, _SlotRecord, _BarrierRecord, _StatusRecord):
+      queries[model] = model.query().filter(
+          _PipelineRecord.root_pipeline == root_pipeline_key).fetch(
+              _MAX_STATUS_TREE_ENTITIES)
 
   found_pipeline_dict = dict(
       (stage.key, stage) for stage in queries[_PipelineRecord])
@@ -3053,7 +4493,8 @@ def get_status_tree(root_pipeline_id):
         # be the filler.
         child_outputs = child_pipeline_record.params['output_slots']
         for output_slot_key in list(child_outputs.values()):
-          slot_filler_dict[ndb.Key(urlsafe=output_slot_key)] = child_pipeline_key
+          slot_filler_dict[_decode_key(_SlotRecord, output_slot_key)] = (
+              child_pipeline_key)
 
   output = {
     'rootPipelineId': root_pipeline_id,
@@ -3119,7 +4560,8 @@ def get_root_list(class_path=None, cursor=None, count=50):
 
   fetch_list = []
   for pipeline_record in root_list:
-    fetch_list.append(ndb.Key(urlsafe=pipeline_record.params['output_slots']['default']))
+    fetch_list.append(_decode_key(
+        _SlotRecord, pipeline_record.params['output_slots']['default']))
     fetch_list.append(ndb.Key(
         _BarrierRecord, _BarrierRecord.FINALIZE,
         parent=pipeline_record.key))
@@ -3163,6 +4605,25 @@ def get_root_list(class_path=None, cursor=None, count=50):
 
 ################################################################################
 
+def set_default_codec(codec_id):
+  """Sets the codec used to serialize new pipeline params and slot values.
+
+  Values are always decoded with the codec they were written with, so the
+  default may be changed at any time. Make sure every version of the app
+  that may run pipelines understands the codec before switching to it.
+
+  Args:
+    codec_id: The ID of a registered codec, such as util.JSON_CODEC or
+      util.BINARY_CODEC.
+
+  Raises:
+    ValueError if no codec with the given ID has been registered.
+  """
+  global _DEFAULT_CODEC
+  mr_util._get_codec(codec_id)
+  _DEFAULT_CODEC = codec_id
+
+
 def set_enforce_auth(new_status):
   """Sets whether Pipeline API handlers rely on app.yaml for access control.
 
@@ -3175,15 +4636,19 @@ def set_enforce_auth(new_status):
   _ENFORCE_AUTH = new_status
 
 
-def create_handlers_map(prefix='/_ah/pipeline'):
+def create_handlers_map(prefix='/_ah/pipeline', preload_class_paths=()):
   """Create new handlers map.
 
   Args:
     prefix: url prefix to use.
+    preload_class_paths: Class paths of the pipelines this app runs. Their
+      modules are imported right away instead of by the first task that
+      needs each of them.
 
   Returns:
     list of (regexp, handler) pairs for WSGIApplication constructor.
   """
+  mr_util.preload(preload_class_paths)
   return [
       (prefix + '/output', _BarrierHandler),
       (prefix + '/run', _PipelineHandler),
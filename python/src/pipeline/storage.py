@@ -1,22 +1,239 @@
+import collections
+import concurrent.futures
+import hashlib
 import logging
+import os
 import posixpath
+import random
+import tempfile
+import threading
 import time
 import uuid
 
-from google.api_core.exceptions import TooManyRequests
+import google.auth
+from google.api_core import exceptions
+from google.api_core.exceptions import PreconditionFailed, TooManyRequests
 from google.appengine.api import app_identity
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# Maximum number of HTTP connections kept open to Cloud Storage by the shared
+# client, so concurrent reads and writes do not have to reconnect.
+_CONNECTION_POOL_SIZE = 32
+
+# The process-wide client and default bucket handle, created on first use.
+_client = None
+_default_bucket = None
+_client_lock = threading.Lock()
+
+# Blob operation counters and their accumulated latencies, see get_stats().
+_STAT_NAMES = (
+    'reads', 'read_bytes', 'read_seconds',
+    'writes', 'write_bytes', 'write_seconds', 'reused_writes',
+    'deletes', 'delete_bytes', 'delete_seconds',
+    'cache_hits', 'cache_misses', 'cache_evictions',
+)
+_stats = dict.fromkeys(_STAT_NAMES, 0)
+_stats_lock = threading.Lock()
+
+# Maximum number of blobs downloaded at the same time by read_blobs_gcs().
+_MAX_PARALLEL_READS = 16
+
+_read_executor = None
+_read_executor_lock = threading.Lock()
+
+# Maximum number of blobs uploaded at the same time by write_json_gcs_async().
+_MAX_PARALLEL_WRITES = 16
+
+_write_executor = None
+_write_executor_lock = threading.Lock()
+
+# Uploads started by write_json_gcs_async() that have not finished yet, keyed
+# by blob name, so concurrent writes of the same value share one upload.
+_pending_writes = {}
+_pending_writes_lock = threading.Lock()
+
+# Upper bound of the randomized delay between retries of a throttled upload.
+_MAX_RETRY_DELAY_SECONDS = 32
+
+# Blobs are deleted in batch requests of at most this many blobs (the limit of
+# the JSON API), with several batches in flight on the write executor.
+_DELETE_BATCH_SIZE = 100
+
+# Size of the pieces in which streamed blobs are uploaded and downloaded. Must
+# be a multiple of 256 KiB for resumable uploads.
+_STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Downloaded and written blobs are kept in files under a temporary directory,
+# up to this many bytes in total, and evicted least recently used first. A
+# blob name never refers to different contents, so cached copies never go
+# stale. The temporary directory is held in memory on App Engine standard, so
+# the cache competes with the instance's memory; size it accordingly. None
+# disables the cache, which is the default; it must be enabled explicitly.
+_CACHE_MAX_BYTES = None
+
+_cache_dir = None
+_cache_index = collections.OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+def _cache_path(blob_name):
+  """Returns the path of the cache file for a blob, creating the cache dir."""
+  global _cache_dir
+  if _cache_dir is None:
+    _cache_dir = tempfile.mkdtemp(prefix='pipeline-blobs-')
+  return os.path.join(
+      _cache_dir, hashlib.sha256(blob_name.encode('utf-8')).hexdigest())
+
+
+def _cache_get(blob_name):
+  """Returns the cached contents of a blob as bytes, or None."""
+  if _CACHE_MAX_BYTES is None:
+    return None
+  with _cache_lock:
+    if blob_name in _cache_index:
+      _cache_index.move_to_end(blob_name)
+      path = _cache_path(blob_name)
+    else:
+      path = None
+  if path is None:
+    _add_stats(cache_misses=1)
+    return None
+
+  try:
+    with open(path, 'rb') as cache_file:
+      content = cache_file.read()
+  except OSError:
+    # Evicted by another thread in the meantime.
+    _cache_discard(blob_name)
+    _add_stats(cache_misses=1)
+    return None
+  _add_stats(cache_hits=1)
+  return content
+
+
+def _cache_put(blob_name, content):
+  """Saves the contents of a blob in the cache, evicting others if needed."""
+  global _cache_bytes
+  if _CACHE_MAX_BYTES is None or len(content) > _CACHE_MAX_BYTES:
+    return
+  with _cache_lock:
+    path = _cache_path(blob_name)
+  temp_path = '%s.%s' % (path, uuid.uuid4().hex)
+  with open(temp_path, 'wb') as cache_file:
+    cache_file.write(content)
+  os.replace(temp_path, path)
+
+  evicted = 0
+  with _cache_lock:
+    _cache_bytes -= _cache_index.pop(blob_name, 0)
+    _cache_index[blob_name] = len(content)
+    _cache_bytes += len(content)
+    while _cache_bytes > _CACHE_MAX_BYTES:
+      name, size = _cache_index.popitem(last=False)
+      _cache_bytes -= size
+      _remove_file(_cache_path(name))
+      evicted += 1
+  if evicted:
+    _add_stats(cache_evictions=evicted)
+
+
+def _cache_discard(blob_name):
+  """Removes a blob from the cache, if present."""
+  global _cache_bytes
+  with _cache_lock:
+    if blob_name in _cache_index:
+      _cache_bytes -= _cache_index.pop(blob_name)
+      _remove_file(_cache_path(blob_name))
+
+
+def _remove_file(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def _add_stats(**increments):
+  with _stats_lock:
+    for name, increment in increments.items():
+      _stats[name] += increment
+
+
+def get_stats():
+  """Returns the blob operation counters of this process.
+
+  Returns:
+    Dictionary with the number of blob reads, writes and deletes, the bytes
+    read and written, and the total seconds spent on each kind of operation.
+    Writes of a value that was already stored are counted as reused_writes.
+    Reads served from the on-instance cache are counted as cache_hits instead
+    of reads.
+  """
+  with _stats_lock:
+    return dict(_stats)
+
+
+def reset_stats():
+  """Resets the blob operation counters of this process to zero."""
+  with _stats_lock:
+    _stats.update(dict.fromkeys(_STAT_NAMES, 0))
+
+
+def _blob_directory(pipeline_id=None):
+  path_components = ["appengine_pipeline"]
+  if pipeline_id:
+    path_components.append(pipeline_id)
+  # Use posixpath to get a / even if we're running on windows somehow
+  return posixpath.join(*path_components)
+
+
+def _get_client():
+  """Returns the process-wide Cloud Storage client, creating it if needed.
+
+  The client sends its requests through an authorized session whose
+  connection pool is big enough for the concurrent reads and writes.
+  """
+  global _client
+  with _client_lock:
+    if _client is None:
+      credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+      session = AuthorizedSession(credentials)
+      session.mount("https://", HTTPAdapter(
+          pool_connections=_CONNECTION_POOL_SIZE,
+          pool_maxsize=_CONNECTION_POOL_SIZE))
+      _client = storage.Client(credentials=credentials, _http=session)
+    return _client
 
-client = storage.Client()
 
 def _get_default_bucket():
+  """Returns a handle on the default bucket, cached for the process.
+
+  The handle is created without fetching the bucket's metadata; requests on
+  its blobs fail if the bucket does not exist.
+  """
+  global _default_bucket
+  if _default_bucket is not None:
+    return _default_bucket
   default_bucket = app_identity.get_default_gcs_bucket_name()
   if default_bucket is None:
     raise Exception(
         "No default cloud storage bucket has been set for this application. "
         "This app was likely created before v1.9.0, please see: "
         "https://cloud.google.com/appengine/docs/php/googlestorage/setup")
-  return client.get_bucket(default_bucket)
+  bucket = _get_client().bucket(default_bucket)
+  with _client_lock:
+    if _default_bucket is None:
+      _default_bucket = bucket
+    return _default_bucket
+
+
+def _blob_name(content, pipeline_id=None):
+  """Returns the name of the blob holding the given bytes."""
+  return posixpath.join(
+      _blob_directory(pipeline_id), hashlib.sha256(content).hexdigest())
 
 
 def write_json_gcs(encoded_value, pipeline_id=None):
@@ -24,39 +241,122 @@ def write_json_gcs(encoded_value, pipeline_id=None):
 
   This function will store the blob in a GCS file in the default bucket under
   the appengine_pipeline directory. Optionally using another directory level
-  specified by pipeline_id
+  specified by pipeline_id. The file is named after the hash of its contents
+  so identical values written to the same directory share one file; the
+  pipeline passes its root pipeline ID so that all the files referenced by a
+  pipeline tree can be deleted together with it (see delete_blobs_gcs).
+
   Args:
     encoded_value: The encoded JSON string.
     pipeline_id: A pipeline id to segment files in Cloud Storage, if none,
       the file will be created under appengine_pipeline
 
   Returns:
-    The gcs blob name for the file that was created.
+    The gcs blob name for the file that was created or reused.
   """
-  path_components = ["appengine_pipeline"]
-  if pipeline_id:
-    path_components.append(pipeline_id)
-  path_components.append(uuid.uuid4().hex)
-  # Use posixpath to get a / even if we're running on windows somehow
-  file_name = posixpath.join(*path_components)
-
+  content = encoded_value
+  if isinstance(content, str):
+    content = content.encode('utf-8')
+  file_name = _blob_name(content, pipeline_id)
+  # The upload only creates the file if none exists with this name, which is
+  # what dedupes writes of the same value. Nothing is remembered across
+  # writes, since another instance may have deleted the file since.
   blob = _get_default_bucket().blob(file_name)
+  start = time.perf_counter()
   _MAX_RETRIES = 10
   for attempt in range(_MAX_RETRIES):
       try:
-          blob.upload_from_string(encoded_value, content_type='application/json')
+          # Only create the file when there is none with this content yet.
+          blob.upload_from_string(encoded_value, content_type='application/json',
+                                  if_generation_match=0)
+          _add_stats(writes=1, write_bytes=len(content),
+                     write_seconds=time.perf_counter() - start)
           break  # If the upload was successful, break the retry loop
+      except PreconditionFailed:
+          logging.debug("Reusing existing blob for filename = %s", file_name)
+          _add_stats(reused_writes=1,
+                     write_seconds=time.perf_counter() - start)
+          break
       except TooManyRequests:
           if attempt < _MAX_RETRIES - 1:  # If this isn't the last attempt
-              sleep_time = (2 ** attempt)  # Exponential backoff
+              # Exponential backoff with full jitter, so uploads throttled
+              # together do not all retry at the same time.
+              sleep_time = random.uniform(
+                  0, min(_MAX_RETRY_DELAY_SECONDS, 2 ** attempt))
               time.sleep(sleep_time)
           else:  # If this is the last attempt, re-raise the exception
               raise
 
+  _cache_put(file_name, content)
   logging.debug("Created blob for filename = %s gs_key = %s", file_name, blob.self_link)
   return blob.name
 
 
+def _get_write_executor():
+  """Returns the process-wide thread pool used to upload blobs."""
+  global _write_executor
+  with _write_executor_lock:
+    if _write_executor is None:
+      _write_executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=_MAX_PARALLEL_WRITES,
+          thread_name_prefix='pipeline-blob-write')
+    return _write_executor
+
+
+def write_json_gcs_async(encoded_value, pipeline_id=None):
+  """Starts writing a JSON encoded value to a Cloud Storage File.
+
+  Since files are named after their contents, the name is known before the
+  upload completes. The caller must wait for the returned future (see
+  wait_for_writes) before storing the name anywhere it may be read from.
+
+  Args:
+    encoded_value: The encoded JSON string.
+    pipeline_id: A pipeline id to segment files in Cloud Storage, see
+      write_json_gcs.
+
+  Returns:
+    Tuple (blob_name, future) where future resolves to the blob name once
+    the file has been written.
+  """
+  content = encoded_value
+  if isinstance(content, str):
+    content = content.encode('utf-8')
+  file_name = _blob_name(content, pipeline_id)
+  with _pending_writes_lock:
+    future = _pending_writes.get(file_name)
+    started = future is None
+    if started:
+      future = _get_write_executor().submit(
+          write_json_gcs, encoded_value, pipeline_id)
+      _pending_writes[file_name] = future
+  if started:
+    # Added outside of the lock, since the callback runs right away in this
+    # thread when the write already finished.
+    future.add_done_callback(lambda unused: _forget_pending_write(file_name))
+  return file_name, future
+
+
+def _forget_pending_write(file_name):
+  with _pending_writes_lock:
+    _pending_writes.pop(file_name, None)
+
+
+def wait_for_writes(futures):
+  """Waits for writes started by write_json_gcs_async to finish.
+
+  Args:
+    futures: Iterable of futures returned by write_json_gcs_async.
+
+  Raises:
+    The exception of the first failed write, after all of them finished.
+  """
+  futures = list(futures)
+  concurrent.futures.wait(futures)
+  for future in futures:
+    future.result()
+
+
 def read_blob_gcs(blob_name):
   """Reads a blob as bytes from a Cloud Storage File.
 
@@ -66,5 +366,158 @@ def read_blob_gcs(blob_name):
   Returns:
     The bytes of the blob.
   """
+  content = _cache_get(blob_name)
+  if content is not None:
+    return content
+  blob = _get_default_bucket().blob(blob_name)
+  start = time.perf_counter()
+  content = blob.download_as_bytes()
+  _add_stats(reads=1, read_bytes=len(content),
+             read_seconds=time.perf_counter() - start)
+  _cache_put(blob_name, content)
+  return content
+
+
+def _get_read_executor():
+  """Returns the process-wide thread pool used to download blobs."""
+  global _read_executor
+  with _read_executor_lock:
+    if _read_executor is None:
+      _read_executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=_MAX_PARALLEL_READS,
+          thread_name_prefix='pipeline-blob-read')
+    return _read_executor
+
+
+def read_blobs_gcs(blob_names):
+  """Reads many blobs as bytes from Cloud Storage Files concurrently.
+
+  Args:
+    blob_names: Iterable of the names of the blobs to read from.
+
+  Returns:
+    Dictionary mapping each blob name to the bytes of the blob.
+  """
+  blob_names = list(collections.OrderedDict.fromkeys(blob_names))
+  if len(blob_names) <= 1:
+    return {name: read_blob_gcs(name) for name in blob_names}
+  contents = _get_read_executor().map(read_blob_gcs, blob_names)
+  return dict(zip(blob_names, contents))
+
+
+def write_stream_gcs(chunks, pipeline_id=None):
+  """Writes a stream of chunks to a Cloud Storage File.
+
+  The chunks are sent with a resumable upload as they are produced, so only
+  about _STREAM_CHUNK_SIZE bytes of them are held in memory at a time. Since
+  the contents are not known in advance, the file is named randomly rather
+  than after its contents, and is never shared.
+
+  Args:
+    chunks: Iterable of bytes chunks to write.
+    pipeline_id: A pipeline id to segment files in Cloud Storage, see
+      write_json_gcs.
+
+  Returns:
+    The gcs blob name for the file that was created.
+  """
+  file_name = posixpath.join(_blob_directory(pipeline_id), uuid.uuid4().hex)
+  blob = _get_default_bucket().blob(file_name)
+  start = time.perf_counter()
+  size = 0
+  with blob.open('wb', chunk_size=_STREAM_CHUNK_SIZE,
+                 content_type='application/json') as stream:
+    for chunk in chunks:
+      stream.write(chunk)
+      size += len(chunk)
+  _add_stats(writes=1, write_bytes=size,
+             write_seconds=time.perf_counter() - start)
+  logging.debug("Streamed %d bytes to blob filename = %s", size, file_name)
+  return file_name
+
+
+def read_stream_gcs(blob_name):
+  """Reads a Cloud Storage File as a stream of chunks.
+
+  Args:
+    blob_name: The name of the blob to read from.
+
+  Yields:
+    The bytes of the blob, _STREAM_CHUNK_SIZE bytes at a time.
+  """
   blob = _get_default_bucket().blob(blob_name)
-  return blob.download_as_bytes()
+  start = time.perf_counter()
+  size = 0
+  with blob.open('rb', chunk_size=_STREAM_CHUNK_SIZE) as stream:
+    while True:
+      chunk = stream.read(_STREAM_CHUNK_SIZE)
+      if not chunk:
+        break
+      size += len(chunk)
+      yield chunk
+  _add_stats(reads=1, read_bytes=size,
+             read_seconds=time.perf_counter() - start)
+
+
+def _delete_batch(bucket, blobs):
+  """Deletes blobs with a single batch request.
+
+  Files that are already gone count as deleted.
+
+  Args:
+    bucket: The bucket holding the blobs.
+    blobs: The blobs to delete, at most _DELETE_BATCH_SIZE of them.
+
+  Raises:
+    google.api_core.exceptions.GoogleAPICallError if deleting a blob failed
+    for another reason.
+  """
+  batch = bucket.client.batch(raise_exception=False)
+  with batch:
+    for blob in blobs:
+      blob.delete()
+  # Without raise_exception, the batch keeps the response to every delete.
+  for response in batch._responses:
+    if (not 200 <= response.status_code < 300 and
+        response.status_code != 404):
+      raise exceptions.from_http_response(response)
+
+
+def delete_blobs_gcs(pipeline_id, max_blobs=None):
+  """Deletes the Cloud Storage Files written for a pipeline ID.
+
+  Files are shared by content only within the directory of a pipeline ID, so
+  once nothing references that pipeline ID anymore (e.g. its root pipeline has
+  been cleaned up) none of its files are referenced either.
+
+  Args:
+    pipeline_id: The pipeline id that was passed to write_json_gcs.
+    max_blobs: The maximum number of files to delete, or None to delete all of
+      them. Callers can delete the rest by calling again until fewer than
+      max_blobs files were deleted.
+
+  Returns:
+    Tuple (count, size) with the number of files deleted and their total size
+    in bytes.
+  """
+  prefix = _blob_directory(pipeline_id) + "/"
+  bucket = _get_default_bucket()
+  start = time.perf_counter()
+  blobs = list(bucket.list_blobs(prefix=prefix, max_results=max_blobs))
+  batches = [blobs[index:index + _DELETE_BATCH_SIZE]
+             for index in range(0, len(blobs), _DELETE_BATCH_SIZE)]
+  if len(batches) == 1:
+    _delete_batch(bucket, batches[0])
+  else:
+    futures = [_get_write_executor().submit(_delete_batch, bucket, batch)
+               for batch in batches]
+    for future in futures:
+      future.result()
+  size = sum(blob.size or 0 for blob in blobs)
+  _add_stats(deletes=len(blobs), delete_bytes=size,
+             delete_seconds=time.perf_counter() - start)
+  for blob in blobs:
+    _cache_discard(blob.name)
+  logging.debug("Deleted %d blobs (%d bytes) under %s",
+                len(blobs), size, prefix)
+  return len(blobs), size
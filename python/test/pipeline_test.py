@@ -19,10 +19,12 @@
 import base64
 import datetime
 import functools
+import hashlib
 import json
 import logging
 import os
 import pickle
+import random
 import sys
 import unittest
 import urllib.error
@@ -37,14 +39,17 @@ from flask import Flask
 from google.appengine.ext import ndb, testbed
 from google.appengine.api.datastore_errors import BadRequestError
 
-from pipeline import common, pipeline, storage, testing as test_shared
+from pipeline import common, pipeline, storage, util, testing as test_shared
 
 # For convenience.
 _BarrierIndex = pipeline.models._BarrierIndex
 _BarrierRecord = pipeline.models._BarrierRecord
+_ManifestRecord = pipeline.models._ManifestRecord
 _PipelineRecord = pipeline.models._PipelineRecord
 _SlotRecord = pipeline.models._SlotRecord
 _StatusRecord = pipeline.models._StatusRecord
+_decode_key = pipeline.models._decode_key
+_encode_key = pipeline.models._encode_key
 
 
 class TestBase(testutil.TestSetupMixin, unittest.TestCase):
@@ -64,15 +69,19 @@ class TestBase(testutil.TestSetupMixin, unittest.TestCase):
     ndb.get_context().clear_cache()
 
     self.storageData = {}
-    def _write_json_gcs(encoded_value, pipeline_id=None):
-      key = str(len(self.storageData))
-      self.storageData.update({key: encoded_value})
-      return key
-
-    pipeline.write_json_gcs = _write_json_gcs
-    pipeline.read_blob_gcs = lambda x: self.storageData.get(x)
-    storage.write_json_gcs = _write_json_gcs
-    storage.read_blob_gcs = lambda x: self.storageData.get(x)
+    self.bucket = testutil.FakeBucket(self.storageData)
+    # Cleanups also run for subclasses whose tearDown does not call ours.
+    self.addCleanup(setattr, storage, '_get_default_bucket',
+                    storage._get_default_bucket)
+    storage._get_default_bucket = lambda: self.bucket
+    pipeline._abort_signals.clear()
+    self.addCleanup(setattr, pipeline, '_ABORT_SIGNAL_TTL_SECONDS',
+                    pipeline._ABORT_SIGNAL_TTL_SECONDS)
+    pipeline.models._key_cache.clear()
+    pipeline.models._clear_params_cache()
+    self.addCleanup(setattr, storage, '_CACHE_MAX_BYTES',
+                    storage._CACHE_MAX_BYTES)
+    storage._CACHE_MAX_BYTES = None
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -408,7 +417,7 @@ class PipelineTest(TestBase):
     self.assertEqual(3, len(slot_dict))
 
     for outputs in list(params['output_slots'].values()):
-      slot_record = slot_dict[ndb.Key(urlsafe=outputs)]
+      slot_record = slot_dict[_decode_key(_SlotRecord, outputs)]
       self.assertEqual(_SlotRecord.WAITING, slot_record.status)
 
     # Verify that trying to add another output slot will fail.
@@ -424,7 +433,7 @@ class PipelineTest(TestBase):
     self.assertEqual(1, len(task_list))
     task = task_list[0]
     self.assertEqual(
-        {'pipeline_key': [ndb.Key(_PipelineRecord, stage.pipeline_id).urlsafe().decode()]},
+        {'pipeline_key': [_encode_key(ndb.Key(_PipelineRecord, stage.pipeline_id))]},
         task['params'])
     self.assertEqual('/_ah/pipeline/run', task['url'])
 
@@ -641,6 +650,98 @@ class PipelineTest(TestBase):
     self.assertEqual(big_data, other.outputs.one.value)
     self.assertEqual(small_data, other.outputs.two.value)
 
+  def testFillSlot_BinaryCodec(self):
+    """Tests filling slots with the binary codec and reading them back."""
+    stage = NothingPipeline('one', 'two', three='red', four=1234)
+    stage.start(queue_name='other', base_path='/other', idempotence_key='meep')
+    pipeline.set_default_codec(util.BINARY_CODEC)
+    try:
+      stage.fill(stage.outputs.one, {'raw': b'\x00\x01', 'key': stage._pipeline_key})
+    finally:
+      pipeline.set_default_codec(util.JSON_CODEC)
+    stage.fill(stage.outputs.two, 'blue')
+
+    one_record = stage.outputs.one.key.get()
+    self.assertEqual(util.BINARY_CODEC, one_record.value_codec)
+    self.assertEqual(None, one_record.value_text)
+    two_record = stage.outputs.two.key.get()
+    self.assertEqual(None, two_record.value_codec)
+    self.assertEqual(None, two_record.value_blob)
+
+    other = NothingPipeline.from_id(stage.pipeline_id)
+    self.assertEqual({'raw': b'\x00\x01', 'key': stage._pipeline_key},
+                     other.outputs.one.value)
+    self.assertEqual('blue', other.outputs.two.value)
+
+  def testFillSlot_Streamed(self):
+    """Tests filling slots with values that are streamed to blobs."""
+    stage = NothingPipeline('one', 'two', three='red', four=1234)
+    stage.start(queue_name='other', base_path='/other', idempotence_key='meep')
+    big_value = [{'index': index, 'when': datetime.datetime(2020, 1, 2)}
+                 for index in range(1000)]
+    old_stream_min_size = pipeline._STREAM_MIN_SIZE
+    pipeline._STREAM_MIN_SIZE = 1000
+    try:
+      stage.fill(stage.outputs.one, big_value)
+      stage.fill(stage.outputs.two, [1, 2, 3])
+    finally:
+      pipeline._STREAM_MIN_SIZE = old_stream_min_size
+
+    one_record = stage.outputs.one.key.get()
+    self.assertEqual(util.JSON_STREAM_CODEC, one_record.value_codec)
+    self.assertEqual(None, one_record.value_text)
+    self.assertTrue(one_record.value_gcs.startswith(
+        'appengine_pipeline/%s/' % stage.pipeline_id))
+    two_record = stage.outputs.two.key.get()
+    self.assertEqual(None, two_record.value_codec)
+    self.assertEqual(None, two_record.value_gcs)
+
+    other = NothingPipeline.from_id(stage.pipeline_id)
+    self.assertEqual(big_value, other.outputs.one.value)
+    self.assertEqual([1, 2, 3], other.outputs.two.value)
+
+  def testFillSlot_StreamedOnlyAsJson(self):
+    """Tests that values are not streamed with another default codec."""
+    stage = NothingPipeline('one', 'two', three='red', four=1234)
+    stage.start(queue_name='other', base_path='/other', idempotence_key='meep')
+    self.addCleanup(setattr, pipeline, '_STREAM_MIN_SIZE',
+                    pipeline._STREAM_MIN_SIZE)
+    pipeline._STREAM_MIN_SIZE = 10
+    pipeline.set_default_codec(util.BINARY_CODEC)
+    try:
+      stage.fill(stage.outputs.one, list(range(100)))
+    finally:
+      pipeline.set_default_codec(util.JSON_CODEC)
+
+    one_record = stage.outputs.one.key.get()
+    self.assertEqual(util.BINARY_CODEC, one_record.value_codec)
+    self.assertEqual(list(range(100)),
+                     NothingPipeline.from_id(stage.pipeline_id).outputs.one.value)
+
+  def testFillSlot_SmallNotStreamed(self):
+    """Tests that values below the stream size keep the plain encoding."""
+    stage = NothingPipeline('one', 'two', three='red', four=1234)
+    stage.start(queue_name='other', base_path='/other', idempotence_key='meep')
+    stage.fill(stage.outputs.one, [{'b': 1, 'a': 2}] * 3)
+
+    one_record = stage.outputs.one.key.get()
+    self.assertEqual(None, one_record.value_codec)
+    self.assertEqual(util.encode_value([{'a': 2, 'b': 1}] * 3, util.JSON_CODEC),
+                     one_record.value_text)
+
+  def testFillSlot_BlobsUnderRoot(self):
+    """Tests that big values are stored with the root's blobs."""
+    slot_key = ndb.Key(_SlotRecord, 'one')
+    _SlotRecord(key=slot_key,
+                root_pipeline=ndb.Key(_PipelineRecord, 'root')).put()
+    context = pipeline._PipelineContext('', 'default', '/base-path')
+    context.fill_slot(ndb.Key(_PipelineRecord, 'filler'),
+                      pipeline.Slot(name='one', slot_key=slot_key),
+                      base64.b64encode(
+                          random.Random(1234).randbytes(1000000)).decode())
+    self.assertTrue(slot_key.get().value_gcs.startswith(
+        'appengine_pipeline/root/'))
+
   def testFillSlotErrors(self):
     """Tests errors that happen when filling slots."""
     stage = NothingPipeline('one', 'two', three='red', four=1234)
@@ -1039,9 +1140,28 @@ class GenerateArgs(pipeline.Pipeline):
     pass
 
 
+class CustomInitArgs(pipeline.Pipeline):
+  """Pipeline that looks at its argument in __init__."""
+
+  def __init__(self, value, **kwargs):
+    super().__init__(value, **kwargs)
+    self.value_size = len(value)
+
+  def run(self, value):
+    pass
+
+
 class UtilitiesTest(TestBase):
   """Tests for module-level utilities."""
 
+  def _spill_args(self, max_json_size=None):
+    """Enables spilling of arguments, optionally for smaller params."""
+    for name in ('_MAX_INLINE_ARG_SIZE', '_MAX_JSON_SIZE'):
+      self.addCleanup(setattr, pipeline, name, getattr(pipeline, name))
+    pipeline._MAX_INLINE_ARG_SIZE = 65536
+    if max_json_size is not None:
+      pipeline._MAX_JSON_SIZE = max_json_size
+
   def testDereferenceArgsNotFilled(self):
     """Tests when an argument was not filled."""
     slot_key = ndb.Key(_SlotRecord, 'myslot')
@@ -1049,6 +1169,38 @@ class UtilitiesTest(TestBase):
     self.assertRaises(pipeline.SlotNotFilledError,
         pipeline._dereference_args, 'foo', args, {})
 
+  def testDereferenceArgsSpilledSlots(self):
+    """Tests that spilled slot values are downloaded in one batch."""
+    self._spill_args()
+    args = []
+    for index in range(5):
+      slot_record = _SlotRecord(
+          key=ndb.Key(_SlotRecord, 'slot%d' % index),
+          status=_SlotRecord.FILLED,
+          value_gcs=storage.write_json_gcs(json.dumps(index), 'root'))
+      slot_record.put()
+      args.append({'type': 'slot',
+                   'slot_key': slot_record.key.urlsafe().decode()})
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    args.append(pipeline._encode_arg_value(big_value, 'root'))
+
+    reads = []
+    old_read_blobs_gcs = pipeline.read_blobs_gcs
+    def _read_blobs_gcs(blob_names):
+      reads.append(list(blob_names))
+      return old_read_blobs_gcs(blob_names)
+    pipeline.read_blobs_gcs = _read_blobs_gcs
+    try:
+      arg_list, _ = pipeline._dereference_args('foo', args, {})
+    finally:
+      pipeline.read_blobs_gcs = old_read_blobs_gcs
+
+    self.assertEqual([0, 1, 2, 3, 4, big_value], arg_list)
+    self.assertEqual(1, len(reads))
+    self.assertEqual(6, len(reads[0]))
+    self.assertEqual(6, len(self.bucket.downloads))
+
   def testDereferenceArgsBadType(self):
     """Tests when a positional argument has a bad type."""
     self.assertRaises(pipeline.UnexpectedPipelineError,
@@ -1079,7 +1231,7 @@ class UtilitiesTest(TestBase):
     stage = GenerateArgs(future.one, 'some value', future,
                          red=1234, blue=future.two)
     (dependent_slots, output_slot_keys,
-     params_text, params_gcs) = pipeline._generate_args(
+     params_properties) = pipeline._generate_args(
         stage,
         other_future,
         'my-queue',
@@ -1093,44 +1245,60 @@ class UtilitiesTest(TestBase):
              other_future.default.key]),
         output_slot_keys)
 
-    self.assertEqual(None, params_gcs)
-    params = json.loads(params_text)
+    self.assertEqual(None, params_properties['params_gcs'])
+    self.assertEqual(None, params_properties['params_blob'])
+    self.assertEqual(None, params_properties['params_codec'])
+    params = json.loads(params_properties['params_text'])
     self.assertEqual(
         {
             'queue_name': 'my-queue',
-            'after_all': [future.default.key.urlsafe().decode()],
+            'after_all': [_encode_key(future.default.key)],
             'class_path': '{}.GenerateArgs'.format(__name__),
             'args': [
-                {'slot_key': future.one.key.urlsafe().decode(),
+                {'slot_key': _encode_key(future.one.key),
                  'type': 'slot'},
                 {'type': 'value', 'value': 'some value'},
-                {'slot_key': future.default.key.urlsafe().decode(),
+                {'slot_key': _encode_key(future.default.key),
                  'type': 'slot'}
             ],
             'base_path': '/base-path',
             'kwargs': {
-                'blue': {'slot_key': future.two.key.urlsafe().decode(),
+                'blue': {'slot_key': _encode_key(future.two.key),
                          'type': 'slot'},
                 'red': {'type': 'value', 'value': 1234}
             },
             'output_slots': {
-                'default': other_future.default.key.urlsafe().decode(),
-                'four': other_future.four.key.urlsafe().decode(),
-                'three': other_future.three.key.urlsafe().decode()
+                'default': _encode_key(other_future.default.key),
+                'four': _encode_key(other_future.four.key),
+                'three': _encode_key(other_future.three.key)
             },
             'max_attempts': 3,
             'backoff_factor': 2,
             'backoff_seconds': 15,
             'task_retry': False,
             'target': 'my-version.foo-module',
+            'id_allocation': 'uuid',
         }, params)
 
-    # When the parameters are big enough we need an external blob.
-    stage = GenerateArgs(future.one, 'some value' * 1000000, future,
+    # When the parameters are too big for the entity, they go to an external
+    # blob as a whole.
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(1500000)).decode()
+    stage = GenerateArgs(future.one, big_value, future,
                          red=1234, blue=future.two)
+    _, _, params_properties = pipeline._generate_args(
+        stage, other_future, 'my-queue', '/base-path')
+    self.assertEqual(None, params_properties['params_text'])
+    params = json.loads(self.storageData[params_properties['params_gcs']])
+    self.assertEqual({'type': 'value', 'value': big_value}, params['args'][1])
+    self.storageData.clear()
+
+    # With spilling enabled, only the argument too big to keep inline gets an
+    # external blob. The rest of the parameters stay inline.
+    self._spill_args()
 
     (dependent_slots, output_slot_keys,
-     params_text, params_gcs) = pipeline._generate_args(
+     params_properties) = pipeline._generate_args(
         stage,
         other_future,
         'my-queue',
@@ -1144,12 +1312,215 @@ class UtilitiesTest(TestBase):
              other_future.default.key]),
         output_slot_keys)
 
-    self.assertEqual(None, params_text)
+    self.assertEqual(None, params_properties['params_gcs'])
+    self.assertEqual(None, params_properties['params_blob'])
+
+    params = json.loads(params_properties['params_text'])
+    self.assertEqual('my-version.foo-module', params['target'])
+    self.assertEqual({'type': 'value', 'value': 1234},
+                     params['kwargs']['red'])
+    spilled = params['args'][1]
+    self.assertEqual('gcs', spilled['type'])
+    self.assertEqual(None, spilled['codec'])
+    blob = self.storageData.get(spilled['blob_name'])
+    self.assertEqual(len(blob), spilled['size'])
+    self.assertEqual(big_value, json.loads(util.decompress_encoded(blob)))
+
+  def testGenerateArgsInlineUnlessTooBig(self):
+    """Tests that big arguments stay inline while the params fit."""
+    self._spill_args()
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    stage = GenerateArgs(big_value)
+    _, _, params_properties = pipeline._generate_args(
+        stage, pipeline.PipelineFuture([]), 'my-queue', '/base-path')
+    self.assertEqual({}, self.storageData)
+    self.assertEqual(
+        {'type': 'value', 'value': big_value},
+        json.loads(params_properties['params_text'])['args'][0])
 
-    blob = self.storageData.get(params_gcs)
-    params = json.loads(blob)
+  def testGenerateArgsSpilledArgs(self):
+    """Tests that spilled arguments are only read when dereferenced."""
+    self._spill_args(max_json_size=200000)
+    future = pipeline.PipelineFuture([])
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    stage = GenerateArgs('small', big_value, other=big_value)
+    _, _, params_properties = pipeline._generate_args(
+        stage, future, 'my-queue', '/base-path')
+    self.assertEqual(1, len(self.storageData))
+
+    pipeline_record = _PipelineRecord(**params_properties)
+    params = pipeline_record.params
+    self.assertEqual({'type': 'value', 'value': 'small'}, params['args'][0])
+    self.assertEqual('gcs', params['args'][1]['type'])
+    self.assertEqual('gcs', params['kwargs']['other']['type'])
+
+    self.assertEqual('my-queue', pipeline_record.params['queue_name'])
+    self.assertEqual([], self.bucket.downloads)
+
+    args, kwargs = pipeline._dereference_args(
+        'foo', params['args'], params['kwargs'])
+    self.assertEqual(['small', big_value], args)
+    self.assertEqual({'other': big_value}, kwargs)
+    self.assertEqual(1, len(self.bucket.downloads))
+
+  def testGenerateArgsEncodesOnce(self):
+    """Tests that small params are encoded in a single pass."""
+    encodings = []
+    old_encode_value = util.encode_value
+    def _encode_value(value, codec):
+      encodings.append(value)
+      return old_encode_value(value, codec)
+    self.addCleanup(setattr, util, 'encode_value', old_encode_value)
+    util.encode_value = _encode_value
+
+    stage = GenerateArgs('small', [1, 2, 3], other={'a': 'b'})
+    _, _, params_properties = pipeline._generate_args(
+        stage, pipeline.PipelineFuture([]), 'my-queue', '/base-path')
+    self.assertEqual(1, len(encodings))
+    self.assertEqual(
+        {'type': 'value', 'value': {'a': 'b'}},
+        json.loads(params_properties['params_text'])['kwargs']['other'])
+
+  def testFromIdDefersSpilledArgs(self):
+    """Tests that from_id downloads spilled arguments on first access."""
+    self._spill_args(max_json_size=200000)
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    stage = GenerateArgs('small', big_value, other=big_value)
+    _, _, params_properties = pipeline._generate_args(
+        stage, pipeline.PipelineFuture(GenerateArgs.output_names), 'my-queue',
+        '/base-path')
+    pipeline_record = _PipelineRecord(
+        id='one', class_path=GenerateArgs._class_path, **params_properties)
+    pipeline_record.root_pipeline = pipeline_record.key
+    pipeline_record.put()
 
-    self.assertEqual('some value' * 1000000, params['args'][1]['value'])
+    stage = GenerateArgs.from_id('one', resolve_outputs=False)
+    repr(stage)
+    self.assertEqual([], self.bucket.downloads)
+    self.assertEqual(('small', big_value), stage.args)
+    self.assertEqual({'other': big_value}, stage.kwargs)
+    self.assertEqual(1, len(self.bucket.downloads))
+
+  def testFromIdCustomInit(self):
+    """Tests that __init__ overrides get spilled arguments downloaded."""
+    self._spill_args(max_json_size=100000)
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    stage = CustomInitArgs(big_value)
+    _, _, params_properties = pipeline._generate_args(
+        stage, pipeline.PipelineFuture(CustomInitArgs.output_names),
+        'my-queue', '/base-path')
+    pipeline_record = _PipelineRecord(
+        id='one', class_path=CustomInitArgs._class_path, **params_properties)
+    pipeline_record.root_pipeline = pipeline_record.key
+    pipeline_record.put()
+
+    stage = CustomInitArgs.from_id('one', resolve_outputs=False)
+    self.assertEqual(len(big_value), stage.value_size)
+    self.assertEqual((big_value,), stage.args)
+    self.assertEqual(1, len(self.bucket.downloads))
+
+  def testGenerateArgsPendingWrites(self):
+    """Tests that big parameters may be uploaded in the background."""
+    self._spill_args(max_json_size=100000)
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    pending_writes = []
+    stage = GenerateArgs(big_value)
+    _, _, params_properties = pipeline._generate_args(
+        stage, pipeline.PipelineFuture([]), 'my-queue', '/base-path',
+        pending_writes=pending_writes)
+    self.assertEqual(1, len(pending_writes))
+    storage.wait_for_writes(pending_writes)
+
+    blob_name = json.loads(
+        params_properties['params_text'])['args'][0]['blob_name']
+    self.assertEqual(big_value, json.loads(util.decompress_encoded(
+        self.storageData[blob_name])))
+
+  def testGenerateArgsSharedBlob(self):
+    """Tests that children of a root pipeline share identical big values."""
+    self._spill_args(max_json_size=100000)
+    root_pipeline_key = ndb.Key(_PipelineRecord, 'root')
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(100000)).decode()
+    names = set()
+    for unused in range(3):
+      stage = GenerateArgs(big_value)
+      _, _, params_properties = pipeline._generate_args(
+          stage, pipeline.PipelineFuture([]), 'my-queue', '/base-path',
+          root_pipeline_key=root_pipeline_key)
+      params = json.loads(params_properties['params_text'])
+      names.add(params['args'][0]['blob_name'])
+
+    self.assertEqual(1, len(names))
+    self.assertTrue(names.pop().startswith('appengine_pipeline/root/'))
+    self.assertEqual(1, len(self.bucket.uploads))
+
+  def testGenerateArgsCompressed(self):
+    """Tests that big but compressible parameters stay in the entity."""
+    self.addCleanup(setattr, pipeline, '_COMPRESS_MIN_SIZE',
+                    pipeline._COMPRESS_MIN_SIZE)
+    pipeline._COMPRESS_MIN_SIZE = 16384
+    future = pipeline.PipelineFuture([])
+    stage = GenerateArgs('some value' * 500000)
+    _, _, params_properties = pipeline._generate_args(
+        stage, future, 'my-queue', '/base-path')
+
+    self.assertEqual(None, params_properties['params_text'])
+    self.assertEqual(None, params_properties['params_gcs'])
+    self.assertEqual([], list(self.storageData))
+    blob = params_properties['params_blob']
+    self.assertTrue(blob.startswith(util._COMPRESSED_HEADER))
+    self.assertLess(len(blob), pipeline._MAX_JSON_SIZE)
+
+    pipeline_record = _PipelineRecord(**params_properties)
+    self.assertEqual(
+        'some value' * 500000,
+        pipeline_record.params['args'][0]['value'])
+
+  def testGenerateArgsCompressionDisabled(self):
+    """Tests that compression is off by default, for older readers."""
+    future = pipeline.PipelineFuture([])
+    stage = GenerateArgs('some value' * 5000)
+    _, _, params_properties = pipeline._generate_args(
+        stage, future, 'my-queue', '/base-path')
+    self.assertEqual(None, params_properties['params_blob'])
+    self.assertEqual(
+        'some value' * 5000,
+        json.loads(params_properties['params_text'])['args'][0]['value'])
+
+  def testGenerateArgsBinaryCodec(self):
+    """Tests generating a parameter dictionary with the binary codec."""
+    future = pipeline.PipelineFuture([])
+    stage = GenerateArgs(b'\x00\xff', datetime.datetime(2020, 1, 2, 3, 4, 5))
+    pipeline.set_default_codec(util.BINARY_CODEC)
+    try:
+      _, _, params_properties = pipeline._generate_args(
+          stage, future, 'my-queue', '/base-path')
+    finally:
+      pipeline.set_default_codec(util.JSON_CODEC)
+
+    self.assertEqual(None, params_properties['params_text'])
+    self.assertEqual(None, params_properties['params_gcs'])
+    self.assertEqual(util.BINARY_CODEC, params_properties['params_codec'])
+
+    pipeline_record = _PipelineRecord(**params_properties)
+    pipeline_record.put()
+    params = pipeline_record.key.get().params
+    self.assertEqual(
+        [{'type': 'value', 'value': b'\x00\xff'},
+         {'type': 'value', 'value': datetime.datetime(2020, 1, 2, 3, 4, 5)}],
+        params['args'])
+    self.assertEqual('my-queue', params['queue_name'])
+
+  def testSetDefaultCodecUnknown(self):
+    """Tests that only registered codecs may become the default."""
+    self.assertRaises(ValueError, pipeline.set_default_codec, 'bogus')
+    self.assertEqual(util.JSON_CODEC, pipeline._DEFAULT_CODEC)
 
   def testShortRepr(self):
     """Tests for the _short_repr function."""
@@ -1165,6 +1536,49 @@ class UtilitiesTest(TestBase):
         pipeline._short_repr(my_dict))
 
 
+class BlobRefTest(TestBase):
+  """Tests for the BlobRef class."""
+
+  def testCreateAndOpen(self):
+    """Tests that a BlobRef is only downloaded when opened."""
+    value = {'big': ['value'] * 10000}
+    ref = pipeline.BlobRef.create(value, 'root')
+    self.assertTrue(ref.blob_name.startswith('appengine_pipeline/root/'))
+    self.assertEqual(len(self.storageData[ref.blob_name]), ref.size)
+    self.assertEqual([], self.bucket.downloads)
+    self.assertEqual(value, ref.open())
+    self.assertEqual(1, len(self.bucket.downloads))
+
+  def testCreateNeedsRoot(self):
+    """Tests that a root pipeline ID is required outside of pipelines."""
+    self.assertRaises(pipeline.PipelineSetupError,
+                      pipeline.BlobRef.create, 'value')
+    with pipeline._running_under_root(ndb.Key(_PipelineRecord, 'root')):
+      ref = pipeline.BlobRef.create('value')
+    self.assertTrue(ref.blob_name.startswith('appengine_pipeline/root/'))
+
+  def testSerialization(self):
+    """Tests that only the reference is serialized, with every codec."""
+    ref = pipeline.BlobRef.create('value', 'root')
+    for codec in (util.JSON_CODEC, util.BINARY_CODEC):
+      encoded = util.encode_value([ref], codec)
+      self.assertLess(len(encoded), 200)
+      decoded = util.decode_value(encoded, codec)[0]
+      self.assertEqual(ref, decoded)
+      self.assertEqual(ref.size, decoded.size)
+    self.assertEqual([], self.bucket.downloads)
+
+  def testBinaryCodec(self):
+    """Tests that values stored with the binary codec are decoded with it."""
+    pipeline.set_default_codec(util.BINARY_CODEC)
+    try:
+      ref = pipeline.BlobRef.create(b'\x00\x01', 'root')
+    finally:
+      pipeline.set_default_codec(util.JSON_CODEC)
+    self.assertEqual(util.BINARY_CODEC, ref.codec)
+    self.assertEqual(b'\x00\x01', ref.open())
+
+
 class PipelineContextTest(TestBase):
   """Tests for the internal _PipelineContext class."""
 
@@ -1266,20 +1680,20 @@ class PipelineContextTest(TestBase):
     first_task, second_task, continuation_task = task_list
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline1_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline1_key)],
          'purpose': [_BarrierRecord.FINALIZE]},
         first_task['params'])
     self.assertEqual('/base-path/finalized', first_task['url'])
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline3_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline3_key)],
          'purpose': [_BarrierRecord.START]},
         second_task['params'])
     self.assertEqual('/base-path/run', second_task['url'])
 
     self.assertEqual('/base-path/output', continuation_task['url'])
     self.assertEqual(
-        [self.slot1_key.urlsafe().decode()], continuation_task['params']['slot_key'])
+        [_encode_key(self.slot1_key)], continuation_task['params']['slot_key'])
     self.assertEqual(
         'my-task1-ae-barrier-notify-0',
         continuation_task['name'])
@@ -1335,14 +1749,14 @@ class PipelineContextTest(TestBase):
     third_task, continuation2_task = task_list
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline5_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline5_key)],
          'purpose': [_BarrierRecord.START]},
         third_task['params'])
     self.assertEqual('/base-path/run', third_task['url'])
 
     self.assertEqual('/base-path/output', continuation2_task['url'])
     self.assertEqual(
-        [self.slot1_key.urlsafe().decode()], continuation2_task['params']['slot_key'])
+        [_encode_key(self.slot1_key)], continuation2_task['params']['slot_key'])
     self.assertEqual(
         'my-task1-ae-barrier-notify-1',
         continuation2_task['name'])
@@ -1391,6 +1805,45 @@ class PipelineContextTest(TestBase):
           use_barrier_indexes=True,
           max_to_notify=3)
 
+  def testNotifyBarrierFire_AfterGate(self):
+    """Tests that a fired After() gate fills its gate slot."""
+    gate_slot_key = ndb.Key(_SlotRecord, 'gate')
+    gate_entities = pipeline._PipelineContext._create_barrier_entities(
+        self.pipeline1_key,
+        self.pipeline1_key,
+        'gate-gate',
+        [self.slot1_key, self.slot4_key])
+    gate_entities[0].gate_slot = gate_slot_key
+    ndb.put_multi(gate_entities + [
+        self.slot1, self.slot4, _SlotRecord(key=gate_slot_key)])
+
+    self.context.notify_barriers(
+        self.slot1_key,
+        None,
+        use_barrier_indexes=True,
+        max_to_notify=3)
+
+    gate_slot = gate_slot_key.get()
+    self.assertEqual(_SlotRecord.FILLED, gate_slot.status)
+    self.assertEqual(self.pipeline1_key, gate_slot.filler)
+    self.assertEqual(None, gate_slot.value)
+    self.assertEqual(_BarrierRecord.FIRED, gate_entities[0].key.get().status)
+
+    task_list = test_shared.get_tasks()
+    test_shared.delete_tasks(task_list)
+    self.assertEqual(1, len(task_list))
+    self.assertEqual('/base-path/output', task_list[0]['url'])
+    self.assertEqual(
+        [_encode_key(gate_slot_key)], task_list[0]['params']['slot_key'])
+
+    # Notifying again does not refill the gate.
+    self.context.notify_barriers(
+        self.slot4_key,
+        None,
+        use_barrier_indexes=True,
+        max_to_notify=3)
+    self.assertEqual(0, len(test_shared.get_tasks()))
+
   def testNotifyBarrierFire_NoBarrierIndexes(self):
     """Tests barrier firing behavior without using _BarrierIndexes."""
     self.assertEqual(_BarrierRecord.WAITING, self.barrier1.status)
@@ -1414,20 +1867,20 @@ class PipelineContextTest(TestBase):
     first_task, second_task, continuation_task = task_list
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline1_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline1_key)],
          'purpose': [_BarrierRecord.FINALIZE]},
         first_task['params'])
     self.assertEqual('/base-path/finalized', first_task['url'])
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline3_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline3_key)],
          'purpose': [_BarrierRecord.START]},
         second_task['params'])
     self.assertEqual('/base-path/run', second_task['url'])
 
     self.assertEqual('/base-path/output', continuation_task['url'])
     self.assertEqual(
-        [self.slot1_key.urlsafe().decode()], continuation_task['params']['slot_key'])
+        [_encode_key(self.slot1_key)], continuation_task['params']['slot_key'])
     self.assertEqual(
         'my-task1-ae-barrier-notify-0',
         continuation_task['name'])
@@ -1483,14 +1936,14 @@ class PipelineContextTest(TestBase):
     third_task, continuation2_task = task_list
 
     self.assertEqual(
-        {'pipeline_key': [self.pipeline5_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline5_key)],
          'purpose': [_BarrierRecord.START]},
         third_task['params'])
     self.assertEqual('/base-path/run', third_task['url'])
 
     self.assertEqual('/base-path/output', continuation2_task['url'])
     self.assertEqual(
-        [self.slot1_key.urlsafe().decode()], continuation2_task['params']['slot_key'])
+        [_encode_key(self.slot1_key)], continuation2_task['params']['slot_key'])
     self.assertEqual(
         'my-task1-ae-barrier-notify-1',
         continuation2_task['name'])
@@ -1613,7 +2066,7 @@ class PipelineContextTest(TestBase):
 
     self.assertEqual('/base-path/fanout_abort', task_list[0]['url'])
     self.assertEqual(
-        {'root_pipeline_key': [self.pipeline5_key.urlsafe().decode()]},
+        {'root_pipeline_key': [_encode_key(self.pipeline5_key)]},
         task_list[0]['params'])
 
   def testTransitionRetryTaskParams(self):
@@ -1659,7 +2112,7 @@ class PipelineContextTest(TestBase):
       self.assertEqual('/base-path/run', task['url'])
       self.assertEqual(
           {
-              'pipeline_key': [self.pipeline1_key.urlsafe().decode()],
+              'pipeline_key': [_encode_key(self.pipeline1_key)],
               'attempt': [str(attempt + 1)],
               'purpose': ['start']
           }, task['params'])
@@ -1683,7 +2136,7 @@ class PipelineContextTest(TestBase):
 
     self.assertEqual('/base-path/fanout_abort', task_list[0]['url'])
     self.assertEqual(
-        {'root_pipeline_key': [self.pipeline5_key.urlsafe().decode()]},
+        {'root_pipeline_key': [_encode_key(self.pipeline5_key)]},
         task_list[0]['params'])
 
   def testBeginAbortMissing(self):
@@ -1755,7 +2208,7 @@ class PipelineContextTest(TestBase):
 
     self.assertEqual('/base-path/fanout_abort', task_list[0]['url'])
     self.assertEqual(
-        {'root_pipeline_key': [self.pipeline1_key.urlsafe().decode()]},
+        {'root_pipeline_key': [_encode_key(self.pipeline1_key)]},
         task_list[0]['params'])
 
   def testContinueAbort(self):
@@ -1807,14 +2260,14 @@ class PipelineContextTest(TestBase):
     # Abort for the first pipeline
     self.assertEqual('/base-path/abort', first_task['url'])
     self.assertEqual(
-        {'pipeline_key': [self.pipeline1_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline1_key)],
          'purpose': ['abort']},
         first_task['params'])
 
     # Abort for the second pipeline
     self.assertEqual('/base-path/abort', second_task['url'])
     self.assertEqual(
-        {'pipeline_key': [self.pipeline2_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline2_key)],
          'purpose': ['abort']},
         second_task['params'])
 
@@ -1822,7 +2275,7 @@ class PipelineContextTest(TestBase):
     self.assertEqual('/base-path/fanout_abort', continuation_task['url'])
     self.assertEqual(set(['cursor', 'root_pipeline_key']),
                       set(continuation_task['params'].keys()))
-    self.assertEqual(self.pipeline1_key.urlsafe().decode(),
+    self.assertEqual(_encode_key(self.pipeline1_key),
                       continuation_task['params']['root_pipeline_key'][0])
     self.assertTrue(continuation_task['name'].endswith('-0'))
     cursor = continuation_task['params']['cursor'][0]
@@ -1842,7 +2295,7 @@ class PipelineContextTest(TestBase):
     # Abort for the third pipeline
     self.assertEqual('/base-path/abort', fifth_task['url'])
     self.assertEqual(
-        {'pipeline_key': [self.pipeline3_key.urlsafe().decode()],
+        {'pipeline_key': [_encode_key(self.pipeline3_key)],
          'purpose': ['abort']},
         fifth_task['params'])
 
@@ -1852,7 +2305,7 @@ class PipelineContextTest(TestBase):
     self.assertEqual(set(['cursor', 'root_pipeline_key']),
                       set(second_continuation_task['params'].keys()))
     self.assertEqual(
-        self.pipeline1_key.urlsafe().decode(),
+        _encode_key(self.pipeline1_key),
         second_continuation_task['params']['root_pipeline_key'][0])
     self.assertTrue(second_continuation_task['name'].endswith('-1'))
     cursor2 = second_continuation_task['params']['cursor'][0]
@@ -1874,7 +2327,7 @@ class PipelineContextTest(TestBase):
     self.assertEqual(set(['cursor', 'root_pipeline_key']),
                       set(third_continuation_task['params'].keys()))
     self.assertEqual(
-        self.pipeline1_key.urlsafe().decode(),
+        _encode_key(self.pipeline1_key),
         third_continuation_task['params']['root_pipeline_key'][0])
     self.assertTrue(third_continuation_task['name'].endswith('-2'))
     cursor3 = third_continuation_task['params']['cursor'][0]
@@ -1889,6 +2342,71 @@ class PipelineContextTest(TestBase):
     test_shared.delete_tasks(task_list)
     self.assertEqual(0, len(task_list))
 
+  def _continue_abort_manifest(self, max_to_notify):
+    """Aborts through a three page manifest; returns the tasks per call."""
+    self.addCleanup(setattr, pipeline.models, '_LOW_INDEX_MODE',
+                    pipeline.models._LOW_INDEX_MODE)
+    pipeline.models._LOW_INDEX_MODE = True
+    statuses = [_PipelineRecord.RUN, _PipelineRecord.WAITING,
+                _PipelineRecord.RUN, _PipelineRecord.ABORTED,
+                _PipelineRecord.DONE]
+    pipeline_keys = [self.pipeline1_key, self.pipeline2_key,
+                     self.pipeline3_key, self.pipeline4_key,
+                     self.pipeline5_key]
+    # Not found by querying the root_pipeline property.
+    records = [_PipelineRecord(key=key, status=status, params_text='{}')
+               for key, status in zip(pipeline_keys, statuses)]
+    old_max_keys = pipeline._MAX_MANIFEST_KEYS
+    pipeline._MAX_MANIFEST_KEYS = 2
+    try:
+      pages = pipeline._PipelineContext._create_manifest_entities(
+          self.pipeline1_key, records, first_page_id=_ManifestRecord.ROOT_PAGE)
+    finally:
+      pipeline._MAX_MANIFEST_KEYS = old_max_keys
+    self.assertEqual(3, len(pages))
+    ndb.put_multi(records + pages)
+
+    aborted_keys = []
+    cursor = None
+    for attempt in range(len(records) + 1):
+      self.context.continue_abort(self.pipeline1_key, cursor=cursor,
+                                  max_to_notify=max_to_notify)
+      task_list = test_shared.get_tasks()
+      test_shared.delete_tasks(task_list)
+      aborted_keys.append(
+          [task['params']['pipeline_key'][0] for task in task_list
+           if task['url'] == '/base-path/abort'])
+      continuations = [task for task in task_list
+                       if task['url'] == '/base-path/fanout_abort']
+      if not continuations:
+        break
+      self.context.task_name = continuations[0]['name']
+      cursor = continuations[0]['params']['cursor'][0]
+
+    self.assertEqual(
+        sorted(_encode_key(key) for key in pipeline_keys[:3]),
+        sorted(key for keys in aborted_keys for key in keys))
+    return aborted_keys
+
+  def testContinueAbort_Manifest(self):
+    """Tests continue_abort going through the pages of a manifest."""
+    self.assertEqual([3], [len(keys) for keys in
+                           self._continue_abort_manifest(10)])
+
+  def testContinueAbort_ManifestLimit(self):
+    """Tests that continue_abort lists max_to_notify pipelines at a time."""
+    # Five pipelines, one at a time.
+    aborted_keys = self._continue_abort_manifest(1)
+    self.assertEqual(5, len(aborted_keys))
+    self.assertTrue(all(len(keys) <= 1 for keys in aborted_keys))
+
+  def testContinueAbort_ManifestLimitWithinPage(self):
+    """Tests that continue_abort resumes within a manifest page."""
+    # Five pipelines on pages of two and one, whatever the order of pages.
+    aborted_keys = self._continue_abort_manifest(2)
+    self.assertEqual(3, len(aborted_keys))
+    self.assertTrue(all(len(keys) <= 2 for keys in aborted_keys))
+
   def testTransitionAbortedMissing(self):
     """Tests transition_aborted when the pipeline is missing."""
     self.assertTrue(self.pipeline1_key.get() is None)
@@ -2024,6 +2542,13 @@ class DumbSync(pipeline.Pipeline):
     pass
 
 
+class DumbSyncFinalized(DumbSync):
+  """A dumb pipeline that's synchronous and has a finalized() method."""
+
+  def finalized(self):
+    pass
+
+
 class DumbAsync(pipeline.Pipeline):
   """A dumb pipeline that's asynchronous."""
 
@@ -2051,6 +2576,19 @@ class DumbGeneratorYields(pipeline.Pipeline):
       yield DumbSync(3, result)
 
 
+class DumbGeneratorAfter(pipeline.Pipeline):
+  """A dumb generator that runs several children after several others."""
+
+  def run(self):
+    first = yield DumbSync(1)
+    second = yield DumbSync(2)
+    third = yield DumbSync(3)
+    with pipeline.After(first, second, third):
+      yield DumbSync(4)
+      yield DumbSync(5)
+      yield DumbSync(6)
+
+
 class DiesOnCreation(pipeline.Pipeline):
   """A pipeline that raises an exception on insantiation."""
 
@@ -2185,6 +2723,148 @@ class TaskRunningTest(test_shared.TaskRunningMixin, TestBase):
     self.context = pipeline._PipelineContext(
         'my-task1', 'default', '/base-path')
 
+  def testSyncCompletesOnFill(self):
+    """Tests that a sync pipeline is completed when its output is filled."""
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record])
+
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_PipelineRecord.DONE, self.pipeline_key.get().status)
+    self.assertEqual(_SlotRecord.FILLED, self.slot_key.get().status)
+    self.assertEqual(_BarrierRecord.FIRED, self.barrier_record.key.get().status)
+
+    task_list = test_shared.get_tasks()
+    test_shared.delete_tasks(task_list)
+    self.assertEqual(['/base-path/output'], [t['url'] for t in task_list])
+
+    # Notifying the filled slot does not enqueue a finalization task.
+    _BarrierIndex(key=ndb.Key(flat=(
+        self.slot_key.flat() + self.pipeline_key.flat() +
+        (_BarrierIndex._get_kind(), _BarrierRecord.FINALIZE)))).put()
+    self.context.notify_barriers(self.slot_key, None, True)
+    self.assertEqual([], test_shared.get_tasks())
+
+  def testSyncCompletesOnFill_RecheckedInTxn(self):
+    """Tests that the blocking slots are checked again in the transaction."""
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    other_slot_key = ndb.Key(_SlotRecord, 'blue')
+    self.barrier_record.blocking_slots.append(other_slot_key)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record,
+                   _SlotRecord(key=other_slot_key,
+                               status=_SlotRecord.FILLED)])
+
+    # The slot goes missing after the check made outside the transaction.
+    check = self.context._last_pending_barrier_key
+    def check_then_delete(*args):
+      barrier_key = check(*args)
+      other_slot_key.delete()
+      return barrier_key
+    self.context._last_pending_barrier_key = check_then_delete
+
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_PipelineRecord.WAITING, self.pipeline_key.get().status)
+    self.assertEqual(_BarrierRecord.WAITING,
+                     self.barrier_record.key.get().status)
+
+  def testSyncWithFinalizedWaitsForFinalization(self):
+    """Tests that a pipeline with a finalized() method is not completed."""
+    self.pipeline_record.class_path = '{}.DumbSyncFinalized'.format(__name__)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record])
+
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_PipelineRecord.WAITING, self.pipeline_key.get().status)
+    self.assertEqual(_BarrierRecord.WAITING,
+                     self.barrier_record.key.get().status)
+
+  def testCachedAbortSignal(self):
+    """Tests that children reuse the cached abort flag of their root."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 5
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    self.pipeline_record.root_pipeline = self.pipeline2_key
+    root_record = _PipelineRecord(
+        key=self.pipeline2_key, root_pipeline=self.pipeline2_key,
+        abort_requested=True)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record,
+                   root_record])
+
+    pipeline._set_abort_signal(self.pipeline2_key, False)
+    self.context.evaluate(self.pipeline_key)
+    # The root was not read, so the child ran and completed; the abort
+    # fan-out of the root takes care of it.
+    self.assertEqual(_SlotRecord.FILLED, self.slot_key.get().status)
+    self.assertEqual(_PipelineRecord.DONE, self.pipeline_key.get().status)
+
+  def testCachedAbortSignal_AbortBeforeFill(self):
+    """Tests that a child is not completed once its root is known to abort."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 5
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    self.pipeline_record.root_pipeline = self.pipeline2_key
+    root_record = _PipelineRecord(
+        key=self.pipeline2_key, root_pipeline=self.pipeline2_key)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record,
+                   root_record])
+
+    # The abort is requested while the child runs.
+    fill_slot = self.context.fill_slot
+    def abort_then_fill(*args, **kwargs):
+      pipeline._set_abort_signal(self.pipeline2_key, True)
+      return fill_slot(*args, **kwargs)
+    self.context.fill_slot = abort_then_fill
+
+    self.context.evaluate(self.pipeline_key)
+    # Completing the child is left to its finalization task.
+    self.assertEqual(_SlotRecord.FILLED, self.slot_key.get().status)
+    self.assertEqual(_PipelineRecord.WAITING, self.pipeline_key.get().status)
+    self.assertEqual(_BarrierRecord.WAITING,
+                     self.barrier_record.key.get().status)
+
+    self.context.evaluate(self.pipeline_key, _BarrierRecord.FINALIZE)
+    self.assertEqual(_PipelineRecord.ABORTED, self.pipeline_key.get().status)
+
+  def testCachedAbortSignal_Expired(self):
+    """Tests that the root is read again once the cached flag expires."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 0
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    self.pipeline_record.root_pipeline = self.pipeline2_key
+    root_record = _PipelineRecord(
+        key=self.pipeline2_key, root_pipeline=self.pipeline2_key,
+        abort_requested=True)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record,
+                   root_record])
+
+    pipeline._set_abort_signal(self.pipeline2_key, False)
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_PipelineRecord.ABORTED, self.pipeline_key.get().status)
+
+  def testAbortSignalOffByDefault(self):
+    """Tests that children read the root for every evaluation by default."""
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    self.pipeline_record.root_pipeline = self.pipeline2_key
+    root_record = _PipelineRecord(
+        key=self.pipeline2_key, root_pipeline=self.pipeline2_key)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record,
+                   root_record])
+
+    # Would be reused if the flags were cached.
+    pipeline._set_abort_signal(self.pipeline2_key, False)
+    root_record.abort_requested = True
+    root_record.put()
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_PipelineRecord.ABORTED, self.pipeline_key.get().status)
+
+  def testCachedAbortSignal_RootMissing(self):
+    """Tests that children give up once the root is cleaned up."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 5
+    self.pipeline_record.class_path = '{}.DumbSync'.format(__name__)
+    self.pipeline_record.root_pipeline = self.pipeline2_key
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record])
+
+    pipeline._set_abort_signal(self.pipeline2_key, False)
+    pipeline._forget_abort_signal(self.pipeline2_key)
+    self.context.evaluate(self.pipeline_key)
+    self.assertEqual(_SlotRecord.WAITING, self.slot_key.get().status)
+    self.assertEqual(_PipelineRecord.WAITING, self.pipeline_key.get().status)
+
   def testSubstagesRunImmediately(self):
     """Tests that sub-stages with no blocking slots are run immediately."""
     self.pipeline_record.class_path = '{}.DumbGeneratorYields'.format(__name__)
@@ -2210,7 +2890,7 @@ class TaskRunningTest(test_shared.TaskRunningMixin, TestBase):
 
     # One fan-out task with both children.
     self.assertEqual(
-        [self.pipeline_key.urlsafe().decode()],
+        [_encode_key(self.pipeline_key)],
         fanout_task['params']['parent_key'])
     self.assertEqual(
         ['0', '1'],
@@ -2250,7 +2930,7 @@ class TaskRunningTest(test_shared.TaskRunningMixin, TestBase):
     # Only two children should start.
     self.assertEqual('/base-path/fanout', fanout_task['url'])
     self.assertEqual(
-        [self.pipeline_key.urlsafe().decode()],
+        [_encode_key(self.pipeline_key)],
         fanout_task['params']['parent_key'])
     self.assertEqual(
         ['0', '1'],
@@ -2270,6 +2950,45 @@ class TaskRunningTest(test_shared.TaskRunningMixin, TestBase):
     self.assertTrue(ndb.Key(_BarrierRecord, _BarrierRecord.FINALIZE, parent=child2_key).get() is not None)
     self.assertTrue(ndb.Key(_BarrierRecord, _BarrierRecord.FINALIZE, parent=other_child_key).get() is not None)
 
+  def testSubstagesShareAfterGate(self):
+    """Tests that children run after the same futures share one gate."""
+    self.pipeline_record.class_path = '{}.DumbGeneratorAfter'.format(__name__)
+    ndb.put_multi([self.pipeline_record, self.slot_record, self.barrier_record])
+
+    self.context.evaluate(self.pipeline_key)
+
+    after_record = self.pipeline_key.get()
+    self.assertEqual(6, len(after_record.fanned_out))
+    children = ndb.get_multi(after_record.fanned_out)
+    after_slot_keys = set(
+        _decode_key(_SlotRecord, child.params['output_slots']['default'])
+        for child in children[:3])
+
+    gate_barriers = [
+        barrier for barrier in _BarrierRecord.query()
+        if barrier.gate_slot is not None]
+    self.assertEqual(1, len(gate_barriers))
+    gate_barrier = gate_barriers[0]
+    self.assertEqual(self.pipeline_key, gate_barrier.key.parent())
+    self.assertEqual(after_slot_keys, set(gate_barrier.blocking_slots))
+    self.assertEqual(_SlotRecord.WAITING, gate_barrier.gate_slot.get().status)
+
+    # Gated children block only on the gate and keep their after_all list.
+    for child in children[3:]:
+      start_barrier = ndb.Key(
+          _BarrierRecord, _BarrierRecord.START, parent=child.key).get()
+      self.assertEqual([gate_barrier.gate_slot], start_barrier.blocking_slots)
+      self.assertEqual(
+          after_slot_keys,
+          set(_decode_key(_SlotRecord, k) for k in child.params['after_all']))
+
+    # K + M indexes for the gate instead of K * M.
+    start_index_count = 0
+    for index_key in _BarrierIndex.query().fetch(keys_only=True):
+      if index_key.string_id() != _BarrierRecord.FINALIZE:
+        start_index_count += 1
+    self.assertEqual(3 + 3, start_index_count)
+
   def testFannedOutOrdering(self):
     """Tests that the fanned_out property lists children in code order."""
     self.pipeline_record.class_path = '{}.DumbGeneratorYields'.format(__name__)
@@ -2849,6 +3568,27 @@ class TaskRunningTest(test_shared.TaskRunningMixin, TestBase):
     self.assertTrue(after_record.abort_message is None)
     self.assertTrue(after_record.finalized_time is None)
 
+  def testPassBigValueUploadFails(self):
+    """Tests when uploading the big arguments of children fails."""
+    self.pipeline_record.class_path = '{}.PassBigValue'.format(__name__)
+    self.pipeline_record.status = _PipelineRecord.WAITING
+    ndb.put_multi([self.pipeline_record, self.slot_record])
+    old_upload = testutil.FakeBlob.upload_from_string
+    def _upload_from_string(blob, data, **kwargs):
+      raise ValueError('broken')
+    testutil.FakeBlob.upload_from_string = _upload_from_string
+    try:
+      self.context.evaluate(self.pipeline_key, purpose=_BarrierRecord.START)
+    finally:
+      testutil.FakeBlob.upload_from_string = old_upload
+
+    after_record = self.pipeline_key.get()
+    self.assertEqual(_PipelineRecord.WAITING, after_record.status)
+    self.assertEqual(1, after_record.current_attempt)
+    self.assertIn('Could not save child arguments. ValueError',
+                  after_record.retry_message)
+    self.assertEqual(1, len(_PipelineRecord.query().fetch()))
+
   def testReturnBadValue(self):
     """Tests when a pipeline returns a non-serializable value."""
     self.pipeline_record.class_path = '{}.ReturnBadValue'.format(__name__)
@@ -3119,6 +3859,749 @@ class CleanupHandlerTest(test_shared.TaskRunningMixin, TestBase):
     self.assertEqual(0, len(_StatusRecord.query().fetch()))
     self.assertEqual(0, len(_BarrierIndex.query().fetch()))
 
+  def testDeletesBlobs(self):
+    """Tests that blobs of the root pipeline are deleted, but not others."""
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(700000)).decode()
+    stage = OutputlessPipeline(big_value)
+    stage.start(idempotence_key='banana')
+    other_name = storage.write_json_gcs('other', 'other-root')
+    self.assertEqual(2, len(self.storageData))
+
+    stage.cleanup()
+    for task in self.get_tasks():
+      if task['url'] == '/_ah/pipeline/cleanup':
+        self.run_task(task)
+
+    self.assertEqual([other_name], list(self.storageData))
+
+  def _start_and_cleanup(self, manifest=True):
+    """Starts a pipeline with a few blobs and returns its cleanup task."""
+    if manifest:
+      self.addCleanup(setattr, pipeline.models, '_LOW_INDEX_MODE',
+                      pipeline.models._LOW_INDEX_MODE)
+      pipeline.models._LOW_INDEX_MODE = True
+    stage = OutputlessPipeline()
+    stage.start(idempotence_key='banana')
+    for index in range(5):
+      storage.write_json_gcs(str(index), stage.root_pipeline_id)
+    stage.cleanup()
+    task_list = self.get_tasks()
+    test_shared.delete_tasks(task_list)
+    return [task for task in task_list
+            if task['url'] == '/_ah/pipeline/cleanup']
+
+  def _run_cleanup_tasks(self, task_list):
+    """Runs cleanup tasks and their continuations; returns all task params."""
+    run_params = []
+    while task_list:
+      for task in task_list:
+        run_params.append(task['params'])
+        self.run_task(task)
+      task_list = self.get_tasks()
+      test_shared.delete_tasks(task_list)
+    return run_params
+
+  def _assert_cleaned_up(self):
+    self.assertEqual({}, self.storageData)
+    for model_class in (_PipelineRecord, _SlotRecord, _BarrierRecord,
+                        _StatusRecord, _BarrierIndex, _ManifestRecord):
+      self.assertEqual(0, len(model_class.query().fetch()))
+
+  def testContinuationTasks(self):
+    """Tests that cleanup continues in new tasks once out of time."""
+    for name, value in (('_MAX_CLEANUP_BLOBS', 2),
+                        ('_CLEANUP_BATCH_SIZE', 1),
+                        ('_CLEANUP_TIME_BUDGET_SECONDS', 0)):
+      self.addCleanup(setattr, pipeline, name, getattr(pipeline, name))
+      setattr(pipeline, name, value)
+
+    run_params = self._run_cleanup_tasks(
+        self._start_and_cleanup(manifest=False))
+    self._assert_cleaned_up()
+    steps = [params.get('step', [None])[0] for params in run_params]
+    self.assertEqual(None, steps[0])
+    # The first task deletes the first kind before running out of time.
+    self.assertEqual(pipeline._CLEANUP_STEPS[1:], sorted(
+        set(steps[1:]), key=pipeline._CLEANUP_STEPS.index))
+    self.assertEqual(
+        [['0'], ['2'], ['4']],
+        [params['deleted_blobs'] for params in run_params
+         if params.get('step') == ['blobs']])
+
+  def testForgetsAbortSignal(self):
+    """Tests that children stop using the cached flag of a deleted root."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 5
+    task_list = self._start_and_cleanup()
+    root_pipeline_key = ndb.Key(_PipelineRecord, 'banana')
+    pipeline._set_abort_signal(root_pipeline_key, False)
+
+    self._run_cleanup_tasks(task_list)
+    self._assert_cleaned_up()
+    self.assertIsNone(pipeline._get_abort_signal(root_pipeline_key))
+
+  def testManifest(self):
+    """Tests that entities listed in the manifest are deleted by key."""
+    self.addCleanup(setattr, pipeline, '_CLEANUP_TIME_BUDGET_SECONDS',
+                    pipeline._CLEANUP_TIME_BUDGET_SECONDS)
+    pipeline._CLEANUP_TIME_BUDGET_SECONDS = 0
+
+    task_list = self._start_and_cleanup()
+    stage = pipeline.Pipeline.from_id('banana')
+    stage.set_status('Some status')
+    # Not found by querying the root_pipeline property.
+    status_record = _StatusRecord.query().get()
+    status_record.root_pipeline = None
+    status_record.put()
+
+    run_params = self._run_cleanup_tasks(task_list)
+    self._assert_cleaned_up()
+    # No kind steps; the second task finds no manifest pages left.
+    self.assertEqual(
+        [None, 'manifest', 'blobs'],
+        [params.get('step', [None])[0] for params in run_params])
+
+  def testManifestDuringDeploy(self):
+    """Tests that the kind steps run until manifests are relied on."""
+    stage = OutputlessPipeline()
+    stage.start(idempotence_key='banana')
+    # Like a child added by an instance that does not write manifests yet.
+    _PipelineRecord(id='unlisted', root_pipeline=stage._pipeline_key,
+                    class_path='foo.Bar').put()
+    stage.cleanup()
+    task_list = [task for task in self.get_tasks()
+                 if task['url'] == '/_ah/pipeline/cleanup']
+    test_shared.delete_tasks(self.get_tasks())
+
+    self._run_cleanup_tasks(task_list)
+    self._assert_cleaned_up()
+
+  def testNoManifestByDefault(self):
+    """Tests that manifests are only written in low index mode."""
+    self._start_and_cleanup(manifest=False)
+    self.assertEqual([], _ManifestRecord.query().fetch())
+
+  def testShardByKind(self):
+    """Tests that each kind is cleaned up by its own tasks when sharded."""
+    self.addCleanup(setattr, pipeline, '_CLEANUP_SHARD_BY_KIND',
+                    pipeline._CLEANUP_SHARD_BY_KIND)
+    pipeline._CLEANUP_SHARD_BY_KIND = True
+
+    run_params = self._run_cleanup_tasks(
+        self._start_and_cleanup(manifest=False))
+    self._assert_cleaned_up()
+    self.assertEqual(1 + len(pipeline._CLEANUP_STEPS), len(run_params))
+    self.assertEqual(
+        sorted(pipeline._CLEANUP_STEPS),
+        sorted(params['step'][0] for params in run_params[1:]))
+    self.assertTrue(all(params['sharded'] == ['1']
+                        for params in run_params[1:]))
+
+  def testShardByKind_Manifest(self):
+    """Tests sharded cleanup of a root pipeline with a manifest."""
+    self.addCleanup(setattr, pipeline, '_CLEANUP_SHARD_BY_KIND',
+                    pipeline._CLEANUP_SHARD_BY_KIND)
+    pipeline._CLEANUP_SHARD_BY_KIND = True
+
+    run_params = self._run_cleanup_tasks(self._start_and_cleanup())
+    self._assert_cleaned_up()
+    self.assertEqual(
+        ['blobs', 'manifest'],
+        sorted(params['step'][0] for params in run_params[1:]))
+
+
+class LowIndexModeTest(test_shared.TaskRunningMixin, TestBase):
+  """Tests for writing entities without unneeded indexes."""
+
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(setattr, pipeline.models, '_LOW_INDEX_MODE',
+                    pipeline.models._LOW_INDEX_MODE)
+    pipeline.models._LOW_INDEX_MODE = True
+
+  def _indexed_names(self, entity):
+    return sorted(prop.name for prop in entity._to_pb().property)
+
+  def testUnindexedProperties(self):
+    """Tests which properties stay indexed on each kind."""
+    root_key = ndb.Key(_PipelineRecord, 'root')
+    child = _PipelineRecord(
+        key=ndb.Key(_PipelineRecord, 'child'), root_pipeline=root_key,
+        class_path='foo.Bar', start_time=datetime.datetime.utcnow())
+    self.assertEqual([], self._indexed_names(child))
+    root = _PipelineRecord(
+        key=root_key, root_pipeline=root_key, is_root_pipeline=True,
+        class_path='foo.Bar', start_time=datetime.datetime.utcnow())
+    self.assertEqual(['class_path', 'is_root_pipeline', 'start_time'],
+                     self._indexed_names(root))
+    slot = _SlotRecord(root_pipeline=root_key, filler=root_key)
+    self.assertEqual([], self._indexed_names(slot))
+    barrier = _BarrierRecord(root_pipeline=root_key, target=root_key,
+                             blocking_slots=[ndb.Key(_SlotRecord, 'slot')])
+    self.assertEqual(['blocking_slots'], self._indexed_names(barrier))
+
+    pipeline.models._LOW_INDEX_MODE = False
+    self.assertEqual(
+        ['class_path', 'is_root_pipeline', 'root_pipeline', 'start_time',
+         'status'],
+        self._indexed_names(child))
+
+  def testRunAndCleanUp(self):
+    """Tests that a pipeline works without the root_pipeline indexes."""
+    stage = DumbGeneratorYields(True)
+    self.run_pipeline(stage)
+    root_key = ndb.Key(_PipelineRecord, stage.pipeline_id)
+    self.assertEqual(
+        [], _PipelineRecord.query(
+            _PipelineRecord.root_pipeline == root_key).fetch())
+
+    self.assertEqual(
+        [stage.pipeline_id],
+        [found['pipelineId']
+         for found in pipeline.get_root_list()['pipelines']])
+    tree = pipeline.get_status_tree(stage.pipeline_id)
+    self.assertEqual(4, len(tree['pipelines']))
+
+    stage.cleanup()
+    for task in self.get_tasks():
+      test_shared.delete_tasks([task])
+      if task['url'] == '/_ah/pipeline/cleanup':
+        self.run_task(task)
+    for model_class in (_PipelineRecord, _SlotRecord, _BarrierRecord,
+                        _BarrierIndex, _ManifestRecord):
+      self.assertEqual(0, len(model_class.query().fetch()))
+
+  def testFewerIndexWrites(self):
+    """Tests that low-index mode writes fewer index rows."""
+    index_writes = []
+    for low_index_mode in (False, True):
+      pipeline.models._LOW_INDEX_MODE = low_index_mode
+      counter = testutil.IndexWriteCounter()
+      counter.install()
+      self.run_pipeline(DumbGeneratorYields(True))
+      index_writes.append(counter.index_writes)
+    self.assertLess(index_writes[1], index_writes[0] / 2)
+
+
+class AbortSignalTest(TestBase):
+  """Tests for the cached abort_requested flags of root pipelines."""
+
+  def setUp(self):
+    super().setUp()
+    self.root_key = ndb.Key(_PipelineRecord, 'root')
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = 5
+
+  def testSetAndGet(self):
+    """Tests that a raised flag is never replaced by a lowered one."""
+    self.assertIsNone(pipeline._get_abort_signal(self.root_key))
+    pipeline._set_abort_signal(self.root_key, False)
+    self.assertIs(False, pipeline._get_abort_signal(self.root_key))
+    pipeline._set_abort_signal(self.root_key, True)
+    pipeline._set_abort_signal(self.root_key, False)
+    self.assertIs(True, pipeline._get_abort_signal(self.root_key))
+
+  def testBeginAbort(self):
+    """Tests that beginning an abort raises the cached flag."""
+    _PipelineRecord(key=self.root_key, root_pipeline=self.root_key).put()
+    pipeline._set_abort_signal(self.root_key, False)
+    context = pipeline._PipelineContext('my-task1', 'default', '/base-path')
+    self.assertTrue(context.begin_abort(self.root_key, 'stop'))
+    self.assertIs(True, pipeline._get_abort_signal(self.root_key))
+
+  def testMemcache(self):
+    """Tests that flags are shared through memcache when enabled."""
+    self.testbed.init_memcache_stub()
+    self.addCleanup(setattr, pipeline, '_ABORT_SIGNAL_MEMCACHE',
+                    pipeline._ABORT_SIGNAL_MEMCACHE)
+    pipeline._ABORT_SIGNAL_MEMCACHE = True
+
+    pipeline._set_abort_signal(self.root_key, True)
+    pipeline._abort_signals.clear()
+    pipeline._set_abort_signal(self.root_key, False)
+    pipeline._abort_signals.clear()
+    self.assertIs(True, pipeline._get_abort_signal(self.root_key))
+
+  def testDisabled(self):
+    """Tests that nothing is cached without a TTL."""
+    pipeline._ABORT_SIGNAL_TTL_SECONDS = None
+    pipeline._set_abort_signal(self.root_key, True)
+    self.assertIsNone(pipeline._get_abort_signal(self.root_key))
+
+
+class LazySlotValueTest(TestBase):
+  """Tests that resolved slot values are decoded when first read."""
+
+  def setUp(self):
+    super().setUp()
+    self.reads = []
+    read_blobs_gcs = pipeline.read_blobs_gcs
+    def counting_read_blobs_gcs(blob_names):
+      self.reads.append(sorted(blob_names))
+      return read_blobs_gcs(blob_names)
+    self.addCleanup(setattr, pipeline, 'read_blobs_gcs', read_blobs_gcs)
+    pipeline.read_blobs_gcs = counting_read_blobs_gcs
+
+    self.filler_key = ndb.Key(_PipelineRecord, 'filler')
+    self.fill_time = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    already_defined = {}
+    self.blob_names = {}
+    for name in ('default', 'one', 'two'):
+      blob_name = storage.write_json_gcs(json.dumps(name.upper()), 'root')
+      slot_record = _SlotRecord(
+          key=ndb.Key(_SlotRecord, name),
+          status=_SlotRecord.FILLED,
+          filler=self.filler_key,
+          fill_time=self.fill_time,
+          value_gcs=blob_name)
+      slot_record.put()
+      already_defined[name] = _encode_key(slot_record.key)
+      self.blob_names[name] = blob_name
+    self.future = pipeline.PipelineFuture(['one', 'two'])
+    self.future._inherit_outputs('foo', already_defined, resolve_outputs=True)
+
+  def testNothingDownloadedUntilRead(self):
+    """Tests that resolving and reading slot metadata downloads nothing."""
+    self.assertTrue(self.future.one.filled)
+    self.assertEqual('filler', self.future.one.filler)
+    self.assertEqual(self.fill_time, self.future.one.fill_datetime)
+    self.assertEqual([], self.reads)
+    self.assertEqual([], self.bucket.downloads)
+
+  def testOnlyReadValueDownloaded(self):
+    """Tests that reading one value does not download the others."""
+    self.assertEqual('ONE', self.future.one.value)
+    self.assertEqual('ONE', self.future.one.value)
+    self.assertEqual([[self.blob_names['one']]], self.reads)
+
+  def testTouchedSlotsPrefetched(self):
+    """Tests that the touched slots are downloaded in one batch."""
+    default, two = self.future.default, self.future.two
+    self.assertEqual('DEFAULT', default.value)
+    self.assertEqual('TWO', two.value)
+    self.assertEqual(
+        [sorted([self.blob_names['default'], self.blob_names['two']])],
+        self.reads)
+    self.assertEqual("'ONE'", repr(self.future.one))
+    self.assertEqual(2, len(self.reads))
+
+
+class ParamsCacheTest(TestBase):
+  """Tests for the process-wide cache of decoded params."""
+
+  def setUp(self):
+    super().setUp()
+    self.decoded = []
+    decode_payload = pipeline.models._decode_payload
+    def counting_decode_payload(*args):
+      self.decoded.append(args)
+      return decode_payload(*args)
+    self.addCleanup(setattr, pipeline.models, '_decode_payload', decode_payload)
+    pipeline.models._decode_payload = counting_decode_payload
+
+  def _put_record(self, pipeline_id, params):
+    record = _PipelineRecord(
+        key=ndb.Key(_PipelineRecord, pipeline_id),
+        params_text=json.dumps(params))
+    record.put()
+    return record.key
+
+  def testSharedAcrossFetches(self):
+    """Tests that params are decoded once for all fetches of a record."""
+    key = self._put_record('one', {'args': [], 'kwargs': {'a': [1, 2]}})
+    first = key.get().params
+    first['kwargs']['a'].append(3)
+    second = key.get().params
+    self.assertEqual({'args': [], 'kwargs': {'a': [1, 2]}}, second)
+    self.assertEqual(1, len(self.decoded))
+
+  def testChangedEncoding(self):
+    """Tests that a record written again with other params is decoded."""
+    key = self._put_record('one', {'args': [1]})
+    self.assertEqual([1], key.get().params['args'])
+    self._put_record('one', {'args': [2]})
+    self.assertEqual([2], key.get().params['args'])
+    self.assertEqual(2, len(self.decoded))
+
+  def testKeyedByDigest(self):
+    """Tests that params are cached under the digest of their encoding."""
+    key = self._put_record('one', {'args': [1]})
+    record = key.get()
+    self.assertEqual(
+        (key, None, hashlib.sha256(record.params_text.encode()).digest()),
+        record._params_cache_key())
+
+  def testEviction(self):
+    """Tests that the least recently used params are evicted."""
+    self.addCleanup(setattr, pipeline.models, '_PARAMS_CACHE_MAX_BYTES',
+                    pipeline.models._PARAMS_CACHE_MAX_BYTES)
+    key_one = self._put_record('one', {'args': ['x' * 100]})
+    key_two = self._put_record('two', {'args': ['y' * 100]})
+    key_one.get().params
+    pipeline.models._PARAMS_CACHE_MAX_BYTES = (
+        pipeline.models._params_cache_bytes + 10)
+    key_two.get().params
+    key_two.get().params
+    key_one.get().params
+    self.assertEqual(3, len(self.decoded))
+
+  def testDisabled(self):
+    """Tests that params are decoded for every fetch without the cache."""
+    self.addCleanup(setattr, pipeline.models, '_PARAMS_CACHE_MAX_BYTES',
+                    pipeline.models._PARAMS_CACHE_MAX_BYTES)
+    pipeline.models._PARAMS_CACHE_MAX_BYTES = None
+    key = self._put_record('one', {'args': []})
+    key.get().params
+    key.get().params
+    self.assertEqual(2, len(self.decoded))
+
+
+class RequestCacheTest(TestBase):
+  """Tests for the request-scoped read cache."""
+
+  def setUp(self):
+    super().setUp()
+    self.pipeline_key = ndb.Key(_PipelineRecord, 'one')
+    self.slot_key = ndb.Key(_SlotRecord, 'red')
+    _PipelineRecord(key=self.pipeline_key, class_path='foo.Bar').put()
+    _SlotRecord(key=self.slot_key, status=_SlotRecord.FILLED).put()
+
+  def testReusesReads(self):
+    """Tests that entities are read once per request."""
+    with pipeline.models._request_cache():
+      first = pipeline.models._cached_get(self.pipeline_key)
+      self.assertIs(first, pipeline.models._cached_get(self.pipeline_key))
+      self.assertEqual(
+          [first, None],
+          pipeline.models._cached_get_multi(
+              [self.pipeline_key, ndb.Key(_PipelineRecord, 'missing')]))
+    self.assertIsNot(first, pipeline.models._cached_get(self.pipeline_key))
+
+  def testWritesInvalidate(self):
+    """Tests that mutable entities are only reused until the first write."""
+    with pipeline.models._request_cache():
+      record, slot = pipeline.models._cached_get_multi(
+          [self.pipeline_key, self.slot_key])
+      _BarrierRecord(id=_BarrierRecord.FINALIZE, parent=self.pipeline_key).put()
+      self.assertIs(slot, pipeline.models._cached_get(self.slot_key))
+      self.assertIsNot(record, pipeline.models._cached_get(self.pipeline_key))
+
+      slot.status = _SlotRecord.WAITING
+      slot.put()
+      self.assertEqual(_SlotRecord.WAITING,
+                       pipeline.models._cached_get(self.slot_key).status)
+
+      self.slot_key.delete()
+      self.assertIsNone(pipeline.models._cached_get(self.slot_key))
+
+  def testPutMultiInvalidates(self):
+    """Tests that a batch write only drops the written immutable entities."""
+    other_keys = [ndb.Key(_SlotRecord, 'other%d' % index)
+                  for index in range(3)]
+    ndb.put_multi([_SlotRecord(key=key, status=_SlotRecord.FILLED)
+                   for key in other_keys])
+    with pipeline.models._request_cache():
+      cached = pipeline.models._cached_get_multi(
+          [self.slot_key, self.pipeline_key] + other_keys)
+      for slot in cached[2:]:
+        slot.status = _SlotRecord.WAITING
+      ndb.put_multi(cached[2:])
+      self.assertIs(cached[0], pipeline.models._cached_get(self.slot_key))
+      self.assertIsNot(cached[1], pipeline.models._cached_get(self.pipeline_key))
+      self.assertEqual(
+          [_SlotRecord.WAITING] * 3,
+          [slot.status
+           for slot in pipeline.models._cached_get_multi(other_keys)])
+
+  def testTransactionsBypass(self):
+    """Tests that reads in transactions are not served from the cache."""
+    with pipeline.models._request_cache():
+      record = pipeline.models._cached_get(self.pipeline_key)
+      in_txn = ndb.transaction(
+          lambda: pipeline.models._cached_get(self.pipeline_key))
+      self.assertIsNot(record, in_txn)
+      self.assertIs(record, pipeline.models._cached_get(self.pipeline_key))
+
+
+class InlineInputsTest(TestBase):
+  """Tests for the input values sent along with start tasks."""
+
+  def setUp(self):
+    super().setUp()
+    self.pipeline_record = _PipelineRecord(
+        key=ndb.Key(_PipelineRecord, 'one'), class_path='foo.Bar',
+        status=_PipelineRecord.WAITING, current_attempt=0)
+    self.pipeline_record.root_pipeline = self.pipeline_record.key
+    self.pipeline_record.put()
+    self.filled = _SlotRecord(
+        key=ndb.Key(_SlotRecord, 'red'), status=_SlotRecord.FILLED,
+        filler=self.pipeline_record.key, value_text='"small"',
+        fill_time=datetime.datetime(2024, 5, 17, 12, 30, 45, 123456))
+    self.spilled = _SlotRecord(
+        key=ndb.Key(_SlotRecord, 'blue'), status=_SlotRecord.FILLED,
+        value_gcs='/bucket/blob')
+    self.big = _SlotRecord(
+        key=ndb.Key(_SlotRecord, 'green'), status=_SlotRecord.FILLED,
+        value_text='"%s"' % ('x' * 100))
+    self.addCleanup(setattr, pipeline, '_MAX_INLINE_INPUTS_SIZE',
+                    pipeline._MAX_INLINE_INPUTS_SIZE)
+
+  def testEncode(self):
+    """Tests that only small values stored inline are sent."""
+    expected = json.dumps({'attempt': 0, 'slots': [
+        [_encode_key(self.filled.key), None, '"small"',
+         _encode_key(self.pipeline_record.key),
+         '2024-05-17T12:30:45.123456']]})
+    # The budget counts the form-encoded task parameter.
+    pipeline._MAX_INLINE_INPUTS_SIZE = len(
+        urllib.parse.urlencode({'inputs': expected}).encode('utf-8'))
+    self.assertEqual(expected, pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.spilled, self.big, self.filled]))
+    self.assertIsNone(pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.spilled, self.big]))
+
+    pipeline._MAX_INLINE_INPUTS_SIZE -= 1
+    self.assertIsNone(pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled]))
+    pipeline._MAX_INLINE_INPUTS_SIZE = None
+    self.assertIsNone(pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled]))
+
+  def testEncodeSeveral(self):
+    """Tests that the budget counts every slot sent and their separators."""
+    other = _SlotRecord(
+        key=ndb.Key(_SlotRecord, 'orange'), status=_SlotRecord.FILLED,
+        value_text='"caf\u00e9 & more"')
+    inputs = pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled, other, self.big])
+    size = len(urllib.parse.urlencode({'inputs': inputs}).encode('utf-8'))
+    pipeline._MAX_INLINE_INPUTS_SIZE = size
+    self.assertEqual(inputs, pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled, other, self.big]))
+    pipeline._MAX_INLINE_INPUTS_SIZE = size - 1
+    self.assertEqual(2, len(json.loads(pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled, other, self.big]))['slots']))
+
+  def testPrime(self):
+    """Tests that sent values are read from the cache, not the Datastore."""
+    inputs = pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled])
+    with pipeline.models._request_cache():
+      pipeline._prime_inline_inputs(self.pipeline_record, inputs)
+      slot_record = pipeline.models._cached_get(self.filled.key)
+    self.assertEqual('small', slot_record.value)
+    self.assertEqual(self.filled.filler, slot_record.filler)
+    self.assertEqual(self.filled.fill_time, slot_record.fill_time)
+    self.assertEqual(self.pipeline_record.key, slot_record.root_pipeline)
+
+  def testPrimeStaleAttempt(self):
+    """Tests that values sent for another attempt are ignored."""
+    inputs = pipeline._encode_inline_inputs(
+        self.pipeline_record, [self.filled])
+    self.pipeline_record.current_attempt = 1
+    with pipeline.models._request_cache():
+      pipeline._prime_inline_inputs(self.pipeline_record, inputs)
+      self.assertIsNone(pipeline.models._cached_get(self.filled.key))
+
+
+class KeyEncodingTest(test_shared.TaskRunningMixin, TestBase):
+  """Tests for the encoding of keys in params and task payloads."""
+
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(setattr, pipeline.models, '_COMPACT_KEYS',
+                    pipeline.models._COMPACT_KEYS)
+    pipeline.models._COMPACT_KEYS = True
+
+  def testCompactRoundTrip(self):
+    """Tests that pipeline and slot keys round-trip in the compact form."""
+    pipeline_key = ndb.Key(_PipelineRecord, 'one')
+    for model_class, key in (
+        (_PipelineRecord, pipeline_key),
+        (_SlotRecord, ndb.Key(_SlotRecord, 'two')),
+        (_SlotRecord, ndb.Key(_SlotRecord, 'two', parent=pipeline_key)),
+        (_SlotRecord, ndb.Key(_SlotRecord, 'two', namespace='ns'))):
+      encoded = _encode_key(key)
+      self.assertNotEqual(key.urlsafe().decode(), encoded)
+      self.assertEqual(key, _decode_key(model_class, encoded))
+    self.assertEqual(':one:two', _encode_key(
+        ndb.Key(_SlotRecord, 'two', parent=pipeline_key)))
+
+  def testUrlsafeFallback(self):
+    """Tests that keys without a compact form are encoded urlsafe."""
+    for key in (
+        ndb.Key(_PipelineRecord, 1234),
+        ndb.Key(_PipelineRecord, 'my:id'),
+        ndb.Key(_PipelineRecord, 'one', app='other-app'),
+        ndb.Key(_SlotRecord, 'two', parent=ndb.Key('Other', 'one'))):
+      encoded = _encode_key(key)
+      self.assertEqual(key.urlsafe().decode(), encoded)
+      self.assertEqual(key, _decode_key(_SlotRecord, encoded))
+
+  def testMemoized(self):
+    """Tests that parsed keys are reused and the memo is bounded."""
+    self.addCleanup(setattr, pipeline.models, '_KEY_CACHE_SIZE',
+                    pipeline.models._KEY_CACHE_SIZE)
+    pipeline.models._KEY_CACHE_SIZE = 2
+    key = _decode_key(_PipelineRecord, ':one')
+    self.assertIs(key, _decode_key(_PipelineRecord, ':one'))
+    two = _decode_key(_PipelineRecord, ':two')
+    _decode_key(_PipelineRecord, ':one')
+    _decode_key(_PipelineRecord, ':three')
+    # The least recently used key is evicted.
+    self.assertEqual(2, len(pipeline.models._key_cache))
+    self.assertIs(key, _decode_key(_PipelineRecord, ':one'))
+    self.assertIsNot(two, _decode_key(_PipelineRecord, ':two'))
+
+  def testCompactRecords(self):
+    """Tests running a pipeline whose params and tasks hold compact keys."""
+    stage = DumbGeneratorYields(True)
+    self.run_pipeline(stage)
+    params = _PipelineRecord.get_by_id(stage.pipeline_id).params
+    default_slot_key = params['output_slots']['default']
+    self.assertTrue(default_slot_key.startswith(':'))
+    self.assertEqual(
+        default_slot_key,
+        _encode_key(_decode_key(_SlotRecord, default_slot_key)))
+
+  def testUrlsafeRecords(self):
+    """Tests running a pipeline whose params and tasks hold urlsafe keys."""
+    pipeline.models._COMPACT_KEYS = False
+    stage = DumbGeneratorYields(True)
+    self.run_pipeline(stage)
+    params = _PipelineRecord.get_by_id(stage.pipeline_id).params
+    default_slot_key = params['output_slots']['default']
+    self.assertEqual(
+        ndb.Key(urlsafe=default_slot_key),
+        _decode_key(_SlotRecord, default_slot_key))
+
+  def testStatusUsesUrlsafeKeys(self):
+    """Tests that the status tree refers to slots by their urlsafe keys."""
+    stage = DumbGeneratorYields(True)
+    self.run_pipeline(stage)
+    tree = pipeline.get_status_tree(stage.pipeline_id)
+    for slot_key in tree['slots']:
+      self.assertEqual(slot_key, ndb.Key(urlsafe=slot_key).urlsafe().decode())
+    for info in tree['pipelines'].values():
+      for slot_key in info['outputs'].values():
+        self.assertIn(slot_key, tree['slots'])
+
+
+class IdAllocationTest(test_shared.TaskRunningMixin, TestBase):
+  """Tests for the allocation of pipeline and slot IDs."""
+
+  def _string_ids(self, model_class):
+    return [key.string_id() for key in model_class.query().iter(keys_only=True)]
+
+  def testAllocateIds(self):
+    """Tests the IDs generated by each allocation."""
+    compact_ids = pipeline._allocate_ids(pipeline.COMPACT_IDS, 100)
+    self.assertEqual(100, len(set(compact_ids)))
+    for compact_id in compact_ids:
+      self.assertRegex(compact_id, '^[A-Za-z0-9_-]{20}$')
+    for uuid_id in pipeline._allocate_ids(pipeline.UUID_IDS, 3):
+      self.assertRegex(uuid_id, '^[0-9a-f]{32}$')
+    self.assertEqual([], pipeline._allocate_ids(pipeline.COMPACT_IDS, 0))
+    self.assertRaises(pipeline.PipelineSetupError,
+                      pipeline._allocate_ids, 'other', 1)
+
+  def testAllocateIdsReserved(self):
+    """Tests that compact IDs reserved by the Datastore are drawn again."""
+    # b'\xff' * 15 encodes to 20 underscores.
+    draws = [b'\xff' * 15 + b'\x00' * 15, b'\xff' * 15, b'\x10' * 15]
+    self.addCleanup(setattr, pipeline.os, 'urandom', os.urandom)
+    pipeline.os.urandom = lambda size: draws.pop(0)
+    self.assertEqual(['EBAQEBAQEBAQEBAQEBAQ', 'A' * 20],
+                     pipeline._allocate_ids(pipeline.COMPACT_IDS, 2))
+
+  def testCompactTree(self):
+    """Tests that a root's compact allocation is used by the whole tree."""
+    stage = DumbGeneratorAfter()
+    stage.id_allocation = pipeline.COMPACT_IDS
+    self.run_pipeline(stage)
+    self.assertEqual(20, len(stage.pipeline_id))
+    pipeline_ids = self._string_ids(_PipelineRecord)
+    slot_ids = self._string_ids(_SlotRecord)
+    self.assertEqual(7, len(pipeline_ids))
+    # The outputs of the root and the first five children, which the last one
+    # inherits from the root, and the gate of the After() block.
+    self.assertEqual(7, len(slot_ids))
+    for string_id in pipeline_ids + slot_ids:
+      self.assertEqual(20, len(string_id))
+    for pipeline_id in pipeline_ids:
+      self.assertEqual(pipeline.COMPACT_IDS, _PipelineRecord.get_by_id(
+          pipeline_id).params['id_allocation'])
+
+  def testUuidTree(self):
+    """Tests that pipelines get uuid4 IDs by default."""
+    self.run_pipeline(DumbGeneratorAfter())
+    for string_id in (self._string_ids(_PipelineRecord) +
+                      self._string_ids(_SlotRecord)):
+      self.assertEqual(32, len(string_id))
+
+
+class DatastoreOpsTest(test_shared.TaskRunningMixin, TestBase):
+  """Tests for the per-pipeline Datastore operation counters."""
+
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(setattr, pipeline, '_RECORD_DATASTORE_OPS',
+                    pipeline._RECORD_DATASTORE_OPS)
+    pipeline._RECORD_DATASTORE_OPS = True
+    pipeline.reset_datastore_stats()
+    self.addCleanup(pipeline.reset_datastore_stats)
+
+  def testSyncPipeline(self):
+    """Tests the budget of a synchronous root pipeline."""
+    stage = DumbSync()
+    self.run_pipeline(stage)
+    # One transaction to start it and one to fill its output and complete.
+    self.assertEqual(
+        2, pipeline.get_datastore_stats(stage.pipeline_id)['transactions'])
+
+  def testGeneratorChildren(self):
+    """Tests that a sync child fills and completes in one transaction."""
+    stage = DumbGeneratorYields(True)
+    self.run_pipeline(stage)
+    stats = pipeline.get_datastore_stats()
+    # Start, run with the fan-out of the children, and finalization.
+    self.assertEqual(3, stats.pop(stage.pipeline_id)['transactions'])
+    self.assertEqual(3, len(stats))
+    for child_stats in stats.values():
+      self.assertEqual(1, child_stats['transactions'])
+      # The query for the barriers waiting on the child's output.
+      self.assertEqual(1, child_stats['queries'])
+
+    pipeline.reset_datastore_stats()
+    self.assertEqual({}, pipeline.get_datastore_stats())
+
+  def testInlineInputs(self):
+    """Tests that a dependent child does not read its input slot."""
+    self.addCleanup(setattr, pipeline, '_MAX_INLINE_INPUTS_SIZE',
+                    pipeline._MAX_INLINE_INPUTS_SIZE)
+    gets = []
+    for max_size in (None, 16 * 1024):
+      pipeline._MAX_INLINE_INPUTS_SIZE = max_size
+      pipeline.reset_datastore_stats()
+      self.run_pipeline(DumbGeneratorYields(True))
+      gets.append(sum(stats['gets'] for stats in
+                      pipeline.get_datastore_stats().values()))
+    self.assertEqual(gets[0] - 1, gets[1])
+
+  def testHookRegisteredOnce(self):
+    """Tests that the counting hook is only registered once."""
+    from google.appengine.api import apiproxy_stub_map
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    self.run_pipeline(DumbSync())
+    hook_count = len(hooks)
+    self.run_pipeline(DumbSync())
+    self.assertEqual(hook_count, len(hooks))
+
+  def testDisabled(self):
+    """Tests that nothing is recorded by default."""
+    pipeline._RECORD_DATASTORE_OPS = False
+    self.run_pipeline(DumbSync())
+    self.assertEqual({}, pipeline.get_datastore_stats())
+
 
 class FanoutHandlerTest(test_shared.TaskRunningMixin, TestBase):
   """Tests for the _FanoutHandler class."""
@@ -3151,7 +4634,7 @@ class FanoutHandlerTest(test_shared.TaskRunningMixin, TestBase):
     for task in task_list:
       self.assertEqual('/_ah/pipeline/run', task['url'])
     children_keys = [
-        ndb.Key(urlsafe=t['params']['pipeline_key'][0]) for t in task_list]
+        _decode_key(_PipelineRecord, t['params']['pipeline_key'][0]) for t in task_list]
 
     self.assertEqual(set(children_keys), set(after_record.fanned_out))
 
@@ -3190,6 +4673,30 @@ class SaveRunOrder(pipeline.Pipeline):
     RunOrder.add(message)
 
 
+class MakeBlobRef(pipeline.Pipeline):
+  """Pipeline that stores its input in a blob and outputs a reference."""
+
+  def run(self, value):
+    return pipeline.BlobRef.create(value)
+
+
+class OpenBlobRefs(pipeline.Pipeline):
+  """Pipeline that outputs the values referenced by a list of BlobRefs."""
+
+  def run(self, refs):
+    return [ref.open() for ref in refs]
+
+
+class PassBlobRef(pipeline.Pipeline):
+  """Pipeline that passes a BlobRef through glue stages before opening it."""
+
+  def run(self, value):
+    ref = yield MakeBlobRef(value)
+    refs = yield common.List(ref, ref)
+    passed = yield common.Return(refs)
+    yield OpenBlobRefs(passed)
+
+
 class EchoSync(pipeline.Pipeline):
   """Pipeline that echos input."""
 
@@ -3484,6 +4991,20 @@ class DoAfterList(pipeline.Pipeline):
         yield SaveRunOrder('twelfth')
 
 
+class DoAfterShared(pipeline.Pipeline):
+  """Test the After clause with enough children to share a gate."""
+
+  def run(self):
+    first = yield SaveRunOrder('first')
+    second = yield SaveRunOrder('first')
+    third = yield SaveRunOrder('first')
+
+    with pipeline.After(first, second, third):
+      yield SaveRunOrder('third')
+      yield SaveRunOrder('third')
+      yield SaveRunOrder('third')
+
+
 class DoInOrder(pipeline.Pipeline):
   """Test the InOrder clause."""
 
@@ -3665,6 +5186,16 @@ class PassBadValue(pipeline.Pipeline):
     yield EchoSync(object())
 
 
+class PassBigValue(pipeline.Pipeline):
+  """Simple pipeline that passes along a value too big to keep inline."""
+
+  def run(self):
+    big_value = base64.b64encode(
+        random.Random(1234).randbytes(700000)).decode()
+    for unused in range(3):
+      yield EchoSync(big_value)
+
+
 class ReturnBadValue(pipeline.Pipeline):
   """Simple pipeline that returns a non-JSON serializable value."""
 
@@ -3948,6 +5479,24 @@ class FunctionalTest(test_shared.TaskRunningMixin, TestBase):
     self.assertEqual( ['redredredredredredredredredred', 'twelfth'],
                       RunOrder.get())
 
+  def testAfterWithSharedGate(self):
+    """Tests that children released by a shared After() gate all run."""
+    stage = DoAfterShared()
+    self.run_pipeline(stage)
+    self.assertEqual(['first', 'first', 'first', 'third', 'third', 'third'],
+                      RunOrder.get())
+
+  def testBlobRef(self):
+    """Tests passing a BlobRef through pipelines without opening it."""
+    stage = PassBlobRef(['big'] * 1000)
+    outputs = self.run_pipeline(stage)
+    self.assertEqual([['big'] * 1000, ['big'] * 1000], outputs.default.value)
+    # Only the final stage downloaded the value, once for each reference.
+    self.assertEqual(1, len(self.storageData))
+    self.assertTrue(list(self.storageData)[0].startswith(
+        'appengine_pipeline/%s/' % stage.pipeline_id))
+    self.assertEqual(2, len(self.bucket.downloads))
+
   def testInOrder(self):
     """Tests the InOrder() class."""
     stage = DoInOrder()
@@ -4783,6 +6332,68 @@ class StatusTest(TestBase):
         expected,
         pipeline.get_status_tree(self.pipeline1_key.string_id()))
 
+  def testGetStatusTree_Manifest(self):
+    """Tests get_status_tree looking up the entities in the manifest."""
+    self.addCleanup(setattr, pipeline.models, '_LOW_INDEX_MODE',
+                    pipeline.models._LOW_INDEX_MODE)
+    pipeline.models._LOW_INDEX_MODE = True
+    self.pipeline1_record.fanned_out = [self.pipeline2_key, self.pipeline3_key]
+    entities = [
+        self.pipeline1_record, self.pipeline2_record, self.pipeline3_record,
+        self.barrier1_record, self.barrier2_record, self.barrier3_record,
+        self.slot1_record, self.slot2_record, self.slot3_record]
+    # Not found by querying the root_pipeline property.
+    for entity in entities[1:]:
+      entity.root_pipeline = None
+    ndb.put_multi(
+        entities[:1] +
+        pipeline._PipelineContext._create_manifest_entities(
+            self.pipeline1_key, entities[:1],
+            first_page_id=_ManifestRecord.ROOT_PAGE))
+    ndb.put_multi(
+        entities[1:] +
+        pipeline._PipelineContext._create_manifest_entities(
+            self.pipeline1_key, entities[1:]))
+    _StatusRecord(key=ndb.Key(_StatusRecord, 'two'),
+                  message='Two is running').put()
+
+    found = pipeline.get_status_tree(self.pipeline1_key.string_id())
+    self.assertEqual(['one', 'three', 'two'], sorted(found['pipelines']))
+    self.assertEqual(['three', 'two'],
+                     sorted(found['pipelines']['one']['children']))
+    self.assertEqual('Two is running',
+                     found['pipelines']['two']['statusMessage'])
+    self.assertEqual(
+        sorted([self.slot2_key.urlsafe().decode(),
+                self.slot3_key.urlsafe().decode()]),
+        sorted(found['slots']))
+
+  def testGetStatusTree_ManifestLimit(self):
+    """Tests that the manifest lookups are capped for each kind."""
+    self.addCleanup(setattr, pipeline, '_MAX_STATUS_TREE_ENTITIES',
+                    pipeline._MAX_STATUS_TREE_ENTITIES)
+    pipeline._MAX_STATUS_TREE_ENTITIES = 3
+    self.addCleanup(setattr, pipeline, '_STATUS_TREE_MANIFEST_PAGES',
+                    pipeline._STATUS_TREE_MANIFEST_PAGES)
+    pipeline._STATUS_TREE_MANIFEST_PAGES = 1
+    # Listed on a page after the pages of testGetStatusTree_Manifest.
+    _ManifestRecord(
+        id='zzz', parent=self.pipeline1_key,
+        entity_keys=[ndb.Key(_SlotRecord, 'extra%d' % index)
+                     for index in range(5)]).put()
+
+    lookups = []
+    old_get_multi_async = ndb.get_multi_async
+    def _get_multi_async(keys, **kwargs):
+      lookups.append(list(keys))
+      return old_get_multi_async(keys, **kwargs)
+    self.addCleanup(setattr, ndb, 'get_multi_async', old_get_multi_async)
+    ndb.get_multi_async = _get_multi_async
+
+    self.testGetStatusTree_Manifest()
+    self.assertTrue(lookups)
+    self.assertTrue(all(len(keys) <= 3 for keys in lookups))
+
   def testGetPipelineNames(self):
     """Tests the get_pipeline_names function."""
     names = pipeline.get_pipeline_names()
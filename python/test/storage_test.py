@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""Tests for storage.py."""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+# Fix up paths for running tests.
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import testutil
+
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
+
+from pipeline import storage
+
+
+class StorageTest(unittest.TestCase):
+  """Tests for the Cloud Storage helpers."""
+
+  def setUp(self):
+    super().setUp()
+    self.bucket = testutil.FakeBucket()
+    self.old_get_default_bucket = storage._get_default_bucket
+    storage._get_default_bucket = lambda: self.bucket
+    self.old_cache_max_bytes = storage._CACHE_MAX_BYTES
+    storage._CACHE_MAX_BYTES = None
+
+  def tearDown(self):
+    storage._get_default_bucket = self.old_get_default_bucket
+    storage._CACHE_MAX_BYTES = self.old_cache_max_bytes
+    super().tearDown()
+
+  def testWriteContentAddressed(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    self.assertEqual(
+        'appengine_pipeline/root/' + hashlib.sha256(b'"value"').hexdigest(),
+        name)
+    self.assertEqual(b'"value"', storage.read_blob_gcs(name))
+    self.assertEqual(name, storage.write_json_gcs(b'"value"', 'root'))
+    self.assertEqual(1, len(self.bucket.uploads))
+    self.assertNotEqual(name, storage.write_json_gcs('"value"', 'other'))
+    self.assertNotEqual(name, storage.write_json_gcs('"other"', 'root'))
+
+  def testWriteReusesExistingBlob(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    self.assertEqual(name, storage.write_json_gcs('"value"', 'root'))
+    self.assertEqual(1, len(self.bucket.uploads))
+
+  def testDeleteBlobs(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    other_name = storage.write_json_gcs('"value"', 'root-other')
+    self.assertEqual((1, 7), storage.delete_blobs_gcs('root'))
+    self.assertEqual([other_name], list(self.bucket.data))
+
+    # Writing the value again after cleanup must upload it again.
+    self.assertEqual(name, storage.write_json_gcs('"value"', 'root'))
+    self.assertIn(name, self.bucket.data)
+
+  def testWriteAfterOtherInstanceDeleted(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    del self.bucket.data[name]
+    self.assertEqual(name, storage.write_json_gcs('"value"', 'root'))
+    self.assertEqual(b'"value"', self.bucket.data[name])
+
+  def testDeleteBlobsInBatches(self):
+    names = [storage.write_json_gcs(str(index), 'root') for index in range(5)]
+    old_batch_size = storage._DELETE_BATCH_SIZE
+    storage._DELETE_BATCH_SIZE = 2
+    try:
+      self.assertEqual((4, 4), storage.delete_blobs_gcs('root', max_blobs=4))
+      self.assertEqual(2, len(self.bucket.delete_batches))
+      self.assertEqual(1, len(self.bucket.data))
+      self.assertEqual((1, 1), storage.delete_blobs_gcs('root', max_blobs=4))
+      self.assertEqual((0, 0), storage.delete_blobs_gcs('root', max_blobs=4))
+    finally:
+      storage._DELETE_BATCH_SIZE = old_batch_size
+    self.assertEqual([], [name for name in names if name in self.bucket.data])
+
+  def testDeleteBlobsMissingOrFailing(self):
+    names = [storage.write_json_gcs(str(index), 'root') for index in range(3)]
+    # Listed, but already deleted by another task.
+    list_blobs = self.bucket.list_blobs
+    def _list_blobs(**kwargs):
+      blobs = list_blobs(**kwargs)
+      del self.bucket.data[names[0]]
+      return blobs
+    self.bucket.list_blobs = _list_blobs
+    self.bucket.fail_deletes.add(names[1])
+    self.assertRaises(exceptions.ServiceUnavailable,
+                      storage.delete_blobs_gcs, 'root')
+    self.assertEqual([sorted(names)], self.bucket.delete_batches)
+    self.assertEqual([names[1]], list(self.bucket.data))
+
+  def testReadBlobs(self):
+    names = [storage.write_json_gcs(str(index), 'root') for index in range(4)]
+    self.assertEqual({}, storage.read_blobs_gcs([]))
+    self.assertEqual({names[0]: b'0'}, storage.read_blobs_gcs(names[:1]))
+    self.assertEqual(
+        dict((name, str(index).encode()) for index, name in enumerate(names)),
+        storage.read_blobs_gcs(names + names))
+
+  def testReadBlobsConcurrently(self):
+    names = [storage.write_json_gcs(str(index), 'root') for index in range(2)]
+    # Both downloads must be in flight at the same time to pass the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+    old_download = testutil.FakeBlob.download_as_bytes
+    def _download_as_bytes(blob):
+      barrier.wait()
+      return old_download(blob)
+    testutil.FakeBlob.download_as_bytes = _download_as_bytes
+    try:
+      contents = storage.read_blobs_gcs(names)
+    finally:
+      testutil.FakeBlob.download_as_bytes = old_download
+    self.assertEqual([b'0', b'1'], [contents[name] for name in names])
+
+  def testWriteAsync(self):
+    name, future = storage.write_json_gcs_async('"value"', 'root')
+    same_name, same_future = storage.write_json_gcs_async(b'"value"', 'root')
+    self.assertEqual(name, same_name)
+    storage.wait_for_writes([future, same_future])
+    self.assertEqual(name, future.result())
+    self.assertEqual(b'"value"', self.bucket.data[name])
+    self.assertEqual(1, len(self.bucket.uploads))
+
+  def testWriteAsyncError(self):
+    old_upload = testutil.FakeBlob.upload_from_string
+    def _upload_from_string(blob, data, **kwargs):
+      raise ValueError('broken')
+    testutil.FakeBlob.upload_from_string = _upload_from_string
+    try:
+      _, future = storage.write_json_gcs_async('"value"', 'root')
+      self.assertRaises(ValueError, storage.wait_for_writes, [future])
+    finally:
+      testutil.FakeBlob.upload_from_string = old_upload
+
+  def testWriteRetriesWithJitter(self):
+    from google.api_core.exceptions import TooManyRequests
+    attempts = []
+    old_upload = testutil.FakeBlob.upload_from_string
+    def _upload_from_string(blob, data, **kwargs):
+      attempts.append(data)
+      if len(attempts) < 4:
+        raise TooManyRequests('slow down')
+      return old_upload(blob, data, **kwargs)
+    sleeps = []
+    old_sleep = storage.time.sleep
+    testutil.FakeBlob.upload_from_string = _upload_from_string
+    storage.time.sleep = sleeps.append
+    try:
+      name = storage.write_json_gcs('"value"', 'root')
+    finally:
+      testutil.FakeBlob.upload_from_string = old_upload
+      storage.time.sleep = old_sleep
+    self.assertIn(name, self.bucket.data)
+    self.assertEqual(3, len(sleeps))
+    for attempt, delay in enumerate(sleeps):
+      self.assertTrue(0 <= delay <= 2 ** attempt)
+
+  def testStream(self):
+    old_chunk_size = storage._STREAM_CHUNK_SIZE
+    storage._STREAM_CHUNK_SIZE = 4
+    try:
+      name = storage.write_stream_gcs([b'"val', b'ue"'], 'root')
+      self.assertTrue(name.startswith('appengine_pipeline/root/'))
+      self.assertEqual(b'"value"', self.bucket.data[name])
+      self.assertEqual([b'"val', b'ue"'], list(storage.read_stream_gcs(name)))
+    finally:
+      storage._STREAM_CHUNK_SIZE = old_chunk_size
+
+  def testStats(self):
+    storage.reset_stats()
+    name = storage.write_json_gcs('"value"', 'root')
+    storage.write_json_gcs('"value"', 'root')
+    storage.read_blob_gcs(name)
+    storage.delete_blobs_gcs('root')
+    stats = storage.get_stats()
+    self.assertEqual(1, stats['writes'])
+    self.assertEqual(1, stats['reused_writes'])
+    self.assertEqual(7, stats['write_bytes'])
+    self.assertEqual(1, stats['reads'])
+    self.assertEqual(7, stats['read_bytes'])
+    self.assertEqual(1, stats['deletes'])
+    self.assertEqual(7, stats['delete_bytes'])
+    self.assertGreaterEqual(stats['read_seconds'], 0)
+
+    storage.reset_stats()
+    self.assertEqual(0, storage.get_stats()['writes'])
+
+
+class CacheTest(unittest.TestCase):
+  """Tests for the on-instance cache of downloaded blobs."""
+
+  def setUp(self):
+    super().setUp()
+    self.bucket = testutil.FakeBucket()
+    self.old_get_default_bucket = storage._get_default_bucket
+    self.old_cache_dir = storage._cache_dir
+    self.old_cache_max_bytes = storage._CACHE_MAX_BYTES
+    storage._get_default_bucket = lambda: self.bucket
+    storage._cache_dir = tempfile.mkdtemp()
+    storage._cache_index.clear()
+    storage._cache_bytes = 0
+    storage._CACHE_MAX_BYTES = 20
+    storage.reset_stats()
+
+  def tearDown(self):
+    shutil.rmtree(storage._cache_dir)
+    storage._get_default_bucket = self.old_get_default_bucket
+    storage._cache_dir = self.old_cache_dir
+    storage._CACHE_MAX_BYTES = self.old_cache_max_bytes
+    storage._cache_index.clear()
+    storage._cache_bytes = 0
+    super().tearDown()
+
+  def testHitAndMiss(self):
+    self.bucket.data['blob'] = b'"value"'
+    self.assertEqual(b'"value"', storage.read_blob_gcs('blob'))
+    cached = storage.read_blob_gcs('blob')
+    self.assertIsInstance(cached, bytes)
+    self.assertEqual(b'"value"', cached)
+    self.assertEqual(1, len(self.bucket.downloads))
+    stats = storage.get_stats()
+    self.assertEqual(1, stats['cache_hits'])
+    self.assertEqual(1, stats['cache_misses'])
+    self.assertEqual(1, stats['reads'])
+
+  def testEmptyBlob(self):
+    self.bucket.data['blob'] = b''
+    storage.read_blob_gcs('blob')
+    self.assertEqual(b'', storage.read_blob_gcs('blob'))
+    self.assertEqual(1, len(self.bucket.downloads))
+
+  def testWriteThrough(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    self.assertEqual(b'"value"', bytes(storage.read_blob_gcs(name)))
+    self.assertEqual(0, len(self.bucket.downloads))
+
+  def testEvictsLeastRecentlyUsed(self):
+    for name in ('a', 'b', 'c'):
+      self.bucket.data[name] = b'12345678'
+    storage.read_blob_gcs('a')
+    storage.read_blob_gcs('b')
+    storage.read_blob_gcs('a')
+    storage.read_blob_gcs('c')
+    self.assertEqual(['a', 'c'], list(storage._cache_index))
+    self.assertEqual(16, storage._cache_bytes)
+    self.assertEqual(2, len(os.listdir(storage._cache_dir)))
+    self.assertEqual(1, storage.get_stats()['cache_evictions'])
+
+  def testSkipsBlobsLargerThanCache(self):
+    self.bucket.data['blob'] = b'x' * 21
+    storage.read_blob_gcs('blob')
+    self.assertEqual([], list(storage._cache_index))
+
+  def testDeleteDiscards(self):
+    name = storage.write_json_gcs('"value"', 'root')
+    storage.delete_blobs_gcs('root')
+    self.assertEqual([], list(storage._cache_index))
+    self.assertEqual([], os.listdir(storage._cache_dir))
+    from google.api_core.exceptions import NotFound
+    self.assertRaises(NotFound, storage.read_blob_gcs, name)
+
+
+class FakeClient:
+  """A storage.Client that records how it was used."""
+
+  SCOPE = ('https://www.googleapis.com/auth/devstorage.full_control',)
+  created = 0
+
+  def __init__(self, credentials=None, _http=None):
+    FakeClient.created += 1
+    self.credentials = credentials
+    self.http = _http
+    self.buckets = []
+
+  def bucket(self, name):
+    self.buckets.append(name)
+    return testutil.FakeBucket()
+
+
+class FakeAppIdentity:
+  """Counts the lookups of the default bucket name."""
+
+  calls = 0
+
+  def get_default_gcs_bucket_name(self):
+    FakeAppIdentity.calls += 1
+    return 'my-bucket'
+
+
+class ClientTest(unittest.TestCase):
+  """Tests for the shared client and bucket handle."""
+
+  def setUp(self):
+    super().setUp()
+    self.old_client_class = storage.storage.Client
+    self.old_app_identity = storage.app_identity
+    self.old_auth_default = storage.google.auth.default
+    self.credentials = AnonymousCredentials()
+    storage.storage.Client = FakeClient
+    storage.app_identity = FakeAppIdentity()
+    storage.google.auth.default = lambda scopes: (self.credentials, 'project')
+    FakeClient.created = 0
+    FakeAppIdentity.calls = 0
+    storage._client = None
+    storage._default_bucket = None
+
+  def tearDown(self):
+    storage.storage.Client = self.old_client_class
+    storage.app_identity = self.old_app_identity
+    storage.google.auth.default = self.old_auth_default
+    storage._client = None
+    storage._default_bucket = None
+    super().tearDown()
+
+  def testLazyClient(self):
+    self.assertEqual(None, storage._client)
+    client = storage._get_client()
+    self.assertIs(client, storage._get_client())
+    self.assertEqual(1, FakeClient.created)
+    self.assertIs(self.credentials, client.credentials)
+    self.assertIs(self.credentials, client.http.credentials)
+    adapter = client.http.get_adapter('https://storage.googleapis.com/')
+    self.assertEqual(storage._CONNECTION_POOL_SIZE, adapter._pool_maxsize)
+
+  def testCachedBucket(self):
+    bucket = storage._get_default_bucket()
+    self.assertIs(bucket, storage._get_default_bucket())
+    self.assertEqual(1, FakeAppIdentity.calls)
+    self.assertEqual(['my-bucket'], storage._client.buckets)
+
+  def testThreadSafe(self):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(storage._get_client()))
+        for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, FakeClient.created)
+    self.assertEqual(1, len(set(map(id, results))))
+
+
+if __name__ == '__main__':
+  unittest.main()
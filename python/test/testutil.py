@@ -20,8 +20,11 @@
 # Code originally from:
 #   http://code.google.com/p/pubsubhubbub/source/browse/trunk/hub/testutil.py
 
+import io
 import logging
 import os
+import threading
+import types
 
 from google.appengine.api import full_app_id
 
@@ -79,3 +82,159 @@ class TestSetupMixin:
   def tearDown(self):
     super().tearDown()
     self.testbed.deactivate()
+
+
+class IndexWriteCounter:
+  """Counts the entities and indexed property values put in the Datastore.
+
+  Every put is counted as if it inserted a new entity, so each indexed value
+  costs two index writes: one for the ascending and one for the descending
+  built-in index.
+  """
+
+  def __init__(self):
+    self.entities = 0
+    self.indexed_values = 0
+
+  def install(self):
+    """Starts counting the puts made through the current API proxy."""
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'index_write_counter', self._hook, 'datastore_v3')
+
+  def _hook(self, service, call, request, response):
+    if call == 'Put':
+      for entity in request.entity:
+        self.entities += 1
+        self.indexed_values += len(entity.property)
+
+  @property
+  def index_writes(self):
+    return 2 * self.indexed_values
+
+
+class FakeBlob:
+  """A Cloud Storage blob whose contents live in a FakeBucket."""
+
+  def __init__(self, bucket, name, size=None):
+    self.bucket = bucket
+    self.name = name
+    self.size = size
+    self.self_link = 'fake://%s' % name
+
+  def upload_from_string(self, data, content_type='text/plain',
+                         if_generation_match=None):
+    from google.api_core.exceptions import PreconditionFailed
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    if if_generation_match == 0 and self.name in self.bucket.data:
+      raise PreconditionFailed('Blob %s already exists' % self.name)
+    self.bucket.uploads.append(self.name)
+    self.bucket.data[self.name] = data
+
+  def open(self, mode='r', chunk_size=None, **kwargs):
+    if mode == 'wb':
+      return _FakeBlobWriter(self)
+    if mode == 'rb':
+      self.bucket.downloads.append(self.name)
+      return io.BytesIO(self.bucket.data[self.name])
+    raise ValueError('Unsupported mode %r' % mode)
+
+  def download_as_bytes(self):
+    from google.api_core.exceptions import NotFound
+    if self.name not in self.bucket.data:
+      raise NotFound('Blob %s not found' % self.name)
+    self.bucket.downloads.append(self.name)
+    return self.bucket.data[self.name]
+
+  def delete(self):
+    batch = getattr(self.bucket.client.local, 'batch', None)
+    if batch is None:
+      raise NotImplementedError('Only deletes in batches are faked')
+    batch.names.append(self.name)
+
+
+class _FakeBlobWriter(io.BytesIO):
+  """Saves what was written to a FakeBlob when closed."""
+
+  def __init__(self, blob):
+    super().__init__()
+    self.blob = blob
+
+  def close(self):
+    if not self.closed:
+      self.blob.upload_from_string(self.getvalue())
+    super().close()
+
+
+class _FakeResponse:
+  """The response to one request of a _FakeBatch."""
+
+  def __init__(self, status_code, name):
+    self.status_code = status_code
+    self.headers = {}
+    self.text = ''
+    self.request = types.SimpleNamespace(method='DELETE', url='fake://' + name)
+
+  def json(self):
+    return {}
+
+
+class _FakeBatch:
+  """Records the blobs deleted within it as one batch request."""
+
+  def __init__(self, bucket):
+    self.bucket = bucket
+    self.names = []
+    self._responses = []
+
+  def __enter__(self):
+    self.bucket.client.local.batch = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.bucket.client.local.batch = None
+    if exc_type is not None:
+      return
+    with self.bucket.client.lock:
+      self.bucket.delete_batches.append(self.names)
+      for name in self.names:
+        if name in self.bucket.fail_deletes:
+          self._responses.append(_FakeResponse(503, name))
+        elif self.bucket.data.pop(name, None) is None:
+          self._responses.append(_FakeResponse(404, name))
+        else:
+          self._responses.append(_FakeResponse(204, name))
+
+
+class _FakeBatchClient:
+  """The client of a FakeBucket; only creates batches."""
+
+  def __init__(self, bucket):
+    self.bucket = bucket
+    self.local = threading.local()
+    self.lock = threading.Lock()
+
+  def batch(self, raise_exception=True):
+    return _FakeBatch(self.bucket)
+
+
+class FakeBucket:
+  """An in-memory stand-in for the default Cloud Storage bucket."""
+
+  def __init__(self, data=None):
+    self.data = {} if data is None else data
+    self.uploads = []
+    self.downloads = []
+    self.delete_batches = []
+    self.fail_deletes = set()
+    self.client = _FakeBatchClient(self)
+
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+  def list_blobs(self, prefix=None, max_results=None):
+    return [FakeBlob(self, name, len(data))
+            for name, data in sorted(self.data.items())
+            if prefix is None or name.startswith(prefix)][:max_results]
+
@@ -12,7 +12,9 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
 
 from pipeline import util
 
+from google.appengine.api import namespace_manager
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 
 class JsonSerializationTest(unittest.TestCase):
@@ -26,6 +28,256 @@ class JsonSerializationTest(unittest.TestCase):
     self.assertEqual(obj, new_obj)
 
 
+class CodecTest(unittest.TestCase):
+  """Test the codec layer used for params and slot values."""
+
+  def setUp(self):
+    super().setUp()
+    self.value = {
+        "none": None,
+        "bools": [True, False],
+        "ints": [0, 1, -1, 127, 128, -129, 2**70, -(2**70)],
+        "float": 1.5,
+        "str": "caf\u00e9 \U0001f600",
+        "bytes": b"\x00\xff",
+        "nested": {"tuple": (1, "two"), "empty": {}},
+        "when": datetime.datetime(1960, 5, 6, 7, 8, 9, 123456),
+        "key": ndb.Key("Kind", "name", "Child", 42, app="my-app"),
+    }
+
+  def testJsonE2e(self):
+    encoded = util.encode_value(self.value, util.JSON_CODEC)
+    self.assertIsInstance(encoded, str)
+    decoded = util.decode_value(encoded, util.JSON_CODEC)
+    self.assertEqual(util.decode_value(encoded, None), decoded)
+    self.assertEqual([1, "two"], decoded["nested"]["tuple"])
+    self.assertEqual(self.value["key"], decoded["key"])
+
+  def testJsonKeys(self):
+    key = ndb.Key("Kind", "name", "Child", 42)
+    encoded = util.encode_value([key], util.JSON_CODEC)
+    self.assertIn(key.urlsafe().decode(), encoded)
+    self.assertEqual([key], util.decode_value(encoded))
+
+  def testJsonFlatKeys(self):
+    self.addCleanup(setattr, util, "_FLAT_KEYS", util._FLAT_KEYS)
+    util._FLAT_KEYS = True
+    key = ndb.Key("Kind", "name", "Child", 42)
+    encoded = util.encode_value([key], util.JSON_CODEC)
+    self.assertIn('["Kind", "name", "Child", 42]', encoded)
+    self.assertEqual([key], util.decode_value(encoded))
+
+    # Keys of other apps keep the urlsafe encoding.
+    other = ndb.Key("Kind", "name", app="other-app")
+    encoded = util.encode_value([other], util.JSON_CODEC)
+    self.assertIn(other.urlsafe().decode(), encoded)
+    self.assertEqual([other], util.decode_value(encoded))
+
+  def testJsonFlatKeysNamespace(self):
+    self.addCleanup(setattr, util, "_FLAT_KEYS", util._FLAT_KEYS)
+    util._FLAT_KEYS = True
+    old_namespace = namespace_manager.get_namespace()
+    self.addCleanup(namespace_manager.set_namespace, old_namespace)
+
+    # Keys keep their namespace whatever the current one is when decoded.
+    key = ndb.Key("Kind", "name", namespace="tenant")
+    encoded = util.encode_value([key], util.JSON_CODEC)
+    for namespace in ("", "tenant", "other"):
+      namespace_manager.set_namespace(namespace)
+      self.assertEqual([key], util.decode_value(encoded))
+    namespace_manager.set_namespace("")
+    key = ndb.Key("Kind", "name")
+    encoded = util.encode_value([key], util.JSON_CODEC)
+    namespace_manager.set_namespace("tenant")
+    self.assertEqual([key], util.decode_value(encoded))
+
+    # Flat paths stored without a namespace use the current one.
+    encoded = encoded.replace(', "namespace": ""', "")
+    self.assertEqual([ndb.Key("Kind", "name", namespace="tenant")],
+                     util.decode_value(encoded))
+
+  def testJsonDatetimes(self):
+    for when in (datetime.datetime(2020, 1, 2, 3, 4, 5),
+                 datetime.datetime(1000, 1, 2, 3, 4, 5, 6)):
+      encoded = util.encode_value(when, util.JSON_CODEC)
+      self.assertEqual(when, util.decode_value(encoded))
+      # Encodings are still readable with the format they used to be read with.
+      self.assertEqual(when, datetime.datetime.strptime(
+          util.json.loads(encoded)["isostr"], util._DATETIME_FORMAT))
+
+  def testJsonWithoutOrjson(self):
+    encoded = util.encode_value({"a": [1, 2.5, "x", None]}, util.JSON_CODEC)
+    decoded = util.decode_value(encoded)
+    old_use_orjson = util._USE_ORJSON
+    util._USE_ORJSON = False
+    try:
+      self.assertEqual(decoded, util.decode_value(encoded))
+    finally:
+      util._USE_ORJSON = old_use_orjson
+
+  def testJsonOnlyJsonModuleAccepts(self):
+    self.assertEqual([2**70], util.decode_value("[1180591620717411303424]"))
+    decoded = util.decode_value("[NaN]")
+    self.assertNotEqual(decoded[0], decoded[0])
+
+  def testBinaryE2e(self):
+    encoded = util.encode_value(self.value, util.BINARY_CODEC)
+    self.assertIsInstance(encoded, bytes)
+    decoded = util.decode_value(encoded, util.BINARY_CODEC)
+    expected = dict(self.value)
+    expected["nested"] = {"tuple": [1, "two"], "empty": {}}
+    self.assertEqual(expected, decoded)
+
+  def testBinaryMatchesJson(self):
+    value = [{1: "int key", 2.5: [1.0, "x"]}, {True: False}, {None: 0}]
+    self.assertEqual(
+        util.decode_value(util.encode_value(value, util.JSON_CODEC)),
+        util.decode_value(util.encode_value(value, util.BINARY_CODEC),
+                          util.BINARY_CODEC))
+
+  def testBinaryIsCompact(self):
+    value = {"args": [{"type": "value", "value": b"x" * 3000}]}
+    self.assertLess(
+        len(util.encode_value(value, util.BINARY_CODEC)),
+        len(util.encode_value(value, util.JSON_CODEC)) * 0.8)
+
+  def testBinaryRegisteredPrimitive(self):
+    class Point(object):
+      def __init__(self, x, y):
+        self.x, self.y = x, y
+
+      def __eq__(self, other):
+        return (self.x, self.y) == (other.x, other.y)
+
+    util._register_json_primitive(
+        Point, lambda p: {"x": p.x, "y": p.y}, lambda d: Point(d["x"], d["y"]))
+    try:
+      encoded = util.encode_value([Point(1, 2)], util.BINARY_CODEC)
+      self.assertEqual([Point(1, 2)],
+                       util.decode_value(encoded, util.BINARY_CODEC))
+    finally:
+      del util._TYPE_TO_ENCODER[Point]
+      del util._TYPE_NAME_TO_DECODER["Point"]
+
+  def testBinaryNotSerializable(self):
+    self.assertRaises(TypeError, util.encode_value, object(),
+                      util.BINARY_CODEC)
+    self.assertRaises(TypeError, util.encode_value, {(1, 2): 3},
+                      util.BINARY_CODEC)
+
+  def testBinaryBadData(self):
+    self.assertRaises(ValueError, util.decode_value, b"{}",
+                      util.BINARY_CODEC)
+
+  def testUnknownCodec(self):
+    self.assertRaises(ValueError, util.encode_value, 1, "bogus")
+    self.assertRaises(ValueError, util.decode_value, "1", "bogus")
+
+
+class CompressionTest(unittest.TestCase):
+  """Test compression of encoded values."""
+
+  def testE2e(self):
+    encoded = util.encode_value({"a": "b" * 10000})
+    compressed = util.compress_encoded(encoded)
+    self.assertTrue(compressed.startswith(util._COMPRESSED_HEADER))
+    self.assertLess(len(compressed), len(encoded))
+    self.assertEqual({"a": "b" * 10000},
+                     util.decode_value(util.decompress_encoded(compressed)))
+
+  def testIncompressible(self):
+    encoded = util.encode_value(b"\x01", util.BINARY_CODEC)
+    self.assertIs(encoded, util.compress_encoded(encoded))
+
+  def testPlainPassThrough(self):
+    self.assertEqual("{}", util.decompress_encoded("{}"))
+    self.assertEqual(b"{}", util.decompress_encoded(b"{}"))
+
+
+class JsonStreamTest(unittest.TestCase):
+  """Test the JSON stream codec and streamed compression."""
+
+  def _chunked(self, data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+  def testRoundTrip(self):
+    for value in ([1, {"a": "x\ny"}, [], datetime.datetime(2020, 1, 2)],
+                  {"b": [1, 2], "a": b"\x00", "caf\u00e9": "\U0001f600"},
+                  {1: 2, 3.5: None}, [], {}, (1, 2), "str", 5, None):
+      expected = util.decode_value(util.encode_value(value))
+      encoded = "".join(util.iter_encode_json_stream(value))
+      self.assertEqual(expected, util.decode_value(encoded))
+      self.assertEqual(
+          expected, util.decode_value(encoded, util.JSON_STREAM_CODEC))
+      for size in (1, 3, 1000):
+        self.assertEqual(expected, util.decode_json_stream(
+            self._chunked(encoded.encode(), size)))
+
+  def testOneItemPerLine(self):
+    self.assertEqual(["[\n", "1", ",\n2", "\n]"],
+                     list(util.iter_encode_json_stream([1, 2])))
+
+  def testIterLines(self):
+    data = b"one\ntwo\n\nthree and a long line\n"
+    for size in (1, 2, 5, 100):
+      self.assertEqual([b"one", b"two", b"", b"three and a long line", b""],
+                       list(util._iter_lines(self._chunked(data, size))))
+    self.assertEqual([b""], list(util._iter_lines([])))
+    self.assertEqual([b"a", b"b"], list(util._iter_lines([b"a\n", b"", b"b"])))
+
+  def testCompressChunks(self):
+    encoded = "".join(util.iter_encode_json_stream(["b" * 100] * 100))
+    compressed = b"".join(util.compress_chunks(
+        util.iter_encode_json_stream(["b" * 100] * 100)))
+    self.assertLess(len(compressed), len(encoded))
+    self.assertEqual(encoded.encode(), util.decompress_encoded(compressed))
+    for size in (1, 7, 100000):
+      self.assertEqual(encoded.encode(), b"".join(
+          util.decompress_chunks(self._chunked(compressed, size))))
+
+  def testDecompressChunksPassThrough(self):
+    self.assertEqual(b"[1]", b"".join(util.decompress_chunks([b"[", b"1]"])))
+    self.assertEqual(b"", b"".join(util.decompress_chunks([])))
+
+
+class ForNameTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    util._for_name_cache.clear()
+    util._for_name_errors.clear()
+    self.addCleanup(util._for_name_errors.clear)
+
+  def testResolves(self):
+    self.assertIs(util.JsonEncoder, util.for_name("pipeline.util.JsonEncoder"))
+    self.assertIs(util.JsonEncoder.default,
+                  util.for_name("pipeline.util.JsonEncoder.default"))
+    self.assertIs(util.JsonEncoder,
+                  util._for_name_cache["pipeline.util.JsonEncoder"])
+
+  def testNegativeCache(self):
+    name = "pipeline.util.NotDefinedYet"
+    self.assertRaises(ImportError, util.for_name, name)
+    util.NotDefinedYet = object()
+    self.addCleanup(delattr, util, "NotDefinedYet")
+    self.assertRaises(ImportError, util.for_name, name)
+
+    # The name is looked up again once the error expires.
+    expiry, error_class, error_args = util._for_name_errors[name]
+    util._for_name_errors[name] = (0, error_class, error_args)
+    self.assertIs(util.NotDefinedYet, util.for_name(name))
+
+  def testMissingModule(self):
+    self.assertRaises(ImportError, util.for_name, "does_not_exist.Foo")
+    self.assertRaises(ImportError, util.for_name, "does_not_exist.Foo")
+
+  def testPreload(self):
+    self.assertEqual(
+        ["does_not_exist.Foo"],
+        util.preload(["pipeline.util.JsonEncoder", "does_not_exist.Foo"]))
+    self.assertIn("pipeline.util.JsonEncoder", util._for_name_cache)
+
+
 class GetTaskTargetTest(unittest.TestCase):
 
   def setUp(self):